@@ -0,0 +1,170 @@
+#!/usr/bin/env python3
+
+# Batch execution for EVM From Scratch
+#
+# executeBatch runs independent executions (code, tx, block, state) on a pool
+# of worker processes and streams the results back:
+#
+#   for index, (success, stack, logsReturnOutput) in executeBatch(jobs, workers=4):
+#       ...
+#
+# Every distinct code and state is sent to each worker once, when the worker
+# starts, and the worker analyses each code up front. Jobs then only carry
+# a code index and a state index next to their tx and block, in chunks of
+# chunkSize jobs. With ordered=True results come back in job order,
+# otherwise as soon as their chunk is done.
+#
+# Code analysis holds bound handlers and compiled blocks which can not be
+# pickled, so workers build it from the code bytes instead of receiving it.
+# Workers run on an engine with the fuse and jitThreshold settings of
+# `engine`, without its hooks or changes to its opcode table. DiskState
+# needs its own database connection per process and is only supported with
+# workers=1.
+#
+#   python3 batch.py [workers] [rounds]
+#
+# runs the tests of evm.json `rounds` times through executeBatch and prints
+# the throughput.
+
+import json
+import os
+import sys
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from dataclasses import dataclass
+from typing import Any
+
+import evm
+
+@dataclass
+class Job:
+    code: bytes
+    tx: Any = None
+    block: Any = None
+    # the test's state mapping or a BaseState, jobs sharing one object share
+    # it in the workers as well
+    state: Any = None
+    # overrides the outStackFormat of executeBatch for this job
+    outStackFormat: Any = None
+
+# Engine, codes and states of the batch, set once per worker process
+workerEngine = None
+workerCodes = []
+workerStates = []
+
+def initWorker(fuse, jitThreshold, codes, states):
+    global workerEngine, workerCodes, workerStates
+    workerEngine = evm.EVM(fuse=fuse, jitThreshold=jitThreshold)
+    workerCodes = codes
+    workerStates = states
+    for code in codes:
+        workerEngine.analysisCache.get(code)
+
+def runChunk(chunk, outStackFormat):
+    results = []
+    for index, codeIndex, tx, block, stateIndex, jobStackFormat in chunk:
+        result = workerEngine.execute(workerCodes[codeIndex], jobStackFormat or outStackFormat,
+                                      tx, block, workerStates[stateIndex])
+        results.append((index, result))
+    return results
+
+# Splits jobs into the codes and states to ship and the chunks to run
+def prepare(jobs, chunkSize):
+    codes = []
+    # keyed by the code bytes, their hash is cached by Python and needs no
+    # keccak
+    codeIndexes = {}
+    states = []
+    # keyed by id(job.state), the objects are kept in jobStates so no id is
+    # reused while the jobs are prepared, e.g. when they come from a
+    # generator and a state mapping is freed after its last job
+    stateIndexes = {}
+    jobStates = []
+    chunks = []
+    chunk = []
+    for index, job in enumerate(jobs):
+        codeIndex = codeIndexes.get(job.code)
+        if codeIndex is None:
+            codeIndex = codeIndexes[job.code] = len(codes)
+            codes.append(job.code)
+        stateIndex = stateIndexes.get(id(job.state))
+        if stateIndex is None:
+            state = job.state
+            if isinstance(state, evm.DiskState):
+                raise TypeError('DiskState can only be used with workers=1')
+            if not isinstance(state, evm.BaseState):
+                # parsed once here instead of once per job in every worker
+                state = evm.BaseState.fromJson(state)
+            stateIndex = stateIndexes[id(job.state)] = len(states)
+            states.append(state)
+            jobStates.append(job.state)
+        chunk.append((index, codeIndex, job.tx or {}, job.block or {}, stateIndex, job.outStackFormat))
+        if len(chunk) == chunkSize:
+            chunks.append(chunk)
+            chunk = []
+    if chunk:
+        chunks.append(chunk)
+    return codes, states, chunks
+
+# Generator of (job index, result of EVM.execute) for every job. workers
+# defaults to the number of cores, workers=1 runs the jobs in this process
+# on `engine`, evm.defaultEngine when not given
+def executeBatch(jobs, workers=None, ordered=True, chunkSize=16,
+                 outStackFormat=evm.outputStackFormat.MultipleLine, engine=None):
+    if engine is None:
+        engine = evm.defaultEngine
+    if workers is None:
+        workers = os.cpu_count() or 1
+    if workers <= 1:
+        for index, job in enumerate(jobs):
+            yield index, engine.execute(job.code, job.outStackFormat or outStackFormat,
+                                        job.tx or {}, job.block or {}, job.state)
+        return
+
+    codes, states, chunks = prepare(jobs, chunkSize)
+    # a few chunks per worker in flight keeps every worker busy without
+    # holding every pending result in memory
+    window = workers * 4
+    chunks = deque(chunks)
+    pending = deque()
+    with ProcessPoolExecutor(workers, initializer=initWorker,
+                             initargs=(engine.fuse, engine.jitThreshold, codes, states)) as pool:
+        def submit():
+            while chunks and len(pending) < window:
+                pending.append(pool.submit(runChunk, chunks.popleft(), outStackFormat))
+        submit()
+        while pending:
+            if ordered:
+                done = [pending.popleft()]
+            else:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    pending.remove(future)
+            for future in done:
+                yield from future.result()
+            submit()
+
+def testJobs():
+    with open(os.path.join(os.path.dirname(__file__), '..', 'evm.json')) as f:
+        data = json.load(f)
+    jobs = []
+    expected = []
+    for test in data:
+        jobs.append(Job(bytes.fromhex(test['code']['bin']), test.get('tx', {}),
+                        test.get('block', {}), test.get('state', {})))
+        expected.append(test['expect']['success'])
+    return jobs, expected
+
+if __name__ == '__main__':
+    workers = int(sys.argv[1]) if len(sys.argv) > 1 else os.cpu_count()
+    rounds = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+    jobs, expected = testJobs()
+    jobs = jobs * rounds
+    expected = expected * rounds
+    start = time.perf_counter()
+    failed = 0
+    for index, (success, stack, logsReturnOutput) in executeBatch(jobs, workers):
+        failed += success != expected[index]
+    elapsed = time.perf_counter() - start
+    print(f'{len(jobs)} executions on {workers} workers: {len(jobs) / elapsed:,.0f} executions/s, {failed} unexpected results')
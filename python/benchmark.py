@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+
+# Throughput benchmark for the run loop
+#
+# Runs loop-heavy contracts on the plain program, with superinstructions and
+# with compiled blocks, and prints instructions per second for each:
+#
+#   python3 benchmark.py [iterations]
+
+import sys
+import time
+
+import evm
+
+# Counts down from `iterations`, adding 3 to an accumulator which goes through
+# memory on every round. Hits PUSH+ADD, PUSH+MSTORE, PUSH+MLOAD and PUSH+JUMPI
+#
+#   PUSH1 0 ; PUSH3 n
+#   JUMPDEST
+#   SWAP1 ; PUSH1 3 ; ADD ; DUP1 ; PUSH1 0 ; MSTORE ; PUSH1 0 ; MLOAD ; POP
+#   SWAP1 ; PUSH1 1 ; SWAP1 ; SUB ; DUP1 ; PUSH1 6 ; JUMPI ; STOP
+def counterLoop(iterations):
+    return bytes.fromhex(
+        "6000" + "62" + iterations.to_bytes(3, "big").hex() +
+        "5b" +
+        "90600301" + "8060005260005150" +
+        "906001900380600657" + "00")
+
+# Same countdown, but the body shuffles the stack with DUP+SWAP pairs and
+# leaves the loop through PUSH+JUMP
+#
+#   PUSH3 n
+#   JUMPDEST (pc 4)
+#   PUSH1 1 ; DUP2 ; SWAP1 ; SWAP1 ; SUB ; SWAP1 ; POP
+#   DUP1 ; ISZERO ; PUSH1 21 ; JUMPI
+#   PUSH1 4 ; JUMP
+#   JUMPDEST (pc 21) ; STOP
+def shuffleLoop(iterations):
+    return bytes.fromhex(
+        "62" + iterations.to_bytes(3, "big").hex() +
+        "5b" +
+        "60018190900390" + "50" +
+        "8015601557" +
+        "600456" +
+        "5b00")
+
+WORKLOADS = {
+    'counterLoop': counterLoop,
+    'shuffleLoop': shuffleLoop,
+}
+
+def countInstructions(program):
+    # Number of instructions an unfused run executes, used to report both
+    # modes in the same unit
+    callStack = evm.CallStack(program.code)
+    callStack.call(b"")
+    ctx = callStack.currentCtx()
+    inputParam = evm.InputParam(Opcode=None, Txn=evm.TxEnv(), Block=evm.BlockEnv(), State={})
+    instructions = program.instructions
+    count = 0
+    pc = 0
+    while pc < len(instructions):
+        run, ctx.pc, _ = instructions[pc]
+        response = run(ctx, inputParam)
+        count += 1
+        if response.stopRun:
+            break
+        pc = ctx.pc
+    return count
+
+def timeRun(code, mode, repeat=3):
+    best = None
+    for _ in range(repeat):
+        callStack = evm.CallStack(code)
+        callStack.call(b"")
+        ctx = callStack.currentCtx()
+        inputParam = evm.InputParam(Opcode=None, Txn=evm.TxEnv(), Block=evm.BlockEnv(), State={})
+        if mode == 'fused':
+            program = callStack.analysis.fusedProgram()
+        elif mode == 'jit':
+            program = callStack.analysis.jitProgram()
+        else:
+            program = callStack.program
+        start = time.perf_counter()
+        (pc, response) = evm.runProgram(ctx, inputParam, program)
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+def main():
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    for name, build in WORKLOADS.items():
+        code = build(iterations)
+        analysis = evm.defaultEngine.analysisCache.get(code)
+        count = countInstructions(analysis.program)
+        plain = timeRun(code, 'plain')
+        print(f'{name}: {count} instructions, {analysis.fusedProgram().fused} fused pairs')
+        print(f'  plain  {count / plain:12.0f} instr/s')
+        for mode in ('fused', 'jit'):
+            elapsed = timeRun(code, mode)
+            print(f'  {mode:6} {count / elapsed:12.0f} instr/s  ({plain / elapsed:.2f}x)')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,300 @@
+#!/usr/bin/env python3
+
+# Benchmark suite for EVM From Scratch
+#
+# Three tiers, every benchmark is timed as the best of `repeat` runs:
+#   micro     a loop around a few instructions of one opcode family
+#             (arithmetic, SAR, EXP, memory, SHA3, jumps)
+#   macro     contract-like workloads: a counting loop, keccak mapping
+#             access through SLOAD/SSTORE, large memory copies and
+#             calldata decoding
+#   startup   importing evm.py and the first execution, in a new process,
+#             and a whole `evm.py test=<hex>` command next to the startup of
+#             the bare interpreter
+#
+# Results are written as JSON with out=<file>. A file written before can be
+# passed as baseline=<file>, every benchmark slower than the baseline by more
+# than tolerance (a fraction, 0.1 by default) is reported as a regression
+# and the exit status is 1. The startup tier also fails when importing evm.py
+# and running code without SHA3 imported a module which is meant to load
+# lazily (LAZY_MODULES), whatever the timings.
+#
+#   python3 benchsuite.py [micro] [macro] [startup] [fuse] [jit=N]
+#                         [out=<file>] [baseline=<file>] [tolerance=0.1]
+#
+# Without tiers all of them run. fuse and jit= configure the engine as for
+# evm.py.
+#
+#   python3 benchsuite.py builds [micro] [macro] [fuse] [jit=N]
+#
+# runs the micro and macro tiers twice, each in its own process: on the
+# Python sources of core.py and word.py (EVM_PURE_PYTHON=1) and on their
+# mypyc build, and prints both with the speedup. The build has to exist,
+# see core.py.
+
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+
+import benchmark
+import evm
+
+NAMES = {opcodeDataObj.name: op for op, opcodeDataObj in evm.defaultOpcodes().items()}
+
+def assemble(*items):
+    # Opcode names, ints (pushed with the smallest PUSH), '@label' for a
+    # JUMPDEST and ':label' to push the pc of a label
+    code = bytearray()
+    labels = {}
+    fixups = []
+    for item in items:
+        if isinstance(item, int):
+            size = max(1, (item.bit_length() + 7) // 8)
+            code.append(0x60 + size - 1)
+            code += item.to_bytes(size, 'big')
+        elif item.startswith('@'):
+            labels[item[1:]] = len(code)
+            code.append(NAMES['JUMPDEST'])
+        elif item.startswith(':'):
+            code.append(NAMES['PUSH2'])
+            fixups.append((len(code), item[1:]))
+            code += b'\x00\x00'
+        else:
+            code.append(NAMES[item])
+    for offset, label in fixups:
+        code[offset:offset+2] = labels[label].to_bytes(2, 'big')
+    return bytes(code)
+
+def loop(iterations, body):
+    # Runs body `iterations` times with the counter on top of the stack, body
+    # has to leave the stack as it found it. Returns the code and the number
+    # of instructions it executes
+    code = assemble(iterations, '@loop', *body, 1, 'SWAP1', 'SUB', 'DUP1', ':loop', 'JUMPI', 'STOP')
+    return code, 2 + iterations * (len(body) + 7)
+
+MICRO = {
+    'arithmetic': [3, 5, 'ADD', 7, 'MUL', 11, 'SWAP1', 'SUB', 13, 'SWAP1', 'DIV', 17, 'SWAP1', 'MOD', 'POP'],
+    'sar': [evm.UINT256MAX - 12345, 7, 'SAR', 'POP', 1 << 255, 200, 'SAR', 'POP'],
+    'exp': [0xffff, 3, 'EXP', 'POP', 31, 0xff, 'EXP', 'POP'],
+    'memory': [42, 0, 'MSTORE', 0, 'MLOAD', 'POP', 7, 33, 'MSTORE8', 32, 'MLOAD', 'POP'],
+    'sha3': [64, 0, 'SHA3', 'POP', 32, 0, 'SHA3', 'POP'],
+    'jumps': [':a', 'JUMP', '@a', ':b', 'JUMP', '@b', 1, ':c', 'JUMPI', '@c'],
+}
+
+def mappingAccess(iterations):
+    # balances[counter] += 1 with the slot of the mapping at 5, the key is
+    # keccak(counter . 5) as in Solidity
+    return loop(iterations, ['DUP1', 0, 'MSTORE', 5, 32, 'MSTORE', 64, 0, 'SHA3',
+                             'DUP1', 'SLOAD', 1, 'ADD', 'SWAP1', 'SSTORE'])
+
+def memoryCopy(iterations):
+    # copies the whole calldata to two places in memory
+    return loop(iterations, ['CALLDATASIZE', 0, 0, 'CALLDATACOPY',
+                             'CALLDATASIZE', 0, 8192, 'CALLDATACOPY'])
+
+def calldataDecoding(iterations):
+    # selector and the sum of eight word arguments
+    body = [0, 'CALLDATALOAD', 224, 'SHR', 'POP', 4, 'CALLDATALOAD']
+    for index in range(1, 8):
+        body += [4 + 32 * index, 'CALLDATALOAD', 'ADD']
+    body.append('POP')
+    return loop(iterations, body)
+
+def macroWorkloads(iterations):
+    # name -> (code, instructions, tx)
+    counter = benchmark.counterLoop(iterations)
+    arguments = bytes.fromhex('a9059cbb') + b''.join(i.to_bytes(32, 'big') for i in range(8))
+    return {
+        'loop': (counter, benchmark.countInstructions(evm.defaultEngine.analysisCache.get(counter).program), {}),
+        'mapping': mappingAccess(iterations) + ({},),
+        'memoryCopy': memoryCopy(iterations) + ({'data': (bytes(range(256)) * 16).hex()},),
+        'calldataDecoding': calldataDecoding(iterations) + ({'data': arguments.hex()},),
+    }
+
+def timeExecution(engine, code, tx, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        (success, stack, logsReturnOutput) = engine.execute(code, evm.outputStackFormat.MultipleLine, tx, {}, {})
+        elapsed = time.perf_counter() - start
+        if not success:
+            raise RuntimeError('benchmark code failed')
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+def result(seconds, instructions):
+    entry = {'seconds': seconds}
+    if instructions:
+        entry['instructionsPerSecond'] = instructions / seconds
+    return entry
+
+def runMicro(engine, iterations, repeat):
+    results = {}
+    for name, body in MICRO.items():
+        code, instructions = loop(iterations, body)
+        results[f'micro/{name}'] = result(timeExecution(engine, code, {}, repeat), instructions)
+    return results
+
+def runMacro(engine, iterations, repeat):
+    results = {}
+    for name, (code, instructions, tx) in macroWorkloads(iterations).items():
+        results[f'macro/{name}'] = result(timeExecution(engine, code, tx, repeat), instructions)
+    return results
+
+# Modules evm.py only imports when they are needed, the keccak backend is
+# loaded by the first hash
+LAZY_MODULES = ('eth_utils', 'eth_hash', 'dataclasses')
+
+STARTUP = '''
+import json, sys, time
+start = time.perf_counter()
+import evm
+imported = time.perf_counter()
+evm.EVM().execute(bytes.fromhex('6001600201'), evm.outputStackFormat.MultipleLine, {}, {}, {})
+print(json.dumps([imported - start, time.perf_counter() - imported,
+                  [name for name in %r if name in sys.modules]]))
+''' % (LAZY_MODULES,)
+
+def timeCommand(args, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        subprocess.run(args, capture_output=True, check=True, cwd=sys.path[0] or '.')
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+# Results and the LAZY_MODULES the startup imported
+def runStartup(repeat):
+    best = None
+    eagerImports = set()
+    for _ in range(repeat):
+        output = subprocess.run([sys.executable, '-c', STARTUP], capture_output=True, text=True,
+                                check=True, cwd=sys.path[0] or '.').stdout
+        imported, firstRun, modules = json.loads(output.splitlines()[-1])
+        eagerImports.update(modules)
+        best = [imported, firstRun] if best is None else [min(best[0], imported), min(best[1], firstRun)]
+    results = {
+        'startup/import': result(best[0], None),
+        'startup/firstRun': result(best[1], None),
+        'startup/interpreter': result(timeCommand([sys.executable, '-c', 'pass'], repeat), None),
+        'startup/cli': result(timeCommand([sys.executable, 'evm.py', 'test=6001600201'], repeat), None),
+    }
+    return results, sorted(eagerImports)
+
+# Benchmarks slower than the baseline by more than tolerance:
+# [(name, baseline seconds, seconds)]
+def compare(results, baseline, tolerance):
+    regressions = []
+    for name, entry in results.items():
+        before = baseline.get('results', {}).get(name)
+        if before is not None and entry['seconds'] > before['seconds'] * (1 + tolerance):
+            regressions.append((name, before['seconds'], entry['seconds']))
+    return regressions
+
+def run(tiers, engine, iterations=2000, repeat=5):
+    results = {}
+    eagerImports = []
+    if 'micro' in tiers:
+        results.update(runMicro(engine, iterations, repeat))
+    if 'macro' in tiers:
+        results.update(runMacro(engine, iterations, repeat))
+    if 'startup' in tiers:
+        startup, eagerImports = runStartup(repeat)
+        results.update(startup)
+    return {
+        'python': platform.python_version(),
+        'implementation': platform.python_implementation(),
+        'engine': {'fuse': engine.fuse, 'jitThreshold': engine.jitThreshold},
+        'compiled': evm.compiledModules(),
+        'results': results,
+        'eagerImports': eagerImports,
+    }
+
+# Runs `tiers` in a new process, on the Python sources of the core when
+# pure is set, and returns its report
+def runBuild(tiers, engineArgs, pure):
+    env = dict(os.environ)
+    env.pop('EVM_PURE_PYTHON', None)
+    if pure:
+        env['EVM_PURE_PYTHON'] = '1'
+    with tempfile.TemporaryDirectory() as directory:
+        outPath = os.path.join(directory, 'report.json')
+        subprocess.run([sys.executable, os.path.abspath(__file__), *tiers, *engineArgs, f'out={outPath}'],
+                       env=env, check=True, capture_output=True)
+        with open(outPath) as f:
+            return json.load(f)
+
+def compareBuilds(tiers, engineArgs):
+    if not evm.compiledModules():
+        print('core.py is not compiled, build it with `mypyc core.py word.py` in python/')
+        return 1
+    pure = runBuild(tiers, engineArgs, True)
+    compiled = runBuild(tiers, engineArgs, False)
+    print(f'{"":24} {"python":>12} {"compiled (" + ", ".join(compiled["compiled"]) + ")":>24} {"speedup":>8}')
+    for name, entry in pure['results'].items():
+        seconds = compiled['results'][name]['seconds']
+        print(f'{name:24} {entry["seconds"] * 1e3:9.3f} ms {seconds * 1e3:21.3f} ms {entry["seconds"] / seconds:7.2f}x')
+    return 0
+
+def main(args):
+    tiers = []
+    engine = evm.EVM()
+    outPath = None
+    baselinePath = None
+    tolerance = 0.1
+    builds = False
+    # passed on to the processes of `builds`
+    engineArgs = []
+    for arg in args:
+        if arg in ('micro', 'macro', 'startup'):
+            tiers.append(arg)
+        elif arg == 'builds':
+            builds = True
+        elif arg == 'fuse':
+            engine.fuse = True
+            engineArgs.append(arg)
+        elif arg.startswith('jit='):
+            value = arg.split('=')[1]
+            engine.jitThreshold = None if value == 'off' else int(value)
+            engineArgs.append(arg)
+        elif arg.startswith('out='):
+            outPath = arg.split('=', 1)[1]
+        elif arg.startswith('baseline='):
+            baselinePath = arg.split('=', 1)[1]
+        elif arg.startswith('tolerance='):
+            tolerance = float(arg.split('=')[1])
+        else:
+            raise SystemExit(f'unknown argument {arg}')
+    if builds:
+        return compareBuilds(tiers or ('micro', 'macro'), engineArgs)
+    report = run(tiers or ('micro', 'macro', 'startup'), engine)
+    for name, entry in report['results'].items():
+        rate = entry.get('instructionsPerSecond')
+        print(f'{name:24} {entry["seconds"] * 1e3:10.3f} ms' + (f'  {rate:12.0f} instr/s' if rate else ''))
+    if outPath is not None:
+        with open(outPath, 'w') as f:
+            json.dump(report, f, indent=2)
+    status = 0
+    for name in report['eagerImports']:
+        print(f'REGRESSION startup imports {name}, it should only be imported when first needed')
+        status = 1
+    if baselinePath is not None:
+        with open(baselinePath) as f:
+            baseline = json.load(f)
+        regressions = compare(report['results'], baseline, tolerance)
+        for name, before, seconds in regressions:
+            print(f'REGRESSION {name}: {before * 1e3:.3f} ms -> {seconds * 1e3:.3f} ms ({seconds / before - 1:+.0%})')
+        if regressions:
+            return 1
+        print(f'no regressions against {baselinePath}')
+    return status
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,203 @@
+#!/usr/bin/env python3
+
+# Conformance runner for EVM From Scratch
+#
+# Runs every test of an evm.json style file, sharded over a pool of worker
+# processes with batch.executeBatch, and reports all failures instead of
+# stopping at the first one as test() does.
+#
+#   python3 conformance.py [file] [workers=N] [name=PATTERN] [opcode=NAME]
+#                          [shard=I/N] [fuse] [jit=N] [nocache]
+#
+# name= selects tests by name (shell style, case insensitive, e.g. 'PUSH*')
+# and opcode= the tests whose code contains the opcode, by name or as a hex
+# byte for opcodes the engine does not implement (opcode=0xf0), both can be
+# given several times. shard=I/N runs the I-th of N disjoint parts of the tests,
+# e.g. one per CI job, assigned by fixture digest so they stay stable when
+# tests are added or reordered.
+#
+# Results are cached in <file>.results: a test which passed is skipped while
+# its fixture digest and the engine hash stay the same. The engine hash
+# covers the source of evm.py, core.py, jit.py and word.py (or the mypyc
+# build of core.py and word.py), the engine settings and the opcode table,
+# so any change of the engine runs everything again.
+# Failures are never cached. nocache runs every test and leaves the cache
+# unchanged.
+#
+# The exit status is 1 when a test failed.
+
+import fnmatch
+import hashlib
+import json
+import os
+import sys
+import time
+
+import batch
+import evm
+import fixtures
+
+# a compiled core is hashed as the built extension
+ENGINE_MODULES = (evm, evm.core, evm.jit, evm.word)
+
+def engineHash(engine):
+    digest = hashlib.sha256()
+    for module in ENGINE_MODULES:
+        with open(module.__file__, 'rb') as f:
+            digest.update(f.read())
+    digest.update(repr((engine.fuse, engine.jitThreshold)).encode())
+    digest.update(repr(sorted((op, opcodeDataObj.name) for op, opcodeDataObj in engine.opcodes.items())).encode())
+    return digest.hexdigest()
+
+def opcodesOf(code):
+    # the opcodes in `code`, without bytes which are PUSH data
+    result = set()
+    pc = 0
+    while pc < len(code):
+        op = code[pc]
+        result.add(op)
+        if op >= 0x60 and op <= 0x7f:
+            pc += op - 0x60 + 1
+        pc += 1
+    return result
+
+def parseOpcode(value, opcodes):
+    if value.lower().startswith('0x'):
+        return int(value, 16)
+    for op, opcodeDataObj in opcodes.items():
+        if opcodeDataObj.name == value.upper():
+            return op
+    raise ValueError(f'unknown opcode {value}')
+
+# The fixtures selected by the name patterns, opcodes and shard (index,
+# count), an empty list of patterns or opcodes selects everything
+def select(tests, names=(), opcodeFilter=(), shard=None):
+    names = [name.lower() for name in names]
+    opcodeFilter = set(opcodeFilter)
+    for fixture in tests:
+        if shard is not None and int(fixture.digest, 16) % shard[1] != shard[0]:
+            continue
+        if names and not any(fnmatch.fnmatchcase(fixture.name.lower(), name) for name in names):
+            continue
+        if opcodeFilter and not opcodeFilter & opcodesOf(fixture.code):
+            continue
+        yield fixture
+
+def readResults(path, engineDigest):
+    # Digests of the fixtures which passed on this engine
+    try:
+        with open(path) as f:
+            results = json.load(f)
+    except (OSError, ValueError):
+        return set()
+    if results.get('engine') != engineDigest:
+        return set()
+    return set(results.get('passed', ()))
+
+def writeResults(path, engineDigest, passed, failed):
+    # merged with what another shard may have written meanwhile
+    passed = (readResults(path, engineDigest) | passed) - failed
+    tempPath = f'{path}.{os.getpid()}.tmp'
+    with open(tempPath, 'w') as f:
+        json.dump({'engine': engineDigest, 'passed': sorted(passed)}, f)
+    os.replace(tempPath, path)
+
+class Report:
+    def __init__(self):
+        self.passed = 0
+        self.cached = 0
+        self.selected = 0
+        self.total = 0
+        # [(fixture, (what did not match, expected, actual))] in file order
+        self.failures = []
+        self.seconds = 0.0
+
+# opcodeFilter holds opcode bytes, see parseOpcode
+def run(path, engine=None, workers=None, names=(), opcodeFilter=(), shard=None, cache=True):
+    if engine is None:
+        engine = evm.defaultEngine
+    start = time.perf_counter()
+    report = Report()
+    tests = list(fixtures.load(path))
+    report.total = len(tests)
+    selected = list(select(tests, names, opcodeFilter, shard))
+    report.selected = len(selected)
+
+    resultsPath = path + '.results'
+    engineDigest = engineHash(engine)
+    passedBefore = readResults(resultsPath, engineDigest) if cache else set()
+    pending = [fixture for fixture in selected if fixture.digest not in passedBefore]
+    report.cached = len(selected) - len(pending)
+
+    jobs = [batch.Job(fixture.code, fixture.tx, fixture.block, fixture.state, fixture.stackFormat)
+            for fixture in pending]
+    passed = set()
+    failed = set()
+    failures = []
+    for index, result in batch.executeBatch(jobs, workers, ordered=False, engine=engine):
+        fixture = pending[index]
+        mismatch = fixtures.compare(fixture, result)
+        if mismatch is None:
+            passed.add(fixture.digest)
+        else:
+            failed.add(fixture.digest)
+            failures.append((index, mismatch))
+    # results arrive as their chunk is done, failures are listed in file order
+    report.failures = [(pending[index], mismatch) for index, mismatch in sorted(failures, key=lambda failure: failure[0])]
+    report.passed = len(passed) + report.cached
+
+    if cache:
+        writeResults(resultsPath, engineDigest, passed, failed)
+    report.seconds = time.perf_counter() - start
+    return report
+
+def main(args):
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'evm.json')
+    engine = evm.EVM()
+    workers = None
+    names = []
+    opcodeFilter = []
+    shard = None
+    cache = True
+    for arg in args:
+        if arg == 'fuse':
+            engine.fuse = True
+        elif arg.startswith('jit='):
+            value = arg.split('=')[1]
+            engine.jitThreshold = None if value == 'off' else int(value)
+        elif arg.startswith('workers='):
+            workers = int(arg.split('=')[1])
+        elif arg.startswith('name='):
+            names.append(arg.split('=', 1)[1])
+        elif arg.startswith('opcode='):
+            try:
+                opcodeFilter.append(parseOpcode(arg.split('=', 1)[1], engine.opcodes))
+            except ValueError as error:
+                raise SystemExit(str(error))
+        elif arg.startswith('shard='):
+            index, count = arg.split('=')[1].split('/')
+            shard = (int(index), int(count))
+            if not 0 <= shard[0] < shard[1]:
+                raise SystemExit(f'shard index out of range: {arg}')
+        elif arg == 'nocache':
+            cache = False
+        elif '=' not in arg:
+            path = arg
+        else:
+            raise SystemExit(f'unknown argument {arg}')
+
+    report = run(path, engine, workers, names, opcodeFilter, shard, cache)
+    for fixture, (what, expected, actual) in report.failures:
+        print(f"❌ {fixture.name}")
+        print(f"   {what} doesn't match")
+        print("   expected:", expected)
+        print("     actual:", actual)
+        if fixture.hint:
+            print("   hint:", fixture.hint)
+        print("")
+    print(f'{report.passed} passed ({report.cached} cached), {len(report.failures)} failed, '
+          f'{report.total - report.selected} not selected, in {report.seconds:.2f}s')
+    return 1 if report.failures else 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,594 @@
+# Interpreter core of EVM From Scratch
+#
+# The hot part of the interpreter: Stack, Memory, Storage, Context, gas
+# metering, the arithmetic, comparison, bitwise and stack handlers and the
+# run loops without hooks. evm.py imports everything from here and builds
+# the rest (state, calls, opcode table, engine) around it.
+#
+# The module is fully type-annotated so it can be compiled with mypyc,
+# together with word.py which its handlers call:
+#
+#   cd python && mypyc core.py word.py
+#
+# builds C extensions next to the sources, which Python imports instead of
+# the .py files from then on. Without them, or with EVM_PURE_PYTHON set in
+# the environment, the Python sources run as before. Compiled classes do not
+# take attributes which are not declared here.
+#
+# Types follow what the interpreter passes around: words are ints in
+# [0, 2**256), code and calldata bytes. The world state, the execution's
+# InputParam and programs come from evm.py and are typed Any here.
+
+import time
+from typing import Any, Callable, Final, Optional, Union
+
+import word
+
+UINT256MAX: Final = (2 ** 256) - 1
+MAXSTACKSIZE: Final = 1024
+
+# Dynamic gas costs of accesses, the others are in evm.py
+WARM_ACCESS: Final = 100
+COLD_ACCOUNT_ACCESS: Final = 2600
+COLD_SLOAD: Final = 2100
+
+class Stack:
+    # Stack height is checked once per basic block against the limits from
+    # CodeAnalysis and handlers only push values up to UINT256MAX, so push and
+    # pop are the unchecked list operations
+    def __init__(self, size: int = MAXSTACKSIZE) -> None:
+        self.list: list[int] = []
+        self.maxSize = size
+        self.push: Callable[[int], None] = self.list.append
+        self.pop: Callable[[], int] = self.list.pop
+
+    def len(self) -> int:
+        return len(self.list)
+
+    def elements(self) -> list[int]:
+        return self.list
+
+    def peek(self, index: int) -> int:
+        return self.list[index]
+
+    def replace(self, index: int, value: int) -> None:
+        self.list[index] = value
+
+class OutOfGas(Exception):
+    # Raised by GasMeter.charge, the run loops turn it into OPCODE_OUT_OF_GAS
+    pass
+
+class BudgetExceeded(Exception):
+    # Raised by runProgramBudgeted, ends the whole execution
+    pass
+
+class Budget:
+    # Limits on the work of an execution, whatever its gas: instructions run
+    # and wall time in seconds from the start of the first execution. One
+    # budget can be passed to several executions which then share it
+    def __init__(self, instructions: Optional[int] = None, seconds: Optional[float] = None) -> None:
+        self.instructions = instructions
+        self.seconds = seconds
+        self.deadline: Optional[float] = None
+
+    def start(self) -> None:
+        if self.seconds is not None and self.deadline is None:
+            self.deadline = time.perf_counter() + self.seconds
+
+class GasMeter:
+    # Gas left in the current execution. Without a gas limit in the tx the
+    # run is unmetered: static block costs are not charged and GAS pushes
+    # UINT256MAX
+    def __init__(self, limit: Optional[int] = None, parent: Optional['GasMeter'] = None) -> None:
+        self.metered = limit is not None
+        self.limit: int = limit if limit is not None else UINT256MAX
+        self.left = self.limit
+        # EIP-2929 access lists, the first access of an address or storage
+        # slot costs more. Nested calls share the lists of their parent, they
+        # are not rolled back when a call reverts
+        if parent is not None:
+            self.warmAddresses: set[int] = parent.warmAddresses
+            self.warmSlots: set[tuple[int, int]] = parent.warmSlots
+        else:
+            self.warmAddresses = set()
+            self.warmSlots = set()
+
+    def charge(self, amount: int) -> None:
+        self.left -= amount
+        if self.left < 0:
+            raise OutOfGas()
+
+    # Extra cost of touching an address, warms it for the rest of the run
+    def accessAddress(self, address: int) -> int:
+        if address in self.warmAddresses:
+            return 0
+        self.warmAddresses.add(address)
+        return COLD_ACCOUNT_ACCESS - WARM_ACCESS
+
+    def accessSlot(self, key: tuple[int, int]) -> int:
+        if key in self.warmSlots:
+            return 0
+        self.warmSlots.add(key)
+        return COLD_SLOAD - WARM_ACCESS
+
+    def used(self) -> int:
+        return self.limit - self.left
+
+# Largest memory of an execution. 64 MiB cost about 8.6 billion gas, far
+# more than a block can hold, so metered runs never get here with a real gas
+# limit. Unmetered runs are not limited by gas, they fail here instead of
+# allocating absurd amounts
+MEMORY_LIMIT: Final = 1 << 26
+
+def memoryGas(size: int) -> int:
+    # total cost of `size` bytes of memory, size is a multiple of 32
+    words = size // 32
+    return 3 * words + (words * words) // 512
+
+class Memory:
+    # array can be larger than the EVM memory, only its first `size` bytes
+    # are in use. Bytes past size are always zero
+    def __init__(self, gas: Optional[GasMeter] = None) -> None:
+        self.array = bytearray()
+        self.size = 0
+        # expansion is paid for from this meter
+        self.gas = gas if gas is not None else GasMeter()
+
+    #Internal function
+    def _expand(self, offset: int, dataSize: int) -> None:
+        # zero sized accesses never expand memory
+        if dataSize and offset+dataSize > self.size:
+            newSize = ((((offset+dataSize)-1) // 32) * 32) + 32
+            if newSize > MEMORY_LIMIT:
+                raise OutOfGas()
+            # charged before growing, so metered runs fail with out of gas
+            # instead of allocating what they can not pay for
+            self.gas.charge(memoryGas(newSize) - memoryGas(self.size))
+            if newSize > len(self.array):
+                # at least double the capacity, so growing word by word
+                # does not copy the whole array every time
+                capacity = max(newSize, 2 * len(self.array))
+                self.array.extend(bytes(capacity - len(self.array)))
+            self.size = newSize
+
+    # Store can be 1 or 32 or "x" bytes dataSize
+    def store(self, offset: int, data: int, dataSize: int) -> None:
+        self._expand(offset, dataSize)
+        self.array[offset:offset+dataSize] = data.to_bytes(dataSize, 'big')
+
+    def load(self, offset: int, dataSize: int = 32) -> int:
+        self._expand(offset, dataSize)
+        return int.from_bytes(self.array[offset:offset+dataSize], "big")
+
+    # Copies bytes-like data to memory. With dataSize the rest of the
+    # dataSize bytes after data are zeroed, for copies reading past the end
+    # of their source
+    def write(self, offset: int, data: Union[bytes, bytearray, memoryview], dataSize: Optional[int] = None) -> None:
+        if dataSize is None:
+            dataSize = len(data)
+        self._expand(offset, dataSize)
+        if not dataSize:
+            return
+        length = len(data)
+        self.array[offset:offset+length] = data
+        if length < dataSize:
+            self.array[offset+length:offset+dataSize] = bytes(dataSize - length)
+
+    # View of dataSize bytes of memory, nothing is copied. The memory can not
+    # grow while the view is alive, keep bytes(view) when the data has to
+    # outlive the next instruction
+    def read(self, offset: int, dataSize: int) -> memoryview:
+        self._expand(offset, dataSize)
+        if not dataSize:
+            return memoryview(b'')
+        return memoryview(self.array)[offset:offset+dataSize]
+
+# Journal value of entries which did not exist before the write
+MISSING: Final = object()
+
+class Storage:
+    # Storage of one account in `world`, a WorldState of evm.py. Writes go
+    # through the journal of the world state so they can be reverted. dict
+    # holds the slots written in this world state, base the ones of the
+    # BaseState below it
+    def __init__(self, world: Any, address: int = 0) -> None:
+        self.world = world
+        self.address = address
+        self.dict: dict[int, int] = world.storageOf(address)
+        self.base: Any = world.base.storageOf(address)
+
+    def store(self, key: int, value: int) -> None:
+        self.world.journal.append((self.dict, key, self.dict.get(key, MISSING)))
+        self.dict[key] = value
+
+    def load(self, key: int) -> int:
+        if key in self.dict:
+            return self.dict[key]
+        else:
+            value: int = self.base.get(key, 0)
+            return value
+
+class Context:
+    # storage is None only for contexts built outside of a CallStack, which
+    # can not run SLOAD and SSTORE
+    def __init__(self, code: bytes, pc: int = 0, calldata: bytes = b"", jumpDest: frozenset[int] = frozenset(),
+                 storage: Optional[Storage] = None, gas: Optional[GasMeter] = None, depth: int = 1,
+                 address: int = 0, caller: int = 0, value: int = 0, static: bool = False) -> None:
+        self.gas = gas if gas is not None else GasMeter()
+        # call depth, 1 for the outermost call
+        self.depth = depth
+        self.stack = Stack(MAXSTACKSIZE)
+        self.memory = Memory(self.gas)
+        self.code = code
+        self.pc = pc
+        self.jumpDest = jumpDest
+        self.storage = storage
+        self.calldata = calldata
+        # account running the code, its caller and the value sent with the
+        # call. DELEGATECALL keeps all three from the calling frame
+        self.address = address
+        self.caller = caller
+        self.value = value
+        # STATICCALL frames and everything they call can not change state
+        self.static = static
+        # output of the last call made from this frame, bytes or a view
+        self.returnData: Any = b''
+
+class OpcodeResponse:
+    def __init__(self, success: bool, stopRun: bool, data: Optional[dict[str, Any]]) -> None:
+        self.success = success
+        # stop will be True for stop opcode
+        self.stopRun = stopRun
+        self.data = data
+
+# Shared responses for the common cases, handlers return these instead of
+# allocating a new OpcodeResponse for every instruction
+OPCODE_CONTINUE: Final = OpcodeResponse(success=True, stopRun=False, data=None)
+OPCODE_STOP: Final = OpcodeResponse(success=True, stopRun=True, data=None)
+OPCODE_FAIL: Final = OpcodeResponse(success=False, stopRun=True, data=None)
+# Execution ran out of gas, all of it is consumed
+OPCODE_OUT_OF_GAS: Final = OpcodeResponse(success=False, stopRun=True, data=None)
+# Returned for bytes which have no entry in the opcode table
+OPCODE_NOT_FOUND: Final = OpcodeResponse(success=True, stopRun=True, data=None)
+
+# Handlers take the context and the InputParam of the execution
+Handler = Callable[[Context, Any], OpcodeResponse]
+
+def opcodeStop(ctx: Context, inputParam: Any) -> OpcodeResponse:
+    return OPCODE_STOP
+
+# PUSH with its immediate already decoded, used by Program
+def makePush(data: int) -> Handler:
+    def opcodePushN(ctx: Context, inputParam: Any) -> OpcodeResponse:
+        ctx.stack.push(data)
+        return OPCODE_CONTINUE
+    return opcodePushN
+
+def opcodePop(ctx: Context, inputParam: Any) -> OpcodeResponse:
+    ctx.stack.pop()
+    return OPCODE_CONTINUE
+
+def opcodeAdd(ctx: Context, inputParam: Any) -> OpcodeResponse:
+    a = ctx.stack.pop()
+    b = ctx.stack.pop()
+    result = (a+b)
+    # overflow condition
+    result &= UINT256MAX
+    ctx.stack.push(result)
+    return OPCODE_CONTINUE
+
+def opcodeMul(ctx: Context, inputParam: Any) -> OpcodeResponse:
+    a = ctx.stack.pop()
+    b = ctx.stack.pop()
+    result = (a*b)
+    # overflow condition
+    result &= UINT256MAX
+    ctx.stack.push(result)
+    return OPCODE_CONTINUE
+
+def opcodeSub(ctx: Context, inputParam: Any) -> OpcodeResponse:
+    a = ctx.stack.pop()
+    b = ctx.stack.pop()
+    result = (a-b)
+    # overflow condition
+    # 2's signed complement, equivalent to
+    # i=-1 ; i.to_bytes(32, "big", signed=True)
+    # b'\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff'
+    result &= UINT256MAX
+    ctx.stack.push(result)
+    return OPCODE_CONTINUE
+
+def opcodeDiv(ctx: Context, inputParam: Any) -> OpcodeResponse:
+    a = ctx.stack.pop()
+    b = ctx.stack.pop()
+    ctx.stack.push(word.div(a, b))
+    return OPCODE_CONTINUE
+
+def opcodeMod(ctx: Context, inputParam: Any) -> OpcodeResponse:
+    a = ctx.stack.pop()
+    b = ctx.stack.pop()
+    ctx.stack.push(word.mod(a, b))
+    return OPCODE_CONTINUE
+
+def opcodeAddMod(ctx: Context, inputParam: Any) -> OpcodeResponse:
+    a = ctx.stack.pop()
+    b = ctx.stack.pop()
+    c = ctx.stack.pop()
+    ctx.stack.push(word.addMod(a, b, c))
+    return OPCODE_CONTINUE
+
+def opcodeMulMod(ctx: Context, inputParam: Any) -> OpcodeResponse:
+    a = ctx.stack.pop()
+    b = ctx.stack.pop()
+    c = ctx.stack.pop()
+    ctx.stack.push(word.mulMod(a, b, c))
+    return OPCODE_CONTINUE
+
+def opcodeExp(ctx: Context, inputParam: Any) -> OpcodeResponse:
+    a = ctx.stack.pop()
+    b = ctx.stack.pop()
+    # 50 per byte of the exponent
+    ctx.gas.charge(50 * ((b.bit_length() + 7) // 8))
+    ctx.stack.push(word.exp(a, b))
+    return OPCODE_CONTINUE
+
+def opcodeSignExt(ctx: Context, inputParam: Any) -> OpcodeResponse:
+    a = ctx.stack.pop()
+    b = ctx.stack.pop()
+    ctx.stack.push(word.signExtend(a, b))
+    return OPCODE_CONTINUE
+
+def opcodeSdiv(ctx: Context, inputParam: Any) -> OpcodeResponse:
+    a = ctx.stack.pop()
+    b = ctx.stack.pop()
+    ctx.stack.push(word.sdiv(a, b))
+    return OPCODE_CONTINUE
+
+def opcodeSmod(ctx: Context, inputParam: Any) -> OpcodeResponse:
+    a = ctx.stack.pop()
+    b = ctx.stack.pop()
+    ctx.stack.push(word.smod(a, b))
+    return OPCODE_CONTINUE
+
+def opcodeLT(ctx: Context, inputParam: Any) -> OpcodeResponse:
+    a = ctx.stack.pop()
+    b = ctx.stack.pop()
+    if a < b:
+        result = 1
+    else:
+        result = 0
+    ctx.stack.push(result)
+    return OPCODE_CONTINUE
+
+def opcodeGT(ctx: Context, inputParam: Any) -> OpcodeResponse:
+    a = ctx.stack.pop()
+    b = ctx.stack.pop()
+    if a > b:
+        result = 1
+    else:
+        result = 0
+    ctx.stack.push(result)
+    return OPCODE_CONTINUE
+
+def opcodeSLT(ctx: Context, inputParam: Any) -> OpcodeResponse:
+    a = word.toSigned(ctx.stack.pop())
+    b = word.toSigned(ctx.stack.pop())
+    if a < b:
+        result = 1
+    else:
+        result = 0
+    ctx.stack.push(result)
+    return OPCODE_CONTINUE
+
+def opcodeSGT(ctx: Context, inputParam: Any) -> OpcodeResponse:
+    a = word.toSigned(ctx.stack.pop())
+    b = word.toSigned(ctx.stack.pop())
+    if a > b:
+        result = 1
+    else:
+        result = 0
+    ctx.stack.push(result)
+    return OPCODE_CONTINUE
+
+def opcodeEQ(ctx: Context, inputParam: Any) -> OpcodeResponse:
+    a = ctx.stack.pop()
+    b = ctx.stack.pop()
+    if a == b:
+        result = 1
+    else:
+        result = 0
+    ctx.stack.push(result)
+    return OPCODE_CONTINUE
+
+def opcodeIsZero(ctx: Context, inputParam: Any) -> OpcodeResponse:
+    a = ctx.stack.pop()
+    result = 0
+    if a == 0:
+        result = 1
+    ctx.stack.push(result)
+    return OPCODE_CONTINUE
+
+def opcodeNot(ctx: Context, inputParam: Any) -> OpcodeResponse:
+    a = ctx.stack.pop()
+    a ^= UINT256MAX
+    ctx.stack.push(a)
+    return OPCODE_CONTINUE
+
+def opcodeAnd(ctx: Context, inputParam: Any) -> OpcodeResponse:
+    a = ctx.stack.pop()
+    b = ctx.stack.pop()
+    result = a & b
+    ctx.stack.push(result)
+    return OPCODE_CONTINUE
+
+def opcodeOr(ctx: Context, inputParam: Any) -> OpcodeResponse:
+    a = ctx.stack.pop()
+    b = ctx.stack.pop()
+    result = a | b
+    ctx.stack.push(result)
+    return OPCODE_CONTINUE
+
+def opcodeXor(ctx: Context, inputParam: Any) -> OpcodeResponse:
+    a = ctx.stack.pop()
+    b = ctx.stack.pop()
+    result = a ^ b
+    ctx.stack.push(result)
+    return OPCODE_CONTINUE
+
+def opcodeSHL(ctx: Context, inputParam: Any) -> OpcodeResponse:
+    a = ctx.stack.pop()
+    b = ctx.stack.pop()
+    if a > 255:
+        result = 0
+    else:
+        result = b << a
+        result &= UINT256MAX
+    ctx.stack.push(result)
+    return OPCODE_CONTINUE
+
+def opcodeSHR(ctx: Context, inputParam: Any) -> OpcodeResponse:
+    a = ctx.stack.pop()
+    b = ctx.stack.pop()
+    if a > 255:
+        result = 0
+    else:
+        result = b >> a
+    ctx.stack.push(result)
+    return OPCODE_CONTINUE
+
+def opcodeSAR(ctx: Context, inputParam: Any) -> OpcodeResponse:
+    a = ctx.stack.pop()
+    b = ctx.stack.pop()
+    ctx.stack.push(word.sar(a, b))
+    return OPCODE_CONTINUE
+
+def opcodeByte(ctx: Context, inputParam: Any) -> OpcodeResponse:
+    a = ctx.stack.pop()
+    b = ctx.stack.pop()
+
+    if a > 31:
+        result = 0
+    else:
+        offset = (31 - a) * 8
+        result = (b & (0xff << offset)) >> offset
+    ctx.stack.push(result)
+    return OPCODE_CONTINUE
+
+# DUP1..DUP16 and SWAP1..SWAP16 get one handler each with the index bound,
+# so they do not need to look at the opcode while running
+def makeDup(index: int) -> Handler:
+    def opcodeDup(ctx: Context, inputParam: Any) -> OpcodeResponse:
+        stack = ctx.stack.list
+        stack.append(stack[-index])
+        return OPCODE_CONTINUE
+    return opcodeDup
+
+def makeSwap(index: int) -> Handler:
+    def opcodeSwap(ctx: Context, inputParam: Any) -> OpcodeResponse:
+        stack = ctx.stack.list
+        stack[-1], stack[-(index+1)] = stack[-(index+1)], stack[-1]
+        return OPCODE_CONTINUE
+    return opcodeSwap
+
+def outOfGas(ctx: Context) -> OpcodeResponse:
+    ctx.gas.left = 0
+    return OPCODE_OUT_OF_GAS
+
+# Entry of a block table, see blockTable in evm.py:
+# (end, stackMin, stackLimit, gas, handlers)
+Block = tuple[int, int, int, int, list[Handler]]
+
+# Dynamic costs can run out of gas in any run loop, memory expansion past
+# MEMORY_LIMIT fails even unmetered runs
+def runProgram(ctx: Context, inputParam: Any, program: Any) -> tuple[int, OpcodeResponse]:
+    blocks: list[Block] = program.blocks
+    codeLen = len(blocks)
+    stack = ctx.stack.list
+    response = OPCODE_STOP
+    pc = ctx.pc
+    try:
+        while pc < codeLen:
+            end, stackMin, stackLimit, gas, runs = blocks[pc]
+            # One stack check for the whole block, the handlers do not check
+            height = len(stack)
+            if height < stackMin or height > stackLimit:
+                return (pc, OPCODE_FAIL)
+            # pc points to the end of the block while running it, jump handlers
+            # overwrite it
+            ctx.pc = end
+            for run in runs:
+                response = run(ctx, inputParam)
+                if response is not OPCODE_CONTINUE and response.stopRun:
+                    return (pc, response)
+            pc = ctx.pc
+    except OutOfGas:
+        return (pc, outOfGas(ctx))
+    return (pc, response)
+
+# runProgram charging the static gas of every block on entry, used when the
+# tx has a gas limit
+def runProgramMetered(ctx: Context, inputParam: Any, program: Any) -> tuple[int, OpcodeResponse]:
+    blocks: list[Block] = program.blocks
+    codeLen = len(blocks)
+    stack = ctx.stack.list
+    meter = ctx.gas
+    response = OPCODE_STOP
+    pc = ctx.pc
+    try:
+        while pc < codeLen:
+            end, stackMin, stackLimit, gas, runs = blocks[pc]
+            height = len(stack)
+            if height < stackMin or height > stackLimit:
+                return (pc, OPCODE_FAIL)
+            meter.left -= gas
+            if meter.left < 0:
+                return (pc, outOfGas(ctx))
+            ctx.pc = end
+            for run in runs:
+                response = run(ctx, inputParam)
+                if response is not OPCODE_CONTINUE and response.stopRun:
+                    return (pc, response)
+            pc = ctx.pc
+    except OutOfGas:
+        return (pc, outOfGas(ctx))
+    return (pc, response)
+
+# Run loop used when an execution has a Budget. The budget is checked when
+# a block is entered, blocks are counted with their instructions in the
+# unfused program (`sizes`, the block table of analysis.program) so fused
+# and compiled programs use up the same budget
+def runProgramBudgeted(ctx: Context, inputParam: Any, program: Any, sizes: list[Block],
+                       budget: Budget) -> tuple[int, OpcodeResponse]:
+    blocks: list[Block] = program.blocks
+    codeLen = len(blocks)
+    stack = ctx.stack.list
+    meter = ctx.gas
+    metered = meter.metered
+    deadline = budget.deadline
+    response = OPCODE_STOP
+    pc = ctx.pc
+    try:
+        while pc < codeLen:
+            end, stackMin, stackLimit, gas, runs = blocks[pc]
+            if budget.instructions is not None:
+                budget.instructions -= len(sizes[pc][4])
+                if budget.instructions < 0:
+                    raise BudgetExceeded('instruction budget exceeded')
+            if deadline is not None and time.perf_counter() > deadline:
+                raise BudgetExceeded('time budget exceeded')
+            height = len(stack)
+            if height < stackMin or height > stackLimit:
+                return (pc, OPCODE_FAIL)
+            if metered:
+                meter.left -= gas
+                if meter.left < 0:
+                    return (pc, outOfGas(ctx))
+            ctx.pc = end
+            for run in runs:
+                response = run(ctx, inputParam)
+                if response is not OPCODE_CONTINUE and response.stopRun:
+                    return (pc, response)
+            pc = ctx.pc
+    except OutOfGas:
+        return (pc, outOfGas(ctx))
+    return (pc, response)
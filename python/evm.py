@@ -11,134 +11,311 @@
 # - Run `python3 evm.py` to run the tests
 
 #Implementation inspired by https://github.com/karmacoma-eth/smol-evm
-import json
 import os
 import sys
-from dataclasses import dataclass
-from eth_utils import keccak
-from typing import Any
+import threading
+import time
+from collections import OrderedDict
+from types import MappingProxyType
 from enum import Enum
 
-# Constants
-UINT256MAX = (2 ** 256) -1
-
-inputs = len(sys.argv)
-# some random high number so that by default all test cases will run
-testsMax = 1000
-testsRun = 0
-# singleBin which contains code binary to run
-singleBin = None
-if inputs == 2:
-    arg2 = list(sys.argv)[1]
-    if "test" in arg2:
-        arg2List = arg2.split('=')
-        if arg2List[0] == 'test':
-            singleBin = arg2List[1]
-    else:
-        # control the test cases numbers here
-        testsMax = int(arg2)
-
-class Stack:
-    def __init__(self, size = 1024):
-        self.list = []
-        self.maxSize = size
-
-    # Push max 32 bytes
-    def push(self, item):
-        if item > UINT256MAX:
-            # TODO: handle error
-            print('STACK OVERFLOW')
-            return False
-        self.list.append(item)
-
-    def pop(self):
-        return self.list.pop()
-
-    def len(self):
-        return len(self.list)
-
-    def elements(self):
-        return self.list
-
-    def peek(self, index):
-        return self.list[index]
+# Loads a module from its Python source even when a compiled build of it
+# exists next to it
+def importSource(name):
+    import importlib.util
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), name + '.py')
+    spec = importlib.util.spec_from_file_location(name, path)
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    spec.loader.exec_module(module)
+    return module
+
+# core.py and word.py can be compiled with mypyc, Python then imports the
+# compiled modules. EVM_PURE_PYTHON=1 runs their sources anyway
+if os.environ.get('EVM_PURE_PYTHON'):
+    importSource('word')
+    importSource('core')
+
+import core
+import jit
+import word
+# the names of the core used here, other modules reach the rest as
+# evm.core.<name>, the build importSource picked
+from core import (UINT256MAX, MAXSTACKSIZE, WARM_ACCESS, COLD_SLOAD,
+                  OutOfGas, GasMeter, memoryGas, MISSING, Storage, Context,
+                  OpcodeResponse, OPCODE_CONTINUE, OPCODE_STOP, OPCODE_FAIL, OPCODE_NOT_FOUND,
+                  opcodeStop, makePush, opcodePop, opcodeAdd, opcodeMul, opcodeSub, opcodeDiv, opcodeMod,
+                  opcodeAddMod, opcodeMulMod, opcodeExp, opcodeSignExt, opcodeSdiv, opcodeSmod, opcodeLT, opcodeGT,
+                  opcodeSLT, opcodeSGT, opcodeEQ, opcodeIsZero, opcodeNot, opcodeAnd, opcodeOr, opcodeXor,
+                  opcodeSHL, opcodeSHR, opcodeSAR, opcodeByte, makeDup, makeSwap,
+                  outOfGas, runProgram, runProgramMetered, runProgramBudgeted)
+from statedb import DiskState
+
+# Names of the modules of the interpreter core which run compiled by mypyc
+def compiledModules():
+    return [module.__name__ for module in (core, word) if not module.__file__.endswith('.py')]
 
-    def replace(self, index, value):
-        self.list[index] = value
+if __name__ == '__main__':
+    # Run main of the module as it is imported by everything else, so classes
+    # pickled by the fixture cache and batch.py are evm.* and not __main__.*.
+    # Done before the definitions below, so they are only executed once
+    import evm
+    evm.main(sys.argv[1:])
+    sys.exit()
+
+# keccak256 of bytes. The backend is imported on the first call, importing
+# eth_utils takes longer than importing and running the EVM, and only SHA3,
+# EXTCODEHASH and callers hashing code need it
+keccakBackend = None
+
+def keccak(data):
+    global keccakBackend
+    if keccakBackend is None:
+        # eth_hash is the hasher behind eth_utils.keccak, without the rest
+        # of eth_utils
+        from eth_hash.auto import keccak as keccakBackend
+    return keccakBackend(data)
+
+# Dynamic gas costs, static ones are in the opcode table and the ones of
+# accesses in core.py
+SSTORE_SET = 20000
+SSTORE_RESET = 2900
+# SSTORE fails when no more than this is left (EIP-2200)
+SSTORE_STIPEND = 2300
+CALL_VALUE = 9000
+CALL_NEW_ACCOUNT = 25000
+# given to the callee for free when a call transfers value
+CALL_STIPEND = 2300
+MAXCALLDEPTH = 1024
+# Every nested call runs a few Python frames deeper (handler, messageCall,
+# runner, run loop, compiled block), leave room for all 1024 levels
+sys.setrecursionlimit(max(sys.getrecursionlimit(), MAXCALLDEPTH * 8))
 
-class Memory:
-    def __init__(self):
-        self.array = bytearray();
-        self.size = 0
-
-    #Internal function
-    def _expand(self, offset, dataSize):
-        if offset+dataSize > self.size:
-            offset = ((((offset+dataSize)-1) // 32) * 32)
-            self.array[self.size:offset+32] = bytes(offset + 32 - self.size)
-            self.size = len(self.array)
-
-    # Store can be 1 or 32 or "x" bytes dataSize
-    def store(self, offset, data, dataSize):
-        self._expand(offset, dataSize)
-        data = data.to_bytes(dataSize, 'big')
-        self.array[offset:offset+dataSize] = data
-
-    def load(self, offset, dataSize=32):
-        self._expand(offset, dataSize)
-        data = self.array[offset:offset+dataSize]
-        data = int.from_bytes(data, "big")
-        return data
-
-@dataclass
 class Account:
-    balance:int
-    codeAsm:str
-    codeBin:str
-
-@dataclass
-class Logs:
-    address:str
-    data:str
-    topics:list[str]
-
-class Storage:
-    def __init__(self):
-        self.dict = {}
-
-    def store(self, key, value):
-        if key > UINT256MAX or value > UINT256MAX:
-            print('STACK OVERFLOW')
-        else:
-            self.dict[key] = value
+    __slots__ = ('balance', 'codeAsm', 'code', '_codeHash')
 
-    def load(self, key):
-        if key in self.dict:
-            return self.dict[key]
-        else:
-            return 0
+    # code as bytes, converted from hex once when the state is loaded.
+    # _codeHash is keccak of code, computed on first use by codeHash()
+    def __init__(self, balance=0, codeAsm=None, code=b'', _codeHash=None):
+        self.balance = balance
+        self.codeAsm = codeAsm
+        self.code = code
+        self._codeHash = _codeHash
+
+    def copy(self):
+        return Account(self.balance, self.codeAsm, self.code, self._codeHash)
+
+    # hasher is keccak or the digest of an engine's KeccakCache
+    def codeHash(self, hasher=keccak):
+        if self._codeHash is None:
+            self._codeHash = hasher(self.code)
+        return self._codeHash
+
+# Transaction and block fields parsed from the hex strings of the tests once
+# per evm() call, so the environment opcodes push ints. Missing fields read
+# as 0
+class TxEnv:
+    __slots__ = ('to', 'caller', 'origin', 'gasPrice', 'value', 'data', 'gas')
+
+    def __init__(self, tx=None):
+        tx = tx or {}
+        self.to = int(tx.get('to', '0'), 16)
+        self.caller = int(tx.get('from', '0'), 16)
+        self.origin = int(tx.get('origin', '0'), 16)
+        self.gasPrice = int(tx.get('gasprice', '0'), 16)
+        self.value = int(tx.get('value', '0'), 16)
+        self.data = bytes.fromhex(tx.get('data', ''))
+        # None when the tx has no gas limit, the run is unmetered then
+        self.gas = int(tx['gas'], 16) if 'gas' in tx else None
+
+class BlockEnv:
+    __slots__ = ('baseFee', 'coinbase', 'timestamp', 'number', 'difficulty', 'gasLimit', 'chainId')
+
+    def __init__(self, block=None):
+        block = block or {}
+        self.baseFee = int(block.get('basefee', '0'), 16)
+        self.coinbase = int(block.get('coinbase', '0'), 16)
+        self.timestamp = int(block.get('timestamp', '0'), 16)
+        self.number = int(block.get('number', '0'), 16)
+        self.difficulty = int(block.get('difficulty', '0'), 16)
+        self.gasLimit = int(block.get('gaslimit', '0'), 16)
+        self.chainId = int(block.get('chainid', '0'), 16)
 
+class Logs:
+    __slots__ = ('address', 'data', 'topics')
+
+    def __init__(self, address, data, topics):
+        self.address = address
+        self.data = data
+        self.topics = topics
+
+class BaseState:
+    # Accounts and storage which never change, shared by any number of
+    # WorldState overlays. Build it once with fromJson and pass it to evm()
+    # in place of the state mapping to run many transactions against it
+    def __init__(self, accounts=None, storages=None):
+        # read only views, overlays copy an account before changing it
+        self.accounts = MappingProxyType(dict(accounts or {}))
+        self.storages = MappingProxyType({address: MappingProxyType(dict(slots))
+                                          for address, slots in (storages or {}).items()})
+
+    # mapping proxies can not be pickled, send plain dicts to other processes
+    def __reduce__(self):
+        return (BaseState, (dict(self.accounts), {address: dict(slots) for address, slots in self.storages.items()}))
 
-class Context:
-    def __init__(self, code, pc=0, calldata = "", jumpDest=[], storage=None):
-        self.stack = Stack(1024)
-        self.memory = Memory()
-        self.code = code
-        self.pc = pc
-        self.jumpDest = jumpDest
-        self.storage = storage
-        self.calldata = calldata
+    @staticmethod
+    def fromJson(state):
+        # `state` mapping of the tests, hex addresses to balance and code
+        accounts = {}
+        storages = {}
+        for address, values in (state or {}).items():
+            account = Account()
+            if 'balance' in values:
+                account.balance = int(values['balance'], 16)
+            if 'code' in values:
+                account.codeAsm = values['code']['asm']
+                account.code = bytes.fromhex(values['code']['bin'])
+            accounts[int(address,16)] = account
+            if 'storage' in values:
+                storages[int(address,16)] = {int(k, 16): int(v, 16) for k, v in values['storage'].items()}
+        return BaseState(accounts, storages)
+
+    def storageOf(self, address):
+        return self.storages.get(address, EMPTY_STORAGE)
+
+    # Runs never change a BaseState, see DiskState for one which keeps them
+    def commit(self, world):
+        pass
+
+EMPTY_STORAGE = MappingProxyType({})
+
+class WorldState:
+    # Accounts, storage and logs of one evm() run, as a copy-on-write overlay
+    # over a BaseState: reads fall through to the base, writes only ever go
+    # to the overlay, so a run pays only for what it touches.
+    # Every write appends (container, key, old value) to the journal, so a
+    # checkpoint is the journal length and reverting to it undoes only the
+    # writes made after it. Account balances are journaled with the Account
+    # as container. Reading accounts works like a dict of accounts
+    def __init__(self, base=None):
+        self.base = base if base is not None else BaseState()
+        # accounts created or changed by this run, copies of base accounts
+        self.accounts = {}
+        self.storages = {}
+        self.logs = []
+        self.journal = []
+
+    def __contains__(self, address):
+        return address in self.accounts or address in self.base.accounts
+
+    def __getitem__(self, address):
+        account = self.get(address)
+        if account is None:
+            raise KeyError(address)
+        return account
+
+    def get(self, address, default=None):
+        account = self.accounts.get(address)
+        if account is None:
+            account = self.base.accounts.get(address, default)
+        return account
+
+    # Account which can be changed, base accounts are copied on first write
+    def writable(self, address):
+        account = self.accounts.get(address)
+        if account is None:
+            baseAccount = self.base.accounts.get(address)
+            if baseAccount is None:
+                return None
+            account = baseAccount.copy()
+            self.journal.append((self.accounts, address, MISSING))
+            self.accounts[address] = account
+        return account
+
+    def storageOf(self, address):
+        storage = self.storages.get(address)
+        if storage is None:
+            storage = self.storages[address] = {}
+        return storage
+
+    def storage(self, address):
+        return Storage(self, address)
+
+    # Hands the changes of a successful run to the base state
+    def commit(self):
+        self.base.commit(self)
+
+    def checkpoint(self):
+        return len(self.journal)
+
+    def revert(self, checkpoint):
+        journal = self.journal
+        while len(journal) > checkpoint:
+            container, key, old = journal.pop()
+            if isinstance(container, Account):
+                container.balance = old
+            elif old is MISSING:
+                del container[key]
+            else:
+                container[key] = old
+
+    def log(self, entry):
+        self.journal.append((self.logs, len(self.logs), MISSING))
+        self.logs.append(entry)
+
+    def createAccount(self, address):
+        account = Account()
+        self.journal.append((self.accounts, address, MISSING))
+        self.accounts[address] = account
+        return account
+
+    def setBalance(self, account, balance):
+        self.journal.append((account, None, account.balance))
+        account.balance = balance
+
+    # Moves value from sender to recipient, recipients which do not exist
+    # are created. False when the sender can not afford it
+    def transfer(self, sender, recipient, value):
+        if not value:
+            return True
+        senderAccount = self.get(sender)
+        if senderAccount is None or senderAccount.balance < value:
+            return False
+        senderAccount = self.writable(sender)
+        recipientAccount = self.writable(recipient)
+        if recipientAccount is None:
+            recipientAccount = self.createAccount(recipient)
+        self.setBalance(senderAccount, senderAccount.balance - value)
+        self.setBalance(recipientAccount, recipientAccount.balance + value)
+        return True
 
 class CallStack:
-    def __init__(self, code):
+    # Contexts of the running calls, the outermost first. All of them share
+    # one world state, runner is the run loop chosen by the engine for the
+    # whole execution: runner(ctx, inputParam, analysis) -> (pc, response)
+    def __init__(self, code, world=None, engine=None):
         self.stacks = []
         self.code = code
-        self.jumpDest = Utils.scanForJumpDest(code)
-
-    def call(self, calldata):
-        storage = Storage()
-        ctx = Context(self.code, calldata=calldata, jumpDest=self.jumpDest, storage=storage)
+        # analysis cache and hooks of nested calls
+        self.engine = engine if engine is not None else defaultEngine
+        # jump destinations and decoded program are shared by every call
+        # running the same code
+        self.analysis = self.engine.analysisCache.get(code)
+        self.jumpDest = self.analysis.jumpDest
+        self.program = self.analysis.program
+        self.world = world if world is not None else WorldState()
+        self.runner = None
+
+    # Outermost call, running self.code
+    def call(self, calldata, gas=None, address=0, caller=0, value=0):
+        return self.enter(self.analysis, calldata, gas, address, caller, value, address, False)
+
+    def enter(self, analysis, calldata, gas, address, caller, value, storageAddress, static):
+        ctx = Context(analysis.code, calldata=calldata, jumpDest=analysis.jumpDest,
+                      storage=self.world.storage(storageAddress), gas=gas, depth=len(self.stacks)+1,
+                      address=address, caller=caller, value=value, static=static)
         self.stacks.append(ctx)
+        return ctx
 
     def pop(self):
         return self.stacks.pop()
@@ -164,339 +341,68 @@ class Utils:
             return (1 << 256) + a
         return a
 
+    @staticmethod
+    def wordCount(size):
+        return (size + 31) // 32
+
+    # total cost of `size` bytes of memory, size is a multiple of 32
+    memoryGas = staticmethod(memoryGas)
+
     @staticmethod
     def scanForJumpDest(code):
-        result = []
+        result = set()
         pc=0
         while pc < len(code):
             currentCode = code[pc]
             if currentCode >= 0x60 and currentCode <=0x7f:
                 pc += (currentCode - 0x60)+1
             elif code[pc] == 0x5b:
-                result.append(pc)
+                result.add(pc)
             pc+=1
         return result
 
-def opcodeStop(ctx, inputParam):
-    return OpcodeResponse(success=True, stopRun=True, data=None)
-
-def opcodePush(ctx, inputParam):
-    data = 0
-    pushBytes = inputParam.Opcode - 0x60 + 1
-    for i in range(pushBytes):
-        # Big Endian
-        data = (data << 8) | ctx.code[ctx.pc]
-        ctx.pc +=1
-    ctx.stack.push(data)
-    return OpcodeResponse(success=True, stopRun=False, data=None)
-
-def opcodePop(ctx, inputParam):
-    data = ctx.stack.pop()
-    return OpcodeResponse(success=True, stopRun=False, data=None)
-
-def opcodeAdd(ctx, inputParam):
-    a = ctx.stack.pop()
-    b = ctx.stack.pop()
-    result = (a+b)
-    # overflow condition
-    result &= UINT256MAX
-    ctx.stack.push(result)
-    return OpcodeResponse(success=True, stopRun=False, data=None)
-
-def opcodeMul(ctx, inputParam):
-    a = ctx.stack.pop()
-    b = ctx.stack.pop()
-    result = (a*b)
-    # overflow condition
-    result &= UINT256MAX
-    ctx.stack.push(result)
-    return OpcodeResponse(success=True, stopRun=False, data=None)
-
-def opcodeSub(ctx, inputParam):
-    a = ctx.stack.pop()
-    b = ctx.stack.pop()
-    result = (a-b)
-    # overflow condition
-    # 2's signed complement, equivalent to
-    # i=-1 ; i.to_bytes(32, "big", signed=True)
-    # b'\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff'
-    result &= UINT256MAX
-    ctx.stack.push(result)
-    return OpcodeResponse(success=True, stopRun=False, data=None)
-
-def opcodeDiv(ctx, inputParam):
-    a = ctx.stack.pop()
-    b = ctx.stack.pop()
-    # Handle Divide by 0
-    if b == 0:
-        result = 0
-    else:
-        result = int(a / b)
-    ctx.stack.push(result)
-    return OpcodeResponse(success=True, stopRun=False, data=None)
-
-def opcodeMod(ctx, inputParam):
-    a = ctx.stack.pop()
-    b = ctx.stack.pop()
-    if b == 0:
-        result = 0
-    else:
-        result = a % b
-    ctx.stack.push(result)
-    return OpcodeResponse(success=True, stopRun=False, data=None)
-
-def opcodeAddMod(ctx, inputParam):
-    a = ctx.stack.pop()
-    b = ctx.stack.pop()
-    result = a+b
-    c = ctx.stack.pop()
-    result = result % c
-    result &= UINT256MAX
-    ctx.stack.push(result)
-    return OpcodeResponse(success=True, stopRun=False, data=None)
-
-def opcodeMulMod(ctx, inputParam):
-    a = ctx.stack.pop()
-    b = ctx.stack.pop()
-    result = a*b
-    c = ctx.stack.pop()
-    result = result % c
-    result &= UINT256MAX
-    ctx.stack.push(result)
-    return OpcodeResponse(success=True, stopRun=False, data=None)
-
-def opcodeExp(ctx, inputParam):
-    a = ctx.stack.pop()
-    b = ctx.stack.pop()
-    result = a ** b
-    ctx.stack.push(result)
-    return OpcodeResponse(success=True, stopRun=False, data=None)
-
-def opcodeSignExt(ctx, inputParam):
-    a = ctx.stack.pop()
-    b = ctx.stack.pop()
-    result = b
-    mask = (a+1)*8
-    if b & int(2**(mask-1)):
-        result = (UINT256MAX << mask) | b
-        result &= UINT256MAX
-    ctx.stack.push(result)
-    return OpcodeResponse(success=True, stopRun=False, data=None)
-
-def opcodeSdiv(ctx, inputParam):
-    a = ctx.stack.pop()
-    b = ctx.stack.pop()
-    # Inputs are in 2s complement, Get the corresponding int value
-    a = Utils.convert2sComplementToInt(a)
-    b = Utils.convert2sComplementToInt(b)
-    if b == 0:
-        result = 0
-    else:
-        result = a // b
-        # Result is int. If its -ve integer, Get the corresponding
-        # 2s complement
-        result = Utils.convertIntTo2sComplement(result)
-    ctx.stack.push(result)
-    return OpcodeResponse(success=True, stopRun=False, data=None)
-
-def opcodeSmod(ctx, inputParam):
-    a = ctx.stack.pop()
-    b = ctx.stack.pop()
-    # Inputs are in 2s complement, Get the corresponding int value
-    a = Utils.convert2sComplementToInt(a)
-    b = Utils.convert2sComplementToInt(b)
-    if b == 0:
-        result = 0
-    else:
-        result = a % b
-        # Result is int. If its -ve integer, Get the corresponding
-        # 2s complement
-        result = Utils.convertIntTo2sComplement(result)
-    ctx.stack.push(result)
-    return OpcodeResponse(success=True, stopRun=False, data=None)
-
-def opcodeLT(ctx, inputParam):
-    a = ctx.stack.pop()
-    b = ctx.stack.pop()
-    if a < b:
-        result = 1
-    else:
-        result = 0
-    ctx.stack.push(result)
-    return OpcodeResponse(success=True, stopRun=False, data=None)
-
-def opcodeGT(ctx, inputParam):
-    a = ctx.stack.pop()
-    b = ctx.stack.pop()
-    if a > b:
-        result = 1
-    else:
-        result = 0
-    ctx.stack.push(result)
-    return OpcodeResponse(success=True, stopRun=False, data=None)
-
-def opcodeSLT(ctx, inputParam):
-    a = ctx.stack.pop()
-    b = ctx.stack.pop()
-    a = Utils.convert2sComplementToInt(a)
-    b = Utils.convert2sComplementToInt(b)
-    if a < b:
-        result = 1
-    else:
-        result = 0
-    ctx.stack.push(result)
-    return OpcodeResponse(success=True, stopRun=False, data=None)
-
-def opcodeSGT(ctx, inputParam):
-    a = ctx.stack.pop()
-    b = ctx.stack.pop()
-    a = Utils.convert2sComplementToInt(a)
-    b = Utils.convert2sComplementToInt(b)
-    if a > b:
-        result = 1
-    else:
-        result = 0
-    ctx.stack.push(result)
-    return OpcodeResponse(success=True, stopRun=False, data=None)
-
-def opcodeEQ(ctx, inputParam):
-    a = ctx.stack.pop()
-    b = ctx.stack.pop()
-    if a == b:
-        result = 1
-    else:
-        result = 0
-    ctx.stack.push(result)
-    return OpcodeResponse(success=True, stopRun=False, data=None)
-
-def opcodeIsZero(ctx, inputParam):
-    a = ctx.stack.pop()
-    result = 0
-    if a == 0:
-        result = 1
-    ctx.stack.push(result)
-    return OpcodeResponse(success=True, stopRun=False, data=None)
-
-def opcodeNot(ctx, inputParam):
-    a = ctx.stack.pop()
-    a ^= UINT256MAX
-    ctx.stack.push(a)
-    return OpcodeResponse(success=True, stopRun=False, data=None)
-
-def opcodeAnd(ctx, inputParam):
-    a = ctx.stack.pop()
-    b = ctx.stack.pop()
-    result = a & b
-    ctx.stack.push(result)
-    return OpcodeResponse(success=True, stopRun=False, data=None)
-
-def opcodeOr(ctx, inputParam):
-    a = ctx.stack.pop()
-    b = ctx.stack.pop()
-    result = a | b
-    ctx.stack.push(result)
-    return OpcodeResponse(success=True, stopRun=False, data=None)
-
-def opcodeXor(ctx, inputParam):
-    a = ctx.stack.pop()
-    b = ctx.stack.pop()
-    result = a ^ b
-    ctx.stack.push(result)
-    return OpcodeResponse(success=True, stopRun=False, data=None)
-
-def opcodeSHL(ctx, inputParam):
-    a = ctx.stack.pop()
-    b = ctx.stack.pop()
-    if a > 255:
-        result = 0
-    else:
-        result = b << a
-        result &= UINT256MAX
-    ctx.stack.push(result)
-    return OpcodeResponse(success=True, stopRun=False, data=None)
-
-def opcodeSHR(ctx, inputParam):
-    a = ctx.stack.pop()
-    b = ctx.stack.pop()
-    if a > 255:
-        result = 0
-    else:
-        result = b >> a
-    ctx.stack.push(result)
-    return OpcodeResponse(success=True, stopRun=False, data=None)
-
-def opcodeSAR(ctx, inputParam):
-    a = ctx.stack.pop()
-    b = ctx.stack.pop()
-    isNegative = b & (1 << 255)
-    if a > 255:
-        if isNegative:
-            result = UINT256MAX
-        else:
-            result = 0
-    else:
-        result = b >> a
-        if isNegative:
-            for i in range(a):
-                result |= ( 1 << (255-i))
-    ctx.stack.push(result)
-    return OpcodeResponse(success=True, stopRun=False, data=None)
-
-def opcodeByte(ctx, inputParam):
-    a = ctx.stack.pop()
-    b = ctx.stack.pop()
-
-    if a > 31:
-        result = 0
-    else:
-        offset = (31 - a) * 8
-        result = (b & (0xff << offset)) >> offset
-    ctx.stack.push(result)
-    return OpcodeResponse(success=True, stopRun=False, data=None)
-
-def opcodeDup(ctx, inputParam):
-    index = inputParam.Opcode - 0x80 + 1
-    try:
-        a = ctx.stack.peek(-index)
-    except IndexError:
-        print("Not enough values on the stack")
-        return OpcodeResponse(success=False, stopRun=True, data=None)
-    ctx.stack.push(a)
-    return OpcodeResponse(success=True, stopRun=False, data=None)
-
-def opcodeSwap(ctx, inputParam):
-    index = inputParam.Opcode - 0x90 + 1
-    try:
-        bottom = ctx.stack.peek(-(index+1))
-    except IndexError:
-        print("Not enough values on the stack")
-        return OpcodeResponse(success=False, stopRun=True, data=None)
-    ctx.stack.replace(-(index+1), ctx.stack.peek(-1))
-    ctx.stack.replace(-1, bottom)
-    return OpcodeResponse(success=True, stopRun=False, data=None)
-
 def opcodeInvalid(ctx, inputParam):
     # Consume all gas, Sorry !
-    return OpcodeResponse(success=False, stopRun=True, data=None)
+    ctx.gas.left = 0
+    return OPCODE_FAIL
 
-def opcodePC(ctx, inputParam):
-    # Already increment PC before, return PC - 1
-    ctx.stack.push(ctx.pc - 1)
-    return OpcodeResponse(success=True, stopRun=False, data=None)
+# PC with its own pc already known, used by Program. The run loop only
+# updates ctx.pc at the end of each basic block
+def makePC(pc):
+    def opcodePCN(ctx, inputParam):
+        ctx.stack.push(pc)
+        return OPCODE_CONTINUE
+    return opcodePCN
 
 def opcodeGas(ctx, inputParam):
-    # not implemented, return UINTMAX
-    ctx.stack.push(UINT256MAX)
-    return OpcodeResponse(success=True, stopRun=False, data=None)
+    # unmetered runs have no limit, return UINTMAX
+    if ctx.gas.metered:
+        ctx.stack.push(ctx.gas.left)
+    else:
+        ctx.stack.push(UINT256MAX)
+    return OPCODE_CONTINUE
+
+# GAS with the static cost of the rest of its block bound, used by
+# CodeAnalysis. The block was paid for on entry, so that part is given back
+# to report the gas left after this instruction
+def makeGas(refund):
+    def opcodeGasN(ctx, inputParam):
+        if ctx.gas.metered:
+            ctx.stack.push(ctx.gas.left + refund)
+        else:
+            ctx.stack.push(UINT256MAX)
+        return OPCODE_CONTINUE
+    return opcodeGasN
 
 def opcodeJump(ctx, inputParam):
     a = ctx.stack.pop()
-    # jump pc should be JUMPDEST
+    # jump pc should be JUMPDEST, the run loop continues with the basic
+    # block starting there
     if a not in ctx.jumpDest:
-        return OpcodeResponse(success=False, stopRun=True, data=None)
+        return OPCODE_FAIL
     else:
-        ctx.pc = a+1
-    return OpcodeResponse(success=True, stopRun=False, data=None)
+        ctx.pc = a
+    return OPCODE_CONTINUE
 
 def opcodeJumpI(ctx, inputParam):
     a = ctx.stack.pop()
@@ -504,121 +410,120 @@ def opcodeJumpI(ctx, inputParam):
     if b > 0:
         # jump pc should be JUMPDEST
         if a not in ctx.jumpDest:
-            return OpcodeResponse(success=False, stopRun=True, data=None)
+            return OPCODE_FAIL
         else:
             ctx.pc = a
-    return OpcodeResponse(success=True, stopRun=False, data=None)
+    return OPCODE_CONTINUE
 
 def opcodeJumpDest(ctx, inputParam):
-    return OpcodeResponse(success=True, stopRun=False, data=None)
+    return OPCODE_CONTINUE
 
 def opcodeMstore(ctx, inputParam):
     a = ctx.stack.pop()
     b = ctx.stack.pop()
     ctx.memory.store(a, b, 32)
-    return OpcodeResponse(success=True, stopRun=False, data=None)
+    return OPCODE_CONTINUE
 
 def opcodeMload(ctx, inputParam):
     a = ctx.stack.pop()
     data = ctx.memory.load(a)
     ctx.stack.push(data)
-    return OpcodeResponse(success=True, stopRun=False, data=None)
+    return OPCODE_CONTINUE
 
 def opcodeMstore8(ctx, inputParam):
     a = ctx.stack.pop()
     b = ctx.stack.pop() & 0xff
     ctx.memory.store(a, b, 1)
-    return OpcodeResponse(success=True, stopRun=False, data=None)
+    return OPCODE_CONTINUE
 
 def opcodeMsize(ctx, inputParam):
     ctx.stack.push(ctx.memory.size)
-    return OpcodeResponse(success=True, stopRun=False, data=None)
+    return OPCODE_CONTINUE
 
 def opcodeSha3(ctx, inputParam):
     a = ctx.stack.pop()
     b = ctx.stack.pop()
-    data = ctx.memory.load(a)
-    b *= 8
-    data >>= (256-b)
-    ctx.stack.push(int.from_bytes(keccak(data), "big"))
-    return OpcodeResponse(success=True, stopRun=False, data=None)
+    ctx.gas.charge(6 * Utils.wordCount(b))
+    # hash the memory slice in place, the same preimages come up again and
+    # again for mapping keys
+    digest = inputParam.Calls.engine.keccakCache.digest(ctx.memory.read(a, b))
+    ctx.stack.push(int.from_bytes(digest, "big"))
+    return OPCODE_CONTINUE
 
 def opcodeAddress(ctx, inputParam):
-    ctx.stack.push(int(inputParam.Txn['to'], 16))
-    return OpcodeResponse(success=True, stopRun=False, data=None)
+    ctx.stack.push(ctx.address)
+    return OPCODE_CONTINUE
 
 def opcodeCaller(ctx, inputParam):
-    ctx.stack.push(int(inputParam.Txn['from'], 16))
-    return OpcodeResponse(success=True, stopRun=False, data=None)
+    ctx.stack.push(ctx.caller)
+    return OPCODE_CONTINUE
 
 def opcodeOrigin(ctx, inputParam):
-    ctx.stack.push(int(inputParam.Txn['origin'], 16))
-    return OpcodeResponse(success=True, stopRun=False, data=None)
+    ctx.stack.push(inputParam.Txn.origin)
+    return OPCODE_CONTINUE
 
 def opcodeGasPrice(ctx, inputParam):
-    ctx.stack.push(int(inputParam.Txn['gasprice'], 16))
-    return OpcodeResponse(success=True, stopRun=False, data=None)
+    ctx.stack.push(inputParam.Txn.gasPrice)
+    return OPCODE_CONTINUE
 
 def opcodeBaseFee(ctx, inputParam):
-    ctx.stack.push(int(inputParam.Block['basefee'], 16))
-    return OpcodeResponse(success=True, stopRun=False, data=None)
+    ctx.stack.push(inputParam.Block.baseFee)
+    return OPCODE_CONTINUE
 
 def opcodeCoinbase(ctx, inputParam):
-    ctx.stack.push(int(inputParam.Block['coinbase'], 16))
-    return OpcodeResponse(success=True, stopRun=False, data=None)
+    ctx.stack.push(inputParam.Block.coinbase)
+    return OPCODE_CONTINUE
 
 def opcodeTimestamp(ctx, inputParam):
-    ctx.stack.push(int(inputParam.Block['timestamp'], 16))
-    return OpcodeResponse(success=True, stopRun=False, data=None)
+    ctx.stack.push(inputParam.Block.timestamp)
+    return OPCODE_CONTINUE
 
 def opcodeNumber(ctx, inputParam):
-    ctx.stack.push(int(inputParam.Block['number'], 16))
-    return OpcodeResponse(success=True, stopRun=False, data=None)
+    ctx.stack.push(inputParam.Block.number)
+    return OPCODE_CONTINUE
 
 def opcodeDifficulty(ctx, inputParam):
-    ctx.stack.push(int(inputParam.Block['difficulty'], 16))
-    return OpcodeResponse(success=True, stopRun=False, data=None)
+    ctx.stack.push(inputParam.Block.difficulty)
+    return OPCODE_CONTINUE
 
 def opcodeGasLimit(ctx, inputParam):
-    ctx.stack.push(int(inputParam.Block['gaslimit'], 16))
-    return OpcodeResponse(success=True, stopRun=False, data=None)
+    ctx.stack.push(inputParam.Block.gasLimit)
+    return OPCODE_CONTINUE
 
 def opcodeChainId(ctx, inputParam):
-    ctx.stack.push(int(inputParam.Block['chainid'], 16))
-    return OpcodeResponse(success=True, stopRun=False, data=None)
+    ctx.stack.push(inputParam.Block.chainId)
+    return OPCODE_CONTINUE
 
 def opcodeBlockHash(ctx, inputParam):
     # Not Implemented.
     ctx.stack.push(0)
-    return OpcodeResponse(success=True, stopRun=False, data=None)
+    return OPCODE_CONTINUE
 
 def opcodeBalance(ctx, inputParam):
     a = ctx.stack.pop()
+    ctx.gas.charge(ctx.gas.accessAddress(a))
     if a not in inputParam.State:
         result = 0
     else:
         result = inputParam.State[a].balance
     ctx.stack.push(result)
-    return OpcodeResponse(success=True, stopRun=False, data=None)
+    return OPCODE_CONTINUE
 
 def opcodeCallValue(ctx, inputParam):
-    ctx.stack.push(int(inputParam.Txn['value'], 16))
-    return OpcodeResponse(success=True, stopRun=False, data=None)
+    ctx.stack.push(ctx.value)
+    return OPCODE_CONTINUE
 
 def opcodeCallDataLoad(ctx, inputParam):
-    calldataOrig = ctx.calldata
     a = ctx.stack.pop()
-    calldata = calldataOrig[a*2:a*2+64]
-    calldata = int(calldata, 16)
-    if (a*2)+64 > len(calldataOrig):
-        calldata <<= (((a*2)+64-len(calldataOrig))//2)*8
+    # bytes past the end of calldata read as zero
+    calldata = ctx.calldata[a:a+32]
+    calldata = int.from_bytes(calldata, "big") << ((32 - len(calldata)) * 8)
     ctx.stack.push(calldata)
-    return OpcodeResponse(success=True, stopRun=False, data=None)
+    return OPCODE_CONTINUE
 
 def opcodeCallDataSize(ctx, inputParam):
-    calldata = ctx.calldata
-    ctx.stack.push(len(calldata)//2)
-    return OpcodeResponse(success=True, stopRun=False, data=None)
+    ctx.stack.push(len(ctx.calldata))
+    return OPCODE_CONTINUE
 
 def opcodeCallDataCopy(ctx, inputParam):
     calldataOrig = ctx.calldata
@@ -628,12 +533,10 @@ def opcodeCallDataCopy(ctx, inputParam):
     b = ctx.stack.pop()
     # size
     c = ctx.stack.pop()
-    calldata = calldataOrig[b*2:b*2+(c*2)]
-    calldata = int(calldata, 16)
-    if (b*2)+(c*2) > len(calldataOrig):
-        calldata <<= (((b*2)+(c*2)-len(calldataOrig))//2)*8
-    ctx.memory.store(a, calldata, c)
-    return OpcodeResponse(success=True, stopRun=False, data=None)
+    ctx.gas.charge(3 * Utils.wordCount(c))
+    # bytes past the end of calldata are zero
+    ctx.memory.write(a, memoryview(calldataOrig)[b:b+c], c)
+    return OPCODE_CONTINUE
 
 def opcodeCodeCopy(ctx, inputParam):
     code = ctx.code
@@ -644,102 +547,210 @@ def opcodeCodeCopy(ctx, inputParam):
     b = ctx.stack.pop()
     # size
     c = ctx.stack.pop()
-    codeLen = len(code)
-    code = code[b:b+c]
-    code = int.from_bytes(code, "big")
-    if b+c > codeLen:
-        code <<= (b + c - codeLen)*8
-    ctx.memory.store(a, code, c)
-    return OpcodeResponse(success=True, stopRun=False, data=None)
+    ctx.gas.charge(3 * Utils.wordCount(c))
+    # bytes past the end of code are zero
+    ctx.memory.write(a, memoryview(code)[b:b+c], c)
+    return OPCODE_CONTINUE
 
 def opcodeCodeSize(ctx, inputParam):
     ctx.stack.push(len(ctx.code))
-    return OpcodeResponse(success=True, stopRun=False, data=None)
+    return OPCODE_CONTINUE
 
 def opcodeExtCodeSize(ctx, inputParam):
     a = ctx.stack.pop()
+    ctx.gas.charge(ctx.gas.accessAddress(a))
     result = 0
-    if a in inputParam.State and inputParam.State[a].codeBin:
-        result = len(inputParam.State[a].codeBin) // 2
+    if a in inputParam.State:
+        result = len(inputParam.State[a].code)
     ctx.stack.push(result)
-    return OpcodeResponse(success=True, stopRun=False, data=None)
+    return OPCODE_CONTINUE
 
 def opcodeExtCodeCopy(ctx, inputParam):
     address = ctx.stack.pop()
-    code = inputParam.State[address].codeBin
+    # accounts which do not exist have no code
+    account = inputParam.State.get(address)
+    code = account.code if account is not None else b''
     # destOffset in memory
     a = ctx.stack.pop()
     # offset in calldata
     b = ctx.stack.pop()
     # size
     c = ctx.stack.pop()
-    codeExact = code[b*2:b*2+(c*2)]
-    codeExact = int(codeExact, 16)
-    if (b*2)+(c*2) > len(code):
-        codeExact <<= (((b*2)+(c*2)-len(code))//2)*8
-    ctx.memory.store(a, codeExact, c)
-    return OpcodeResponse(success=True, stopRun=False, data=None)
+    ctx.gas.charge(ctx.gas.accessAddress(address) + 3 * Utils.wordCount(c))
+    ctx.memory.write(a, memoryview(code)[b:b+c], c)
+    return OPCODE_CONTINUE
 
 def opcodeExtCodeHash(ctx, inputParam):
     a = ctx.stack.pop()
+    ctx.gas.charge(ctx.gas.accessAddress(a))
     result = 0
-    if a in inputParam.State and inputParam.State[a].codeBin:
-        result = keccak(int(inputParam.State[a].codeBin, 16))
-        result = int.from_bytes(result, "big")
-        #ToDo : If codeBin is not present, then hash value will be
+    if a in inputParam.State and inputParam.State[a].code:
+        result = int.from_bytes(inputParam.State[a].codeHash(inputParam.Calls.engine.keccakCache.digest), "big")
+        #ToDo : If code is not present, then hash value will be
         #       0xc5d24601...
-    print(result)
     ctx.stack.push(result)
-    return OpcodeResponse(success=True, stopRun=False, data=None)
+    return OPCODE_CONTINUE
 
 def opcodeSelfBalance(ctx, inputParam):
-    address = inputParam.Txn["to"]
-    address = int(address, 16)
+    address = ctx.address
     result = 0
     if address in inputParam.State and inputParam.State[address].balance:
         result = inputParam.State[address].balance
     ctx.stack.push(result)
-    return OpcodeResponse(success=True, stopRun=False, data=None)
-
-def opcodeSStore(ctx, InputParam):
-    a = ctx.stack.pop()
-    b = ctx.stack.pop()
-    ctx.storage.store(a, b)
-    return OpcodeResponse(success=True, stopRun=False, data=None)
+    return OPCODE_CONTINUE
+
+# Like GAS, SSTORE is bound to static cost charged with its block before it
+# ran (refund): its own and that of the instructions after it in the block.
+# The EIP-2200 stipend check needs the gas left before the SSTORE
+def makeSStore(refund):
+    def opcodeSStoreN(ctx, InputParam):
+        a = ctx.stack.pop()
+        b = ctx.stack.pop()
+        if ctx.static:
+            return OPCODE_FAIL
+        gas = ctx.gas
+        if gas.metered and gas.left + refund <= SSTORE_STIPEND:
+            raise OutOfGas()
+        # The table charges the warm no-op cost, a cold slot costs
+        # COLD_SLOAD on top of it (EIP-2929). The current value stands in
+        # for the original value of the slot
+        cost = COLD_SLOAD if gas.accessSlot((ctx.address, a)) else 0
+        current = ctx.storage.load(a)
+        if current != b:
+            cost += (SSTORE_SET if current == 0 else SSTORE_RESET) - WARM_ACCESS
+        gas.charge(cost)
+        ctx.storage.store(a, b)
+        return OPCODE_CONTINUE
+    return opcodeSStoreN
+
+opcodeSStore = makeSStore(WARM_ACCESS)
 
 def opcodeSLoad(ctx, InputParam):
     a = ctx.stack.pop()
+    ctx.gas.charge(ctx.gas.accessSlot((ctx.address, a)))
     result = ctx.storage.load(a)
     ctx.stack.push(result)
-    return OpcodeResponse(success=True, stopRun=False, data=None)
-
-def opcodeLog(ctx, InputParam):
-    a = ctx.stack.pop()
-    b = ctx.stack.pop()
-    numTopics = InputParam.Opcode - 0xa0
-    topics = []
-    for _ in range(numTopics):
-        c = ctx.stack.pop()
-        topics.append(hex(c))
-    data = hex(ctx.memory.load(a, b))
-    data = data[2:]
-    logs = Logs(InputParam.Txn['to'], data, topics)
-    return OpcodeResponse(success=True, stopRun=False, data={'logs':logs})
-
+    return OPCODE_CONTINUE
+
+def makeLog(numTopics):
+    def opcodeLog(ctx, InputParam):
+        if ctx.static:
+            return OPCODE_FAIL
+        a = ctx.stack.pop()
+        b = ctx.stack.pop()
+        topics = []
+        for _ in range(numTopics):
+            c = ctx.stack.pop()
+            topics.append(hex(c))
+        ctx.gas.charge(8 * b)
+        # memory changes after the log, keep a copy
+        data = bytes(ctx.memory.read(a, b))
+        # kept in the world state, so logs of reverted calls are dropped
+        InputParam.State.log(Logs(ctx.address, data, topics))
+        return OPCODE_CONTINUE
+    return opcodeLog
+
+# The memory of a returning call is never written again, so its return data
+# is a view of it instead of a copy
 def opcodeReturn(ctx, InputParam):
     a = ctx.stack.pop()
     b = ctx.stack.pop()
-    data = hex(ctx.memory.load(a, b))
-    data = data[2:]
+    data = ctx.memory.read(a, b)
     return OpcodeResponse(success=True, stopRun=True, data={'returnData':data})
 
 def opcodeRevert(ctx, InputParam):
     a = ctx.stack.pop()
     b = ctx.stack.pop()
-    data = hex(ctx.memory.load(a, b))
-    data = data[2:]
+    data = ctx.memory.read(a, b)
     return OpcodeResponse(success=False, stopRun=True, data={'returnData':data})
 
+def opcodeReturnDataSize(ctx, inputParam):
+    ctx.stack.push(len(ctx.returnData))
+    return OPCODE_CONTINUE
+
+def opcodeReturnDataCopy(ctx, inputParam):
+    # destOffset in memory
+    a = ctx.stack.pop()
+    # offset in return data
+    b = ctx.stack.pop()
+    # size
+    c = ctx.stack.pop()
+    # reading past the end of return data fails
+    if b + c > len(ctx.returnData):
+        return OPCODE_FAIL
+    ctx.gas.charge(3 * Utils.wordCount(c))
+    ctx.memory.write(a, ctx.returnData[b:b+c])
+    return OPCODE_CONTINUE
+
+# Runs a nested call and pushes 1 on success or 0 on failure. codeAddress is
+# the account whose code runs, the new frame runs as `address` with the
+# storage of that account
+def messageCall(ctx, inputParam, gas, codeAddress, address, caller, value, argsOffset, argsSize,
+                retOffset, retSize, static, transfer):
+    meter = ctx.gas
+    world = inputParam.State
+    calls = inputParam.Calls
+    # arguments and return area are paid for before the call
+    calldata = bytes(ctx.memory.read(argsOffset, argsSize))
+    ctx.memory._expand(retOffset, retSize)
+    cost = meter.accessAddress(codeAddress)
+    if transfer and value:
+        cost += CALL_VALUE
+        if address not in world:
+            cost += CALL_NEW_ACCOUNT
+    meter.charge(cost)
+    ctx.returnData = b''
+    if meter.metered:
+        # everything but one 64th of what is left can be passed on. The rest
+        # of the block is already paid for, so this is slightly less than
+        # with per-instruction charging
+        gas = min(gas, meter.left - meter.left // 64)
+        meter.charge(gas)
+        if transfer and value:
+            gas += CALL_STIPEND
+        childGas = GasMeter(gas, meter)
+    else:
+        childGas = GasMeter(None, meter)
+    checkpoint = world.checkpoint()
+    if len(calls.stacks) >= MAXCALLDEPTH or (transfer and not world.transfer(ctx.address, address, value)):
+        # the call does not happen, the gas passed on comes back
+        meter.left += childGas.left if meter.metered else 0
+        ctx.stack.push(0)
+        return OPCODE_CONTINUE
+    account = world.get(codeAddress)
+    code = account.code if account is not None else b''
+    if not code:
+        meter.left += childGas.left if meter.metered else 0
+        ctx.stack.push(1)
+        return OPCODE_CONTINUE
+    engine = calls.engine
+    analysis = engine.analysisCache.get(code)
+    child = calls.enter(analysis, calldata, childGas, address, caller, value, address, static)
+    tracer = engine.tracer
+    if tracer is not None:
+        tracer.enter(child)
+    try:
+        (pc, response) = calls.runner(child, inputParam, analysis)
+    finally:
+        calls.stacks.pop()
+    # unknown opcodes fail nested calls
+    success = response.success and response is not OPCODE_NOT_FOUND
+    if response.data and 'returnData' in response.data:
+        ctx.returnData = response.data['returnData']
+    elif not success:
+        # failures other than REVERT consume all gas
+        childGas.left = 0
+    if not success:
+        world.revert(checkpoint)
+    if tracer is not None:
+        tracer.exit(child, success, bytes(ctx.returnData).hex(), childGas.used())
+    if meter.metered:
+        meter.left += childGas.left
+    # only as much as fits in the return area is copied
+    ctx.memory.write(retOffset, ctx.returnData[:retSize])
+    ctx.stack.push(1 if success else 0)
+    return OPCODE_CONTINUE
+
 def opcodeCall(ctx, InputParam):
     gas = ctx.stack.pop()
     address = ctx.stack.pop()
@@ -748,303 +759,875 @@ def opcodeCall(ctx, InputParam):
     argsSize = ctx.stack.pop()
     retOffset = ctx.stack.pop()
     retSize = ctx.stack.pop()
+    # static frames can not send value
+    if ctx.static and value:
+        return OPCODE_FAIL
+    return messageCall(ctx, InputParam, gas, address, address, ctx.address, value, argsOffset, argsSize,
+                       retOffset, retSize, ctx.static, True)
 
-@dataclass
-class OpcodeResponse:
-    success: bool
-    stopRun: bool #stop will be True for stop opcode
-    data: dict
+def opcodeDelegateCall(ctx, InputParam):
+    gas = ctx.stack.pop()
+    address = ctx.stack.pop()
+    argsOffset = ctx.stack.pop()
+    argsSize = ctx.stack.pop()
+    retOffset = ctx.stack.pop()
+    retSize = ctx.stack.pop()
+    # code of address runs as the current frame
+    return messageCall(ctx, InputParam, gas, address, ctx.address, ctx.caller, ctx.value, argsOffset, argsSize,
+                       retOffset, retSize, ctx.static, False)
+
+def opcodeStaticCall(ctx, InputParam):
+    gas = ctx.stack.pop()
+    address = ctx.stack.pop()
+    argsOffset = ctx.stack.pop()
+    argsSize = ctx.stack.pop()
+    retOffset = ctx.stack.pop()
+    retSize = ctx.stack.pop()
+    return messageCall(ctx, InputParam, gas, address, address, ctx.address, 0, argsOffset, argsSize,
+                       retOffset, retSize, True, False)
 
-@dataclass
+# Plain classes with __slots__ rather than dataclasses, which take longer to
+# define at import than the rest of the module
 class OpcodeData:
-    opcode:int
-    name:str
-    # function pointer
-    run:any
+    __slots__ = ('opcode', 'name', 'run', 'pops', 'pushes', 'gas')
+
+    def __init__(self, opcode, name, run, pops, pushes, gas):
+        self.opcode = opcode
+        self.name = name
+        # function pointer. PUSH and PC hold a factory instead, which
+        # Program calls with the immediate or the pc when it decodes the code
+        self.run = run
+        # stack items the opcode takes and leaves, DUPn needs n items and
+        # pushes one more
+        self.pops = pops
+        self.pushes = pushes
+        # static gas, charged for the whole basic block when it is entered.
+        # Costs depending on operands are charged by the handlers
+        self.gas = gas
 
-@dataclass
 class InputParam:
-    Opcode: int
-    Txn: dict
-    Block: dict
-    State: dict
-
-opcode = {}
-opcode[0x00] = OpcodeData(0x00, "STOP", opcodeStop)
-opcode[0x60] = OpcodeData(0x60, "PUSH1", opcodePush)
-opcode[0x61] = OpcodeData(0x61, "PUSH2", opcodePush)
-opcode[0x62] = OpcodeData(0x62, "PUSH3", opcodePush)
-opcode[0x63] = OpcodeData(0x63, "PUSH4", opcodePush)
-opcode[0x64] = OpcodeData(0x64, "PUSH5", opcodePush)
-opcode[0x65] = OpcodeData(0x65, "PUSH6", opcodePush)
-opcode[0x66] = OpcodeData(0x66, "PUSH7", opcodePush)
-opcode[0x67] = OpcodeData(0x67, "PUSH8", opcodePush)
-opcode[0x68] = OpcodeData(0x68, "PUSH9", opcodePush)
-opcode[0x69] = OpcodeData(0x69, "PUSH10", opcodePush)
-opcode[0x6A] = OpcodeData(0x6A, "PUSH11", opcodePush)
-opcode[0x6B] = OpcodeData(0x6B, "PUSH12", opcodePush)
-opcode[0x6C] = OpcodeData(0x6C, "PUSH13", opcodePush)
-opcode[0x6D] = OpcodeData(0x6D, "PUSH14", opcodePush)
-opcode[0x6E] = OpcodeData(0x6E, "PUSH15", opcodePush)
-opcode[0x6F] = OpcodeData(0x6F, "PUSH16", opcodePush)
-opcode[0x70] = OpcodeData(0x70, "PUSH17", opcodePush)
-opcode[0x71] = OpcodeData(0x71, "PUSH18", opcodePush)
-opcode[0x72] = OpcodeData(0x72, "PUSH19", opcodePush)
-opcode[0x73] = OpcodeData(0x73, "PUSH20", opcodePush)
-opcode[0x74] = OpcodeData(0x74, "PUSH21", opcodePush)
-opcode[0x75] = OpcodeData(0x75, "PUSH22", opcodePush)
-opcode[0x76] = OpcodeData(0x76, "PUSH23", opcodePush)
-opcode[0x77] = OpcodeData(0x77, "PUSH24", opcodePush)
-opcode[0x78] = OpcodeData(0x78, "PUSH25", opcodePush)
-opcode[0x79] = OpcodeData(0x79, "PUSH26", opcodePush)
-opcode[0x7A] = OpcodeData(0x7A, "PUSH27", opcodePush)
-opcode[0x7B] = OpcodeData(0x7B, "PUSH28", opcodePush)
-opcode[0x7C] = OpcodeData(0x7C, "PUSH29", opcodePush)
-opcode[0x7D] = OpcodeData(0x7D, "PUSH30", opcodePush)
-opcode[0x7E] = OpcodeData(0x7E, "PUSH31", opcodePush)
-opcode[0x7F] = OpcodeData(0x7F, "PUSH32", opcodePush)
-opcode[0x50] = OpcodeData(0x50, "POP", opcodePop)
-opcode[0x01] = OpcodeData(0x01, "ADD", opcodeAdd)
-opcode[0x02] = OpcodeData(0x02, "MUL", opcodeMul)
-opcode[0x03] = OpcodeData(0x03, "SUB", opcodeSub)
-opcode[0x04] = OpcodeData(0x04, "DIV", opcodeDiv)
-opcode[0x06] = OpcodeData(0x06, "MOD", opcodeMod)
-opcode[0x08] = OpcodeData(0x08, "MODADD", opcodeAddMod)
-opcode[0x09] = OpcodeData(0x09, "MODMUL", opcodeMulMod)
-opcode[0x0A] = OpcodeData(0x0A, "EXP", opcodeExp)
-opcode[0x0B] = OpcodeData(0x0B, "SIGNEXTEND", opcodeSignExt)
-opcode[0x05] = OpcodeData(0x05, "SDIV", opcodeSdiv)
-opcode[0x07] = OpcodeData(0x07, "SMOD", opcodeSmod)
-opcode[0x10] = OpcodeData(0x10, "LT", opcodeLT)
-opcode[0x11] = OpcodeData(0x11, "GT", opcodeGT)
-opcode[0x12] = OpcodeData(0x12, "SLT", opcodeSLT)
-opcode[0x13] = OpcodeData(0x13, "SGT", opcodeSGT)
-opcode[0x14] = OpcodeData(0x14, "EQ", opcodeEQ)
-opcode[0x15] = OpcodeData(0x15, "ISZERO", opcodeIsZero)
-opcode[0x19] = OpcodeData(0x19, "NOT", opcodeNot)
-opcode[0x16] = OpcodeData(0x16, "AND", opcodeAnd)
-opcode[0x17] = OpcodeData(0x17, "OR", opcodeOr)
-opcode[0x18] = OpcodeData(0x18, "XOR", opcodeXor)
-opcode[0x1B] = OpcodeData(0x1B, "SHL", opcodeSHL)
-opcode[0x1C] = OpcodeData(0x1C, "SHR", opcodeSHR)
-opcode[0x1D] = OpcodeData(0x1D, "SAR", opcodeSAR)
-opcode[0x1A] = OpcodeData(0x1A, "BYTE", opcodeByte)
-opcode[0x80] = OpcodeData(0x80, "DUP1", opcodeDup)
-opcode[0x81] = OpcodeData(0x81, "DUP2", opcodeDup)
-opcode[0x82] = OpcodeData(0x82, "DUP3", opcodeDup)
-opcode[0x83] = OpcodeData(0x83, "DUP4", opcodeDup)
-opcode[0x84] = OpcodeData(0x84, "DUP5", opcodeDup)
-opcode[0x85] = OpcodeData(0x85, "DUP6", opcodeDup)
-opcode[0x86] = OpcodeData(0x86, "DUP7", opcodeDup)
-opcode[0x87] = OpcodeData(0x87, "DUP8", opcodeDup)
-opcode[0x88] = OpcodeData(0x88, "DUP9", opcodeDup)
-opcode[0x89] = OpcodeData(0x89, "DUP10", opcodeDup)
-opcode[0x8a] = OpcodeData(0x8a, "DUP11", opcodeDup)
-opcode[0x8b] = OpcodeData(0x8b, "DUP12", opcodeDup)
-opcode[0x8c] = OpcodeData(0x8c, "DUP13", opcodeDup)
-opcode[0x8d] = OpcodeData(0x8d, "DUP14", opcodeDup)
-opcode[0x8e] = OpcodeData(0x8e, "DUP15", opcodeDup)
-opcode[0x8f] = OpcodeData(0x8f, "DUP16", opcodeDup)
-opcode[0x90] = OpcodeData(0x90, "SWAP1", opcodeSwap)
-opcode[0x91] = OpcodeData(0x91, "SWAP2", opcodeSwap)
-opcode[0x92] = OpcodeData(0x92, "SWAP3", opcodeSwap)
-opcode[0x93] = OpcodeData(0x93, "SWAP4", opcodeSwap)
-opcode[0x94] = OpcodeData(0x94, "SWAP5", opcodeSwap)
-opcode[0x95] = OpcodeData(0x95, "SWAP6", opcodeSwap)
-opcode[0x96] = OpcodeData(0x96, "SWAP7", opcodeSwap)
-opcode[0x97] = OpcodeData(0x97, "SWAP8", opcodeSwap)
-opcode[0x98] = OpcodeData(0x98, "SWAP9", opcodeSwap)
-opcode[0x99] = OpcodeData(0x99, "SWAP10", opcodeSwap)
-opcode[0x9a] = OpcodeData(0x9a, "SWAP11", opcodeSwap)
-opcode[0x9b] = OpcodeData(0x9b, "SWAP12", opcodeSwap)
-opcode[0x9c] = OpcodeData(0x9c, "SWAP13", opcodeSwap)
-opcode[0x9d] = OpcodeData(0x9d, "SWAP14", opcodeSwap)
-opcode[0x9e] = OpcodeData(0x9e, "SWAP15", opcodeSwap)
-opcode[0x9f] = OpcodeData(0x9f, "SWAP16", opcodeSwap)
-opcode[0xfe] = OpcodeData(0xfe, "INVALID", opcodeInvalid)
-opcode[0x58] = OpcodeData(0x58, "PC", opcodePC)
-opcode[0x5a] = OpcodeData(0x5a, "GAS", opcodeGas)
-opcode[0x56] = OpcodeData(0x56, "JUMP", opcodeJump)
-opcode[0x57] = OpcodeData(0x57, "JUMPI", opcodeJumpI)
-opcode[0x5B] = OpcodeData(0x57, "JUMPDEST", opcodeJumpDest)
-opcode[0x52] = OpcodeData(0x52, "MSTORE", opcodeMstore)
-opcode[0x52] = OpcodeData(0x52, "MSTORE", opcodeMstore)
-opcode[0x51] = OpcodeData(0x51, "MLOAD", opcodeMload)
-opcode[0x53] = OpcodeData(0x52, "MSTORE8", opcodeMstore8)
-opcode[0x59] = OpcodeData(0x59, "MSIZE", opcodeMsize)
-opcode[0x20] = OpcodeData(0x20, "SHA3", opcodeSha3)
-opcode[0x30] = OpcodeData(0x30, "ADDRESS", opcodeAddress)
-opcode[0x33] = OpcodeData(0x33, "CALLER", opcodeCaller)
-opcode[0x32] = OpcodeData(0x32, "ORIGIN", opcodeOrigin)
-opcode[0x3a] = OpcodeData(0x3a, "GASPRICE", opcodeGasPrice)
-opcode[0x48] = OpcodeData(0x48, "BASEFEE", opcodeBaseFee)
-opcode[0x41] = OpcodeData(0x41, "COINBASE", opcodeCoinbase)
-opcode[0x42] = OpcodeData(0x42, "TIMESTAMP", opcodeTimestamp)
-opcode[0x43] = OpcodeData(0x43, "NUMBER", opcodeNumber)
-opcode[0x44] = OpcodeData(0x44, "DIFFICULTY", opcodeDifficulty)
-opcode[0x45] = OpcodeData(0x45, "DIFFICULTY", opcodeGasLimit)
-opcode[0x46] = OpcodeData(0x46, "CHAINID", opcodeChainId)
-opcode[0x40] = OpcodeData(0x40, "BLOCKHASH", opcodeBlockHash)
-opcode[0x31] = OpcodeData(0x31, "BALANCE", opcodeBalance)
-opcode[0x34] = OpcodeData(0x34, "CALLVALUE", opcodeCallValue)
-opcode[0x35] = OpcodeData(0x35, "CALLDATALOAD", opcodeCallDataLoad)
-opcode[0x36] = OpcodeData(0x36, "CALLDATASIZE", opcodeCallDataSize)
-opcode[0x37] = OpcodeData(0x37, "CALLDATACOPY", opcodeCallDataCopy)
-opcode[0x38] = OpcodeData(0x38, "CODESIZE", opcodeCodeSize)
-opcode[0x39] = OpcodeData(0x39, "CODECOPY", opcodeCodeCopy)
-opcode[0x3b] = OpcodeData(0x3b, "EXTCODESIZE", opcodeExtCodeSize)
-opcode[0x3c] = OpcodeData(0x3c, "EXTCODECOPY", opcodeExtCodeCopy)
-opcode[0x3f] = OpcodeData(0x3f, "EXTCODEHASH", opcodeExtCodeHash)
-opcode[0x47] = OpcodeData(0x47, "SELFBALANCE", opcodeSelfBalance)
-opcode[0x55] = OpcodeData(0x55, "SSTORE", opcodeSStore)
-opcode[0x54] = OpcodeData(0x54, "SLOAD", opcodeSLoad)
-opcode[0xa0] = OpcodeData(0xa0, "LOG0", opcodeLog)
-opcode[0xa1] = OpcodeData(0xa1, "LOG1", opcodeLog)
-opcode[0xa2] = OpcodeData(0xa2, "LOG2", opcodeLog)
-opcode[0xa3] = OpcodeData(0xa3, "LOG3", opcodeLog)
-opcode[0xa4] = OpcodeData(0xa4, "LOG4", opcodeLog)
-opcode[0xf3] = OpcodeData(0xf3, "RETURN", opcodeReturn)
-opcode[0xfd] = OpcodeData(0xfd, "REVERT", opcodeRevert)
-opcode[0xf1] = OpcodeData(0xf1, "CALL", opcodeCall)
-
-def prehook(opcodeDataObj):
-    print(f'Running opcode {hex(opcodeDataObj.opcode)} {opcodeDataObj.name}')
+    __slots__ = ('Opcode', 'Txn', 'Block', 'State', 'Calls')
+
+    # Calls is the CallStack of the execution, used by the CALL opcodes
+    def __init__(self, Opcode, Txn, Block, State, Calls=None):
+        self.Opcode = Opcode
+        self.Txn = Txn
+        self.Block = Block
+        self.State = State
+        self.Calls = Calls
+
+# Opcode table every engine starts from, a new dict per call so engines can
+# add or replace opcodes without affecting each other
+def defaultOpcodes():
+    opcode = {}
+    opcode[0x00] = OpcodeData(0x00, "STOP", opcodeStop, 0, 0, 0)
+    opcode[0x60] = OpcodeData(0x60, "PUSH1", makePush, 0, 1, 3)
+    opcode[0x61] = OpcodeData(0x61, "PUSH2", makePush, 0, 1, 3)
+    opcode[0x62] = OpcodeData(0x62, "PUSH3", makePush, 0, 1, 3)
+    opcode[0x63] = OpcodeData(0x63, "PUSH4", makePush, 0, 1, 3)
+    opcode[0x64] = OpcodeData(0x64, "PUSH5", makePush, 0, 1, 3)
+    opcode[0x65] = OpcodeData(0x65, "PUSH6", makePush, 0, 1, 3)
+    opcode[0x66] = OpcodeData(0x66, "PUSH7", makePush, 0, 1, 3)
+    opcode[0x67] = OpcodeData(0x67, "PUSH8", makePush, 0, 1, 3)
+    opcode[0x68] = OpcodeData(0x68, "PUSH9", makePush, 0, 1, 3)
+    opcode[0x69] = OpcodeData(0x69, "PUSH10", makePush, 0, 1, 3)
+    opcode[0x6A] = OpcodeData(0x6A, "PUSH11", makePush, 0, 1, 3)
+    opcode[0x6B] = OpcodeData(0x6B, "PUSH12", makePush, 0, 1, 3)
+    opcode[0x6C] = OpcodeData(0x6C, "PUSH13", makePush, 0, 1, 3)
+    opcode[0x6D] = OpcodeData(0x6D, "PUSH14", makePush, 0, 1, 3)
+    opcode[0x6E] = OpcodeData(0x6E, "PUSH15", makePush, 0, 1, 3)
+    opcode[0x6F] = OpcodeData(0x6F, "PUSH16", makePush, 0, 1, 3)
+    opcode[0x70] = OpcodeData(0x70, "PUSH17", makePush, 0, 1, 3)
+    opcode[0x71] = OpcodeData(0x71, "PUSH18", makePush, 0, 1, 3)
+    opcode[0x72] = OpcodeData(0x72, "PUSH19", makePush, 0, 1, 3)
+    opcode[0x73] = OpcodeData(0x73, "PUSH20", makePush, 0, 1, 3)
+    opcode[0x74] = OpcodeData(0x74, "PUSH21", makePush, 0, 1, 3)
+    opcode[0x75] = OpcodeData(0x75, "PUSH22", makePush, 0, 1, 3)
+    opcode[0x76] = OpcodeData(0x76, "PUSH23", makePush, 0, 1, 3)
+    opcode[0x77] = OpcodeData(0x77, "PUSH24", makePush, 0, 1, 3)
+    opcode[0x78] = OpcodeData(0x78, "PUSH25", makePush, 0, 1, 3)
+    opcode[0x79] = OpcodeData(0x79, "PUSH26", makePush, 0, 1, 3)
+    opcode[0x7A] = OpcodeData(0x7A, "PUSH27", makePush, 0, 1, 3)
+    opcode[0x7B] = OpcodeData(0x7B, "PUSH28", makePush, 0, 1, 3)
+    opcode[0x7C] = OpcodeData(0x7C, "PUSH29", makePush, 0, 1, 3)
+    opcode[0x7D] = OpcodeData(0x7D, "PUSH30", makePush, 0, 1, 3)
+    opcode[0x7E] = OpcodeData(0x7E, "PUSH31", makePush, 0, 1, 3)
+    opcode[0x7F] = OpcodeData(0x7F, "PUSH32", makePush, 0, 1, 3)
+    opcode[0x50] = OpcodeData(0x50, "POP", opcodePop, 1, 0, 2)
+    opcode[0x01] = OpcodeData(0x01, "ADD", opcodeAdd, 2, 1, 3)
+    opcode[0x02] = OpcodeData(0x02, "MUL", opcodeMul, 2, 1, 5)
+    opcode[0x03] = OpcodeData(0x03, "SUB", opcodeSub, 2, 1, 3)
+    opcode[0x04] = OpcodeData(0x04, "DIV", opcodeDiv, 2, 1, 5)
+    opcode[0x06] = OpcodeData(0x06, "MOD", opcodeMod, 2, 1, 5)
+    opcode[0x08] = OpcodeData(0x08, "ADDMOD", opcodeAddMod, 3, 1, 8)
+    opcode[0x09] = OpcodeData(0x09, "MULMOD", opcodeMulMod, 3, 1, 8)
+    opcode[0x0A] = OpcodeData(0x0A, "EXP", opcodeExp, 2, 1, 10)
+    opcode[0x0B] = OpcodeData(0x0B, "SIGNEXTEND", opcodeSignExt, 2, 1, 5)
+    opcode[0x05] = OpcodeData(0x05, "SDIV", opcodeSdiv, 2, 1, 5)
+    opcode[0x07] = OpcodeData(0x07, "SMOD", opcodeSmod, 2, 1, 5)
+    opcode[0x10] = OpcodeData(0x10, "LT", opcodeLT, 2, 1, 3)
+    opcode[0x11] = OpcodeData(0x11, "GT", opcodeGT, 2, 1, 3)
+    opcode[0x12] = OpcodeData(0x12, "SLT", opcodeSLT, 2, 1, 3)
+    opcode[0x13] = OpcodeData(0x13, "SGT", opcodeSGT, 2, 1, 3)
+    opcode[0x14] = OpcodeData(0x14, "EQ", opcodeEQ, 2, 1, 3)
+    opcode[0x15] = OpcodeData(0x15, "ISZERO", opcodeIsZero, 1, 1, 3)
+    opcode[0x19] = OpcodeData(0x19, "NOT", opcodeNot, 1, 1, 3)
+    opcode[0x16] = OpcodeData(0x16, "AND", opcodeAnd, 2, 1, 3)
+    opcode[0x17] = OpcodeData(0x17, "OR", opcodeOr, 2, 1, 3)
+    opcode[0x18] = OpcodeData(0x18, "XOR", opcodeXor, 2, 1, 3)
+    opcode[0x1B] = OpcodeData(0x1B, "SHL", opcodeSHL, 2, 1, 3)
+    opcode[0x1C] = OpcodeData(0x1C, "SHR", opcodeSHR, 2, 1, 3)
+    opcode[0x1D] = OpcodeData(0x1D, "SAR", opcodeSAR, 2, 1, 3)
+    opcode[0x1A] = OpcodeData(0x1A, "BYTE", opcodeByte, 2, 1, 3)
+    opcode[0x80] = OpcodeData(0x80, "DUP1", makeDup(1), 1, 2, 3)
+    opcode[0x81] = OpcodeData(0x81, "DUP2", makeDup(2), 2, 3, 3)
+    opcode[0x82] = OpcodeData(0x82, "DUP3", makeDup(3), 3, 4, 3)
+    opcode[0x83] = OpcodeData(0x83, "DUP4", makeDup(4), 4, 5, 3)
+    opcode[0x84] = OpcodeData(0x84, "DUP5", makeDup(5), 5, 6, 3)
+    opcode[0x85] = OpcodeData(0x85, "DUP6", makeDup(6), 6, 7, 3)
+    opcode[0x86] = OpcodeData(0x86, "DUP7", makeDup(7), 7, 8, 3)
+    opcode[0x87] = OpcodeData(0x87, "DUP8", makeDup(8), 8, 9, 3)
+    opcode[0x88] = OpcodeData(0x88, "DUP9", makeDup(9), 9, 10, 3)
+    opcode[0x89] = OpcodeData(0x89, "DUP10", makeDup(10), 10, 11, 3)
+    opcode[0x8a] = OpcodeData(0x8a, "DUP11", makeDup(11), 11, 12, 3)
+    opcode[0x8b] = OpcodeData(0x8b, "DUP12", makeDup(12), 12, 13, 3)
+    opcode[0x8c] = OpcodeData(0x8c, "DUP13", makeDup(13), 13, 14, 3)
+    opcode[0x8d] = OpcodeData(0x8d, "DUP14", makeDup(14), 14, 15, 3)
+    opcode[0x8e] = OpcodeData(0x8e, "DUP15", makeDup(15), 15, 16, 3)
+    opcode[0x8f] = OpcodeData(0x8f, "DUP16", makeDup(16), 16, 17, 3)
+    opcode[0x90] = OpcodeData(0x90, "SWAP1", makeSwap(1), 2, 2, 3)
+    opcode[0x91] = OpcodeData(0x91, "SWAP2", makeSwap(2), 3, 3, 3)
+    opcode[0x92] = OpcodeData(0x92, "SWAP3", makeSwap(3), 4, 4, 3)
+    opcode[0x93] = OpcodeData(0x93, "SWAP4", makeSwap(4), 5, 5, 3)
+    opcode[0x94] = OpcodeData(0x94, "SWAP5", makeSwap(5), 6, 6, 3)
+    opcode[0x95] = OpcodeData(0x95, "SWAP6", makeSwap(6), 7, 7, 3)
+    opcode[0x96] = OpcodeData(0x96, "SWAP7", makeSwap(7), 8, 8, 3)
+    opcode[0x97] = OpcodeData(0x97, "SWAP8", makeSwap(8), 9, 9, 3)
+    opcode[0x98] = OpcodeData(0x98, "SWAP9", makeSwap(9), 10, 10, 3)
+    opcode[0x99] = OpcodeData(0x99, "SWAP10", makeSwap(10), 11, 11, 3)
+    opcode[0x9a] = OpcodeData(0x9a, "SWAP11", makeSwap(11), 12, 12, 3)
+    opcode[0x9b] = OpcodeData(0x9b, "SWAP12", makeSwap(12), 13, 13, 3)
+    opcode[0x9c] = OpcodeData(0x9c, "SWAP13", makeSwap(13), 14, 14, 3)
+    opcode[0x9d] = OpcodeData(0x9d, "SWAP14", makeSwap(14), 15, 15, 3)
+    opcode[0x9e] = OpcodeData(0x9e, "SWAP15", makeSwap(15), 16, 16, 3)
+    opcode[0x9f] = OpcodeData(0x9f, "SWAP16", makeSwap(16), 17, 17, 3)
+    opcode[0xfe] = OpcodeData(0xfe, "INVALID", opcodeInvalid, 0, 0, 0)
+    opcode[0x58] = OpcodeData(0x58, "PC", makePC, 0, 1, 2)
+    opcode[0x5a] = OpcodeData(0x5a, "GAS", opcodeGas, 0, 1, 2)
+    opcode[0x56] = OpcodeData(0x56, "JUMP", opcodeJump, 1, 0, 8)
+    opcode[0x57] = OpcodeData(0x57, "JUMPI", opcodeJumpI, 2, 0, 10)
+    opcode[0x5B] = OpcodeData(0x5B, "JUMPDEST", opcodeJumpDest, 0, 0, 1)
+    opcode[0x52] = OpcodeData(0x52, "MSTORE", opcodeMstore, 2, 0, 3)
+    opcode[0x51] = OpcodeData(0x51, "MLOAD", opcodeMload, 1, 1, 3)
+    opcode[0x53] = OpcodeData(0x53, "MSTORE8", opcodeMstore8, 2, 0, 3)
+    opcode[0x59] = OpcodeData(0x59, "MSIZE", opcodeMsize, 0, 1, 2)
+    opcode[0x20] = OpcodeData(0x20, "SHA3", opcodeSha3, 2, 1, 30)
+    opcode[0x30] = OpcodeData(0x30, "ADDRESS", opcodeAddress, 0, 1, 2)
+    opcode[0x33] = OpcodeData(0x33, "CALLER", opcodeCaller, 0, 1, 2)
+    opcode[0x32] = OpcodeData(0x32, "ORIGIN", opcodeOrigin, 0, 1, 2)
+    opcode[0x3a] = OpcodeData(0x3a, "GASPRICE", opcodeGasPrice, 0, 1, 2)
+    opcode[0x48] = OpcodeData(0x48, "BASEFEE", opcodeBaseFee, 0, 1, 2)
+    opcode[0x41] = OpcodeData(0x41, "COINBASE", opcodeCoinbase, 0, 1, 2)
+    opcode[0x42] = OpcodeData(0x42, "TIMESTAMP", opcodeTimestamp, 0, 1, 2)
+    opcode[0x43] = OpcodeData(0x43, "NUMBER", opcodeNumber, 0, 1, 2)
+    opcode[0x44] = OpcodeData(0x44, "DIFFICULTY", opcodeDifficulty, 0, 1, 2)
+    opcode[0x45] = OpcodeData(0x45, "GASLIMIT", opcodeGasLimit, 0, 1, 2)
+    opcode[0x46] = OpcodeData(0x46, "CHAINID", opcodeChainId, 0, 1, 2)
+    opcode[0x40] = OpcodeData(0x40, "BLOCKHASH", opcodeBlockHash, 1, 1, 20)
+    opcode[0x31] = OpcodeData(0x31, "BALANCE", opcodeBalance, 1, 1, 100)
+    opcode[0x34] = OpcodeData(0x34, "CALLVALUE", opcodeCallValue, 0, 1, 2)
+    opcode[0x35] = OpcodeData(0x35, "CALLDATALOAD", opcodeCallDataLoad, 1, 1, 3)
+    opcode[0x36] = OpcodeData(0x36, "CALLDATASIZE", opcodeCallDataSize, 0, 1, 2)
+    opcode[0x37] = OpcodeData(0x37, "CALLDATACOPY", opcodeCallDataCopy, 3, 0, 3)
+    opcode[0x38] = OpcodeData(0x38, "CODESIZE", opcodeCodeSize, 0, 1, 2)
+    opcode[0x39] = OpcodeData(0x39, "CODECOPY", opcodeCodeCopy, 3, 0, 3)
+    opcode[0x3b] = OpcodeData(0x3b, "EXTCODESIZE", opcodeExtCodeSize, 1, 1, 100)
+    opcode[0x3c] = OpcodeData(0x3c, "EXTCODECOPY", opcodeExtCodeCopy, 4, 0, 100)
+    opcode[0x3f] = OpcodeData(0x3f, "EXTCODEHASH", opcodeExtCodeHash, 1, 1, 100)
+    opcode[0x47] = OpcodeData(0x47, "SELFBALANCE", opcodeSelfBalance, 0, 1, 5)
+    opcode[0x55] = OpcodeData(0x55, "SSTORE", opcodeSStore, 2, 0, 100)
+    opcode[0x54] = OpcodeData(0x54, "SLOAD", opcodeSLoad, 1, 1, 100)
+    opcode[0xa0] = OpcodeData(0xa0, "LOG0", makeLog(0), 2, 0, 375)
+    opcode[0xa1] = OpcodeData(0xa1, "LOG1", makeLog(1), 3, 0, 750)
+    opcode[0xa2] = OpcodeData(0xa2, "LOG2", makeLog(2), 4, 0, 1125)
+    opcode[0xa3] = OpcodeData(0xa3, "LOG3", makeLog(3), 5, 0, 1500)
+    opcode[0xa4] = OpcodeData(0xa4, "LOG4", makeLog(4), 6, 0, 1875)
+    opcode[0xf3] = OpcodeData(0xf3, "RETURN", opcodeReturn, 2, 0, 0)
+    opcode[0xfd] = OpcodeData(0xfd, "REVERT", opcodeRevert, 2, 0, 0)
+    opcode[0xf1] = OpcodeData(0xf1, "CALL", opcodeCall, 7, 1, 100)
+    opcode[0xf4] = OpcodeData(0xf4, "DELEGATECALL", opcodeDelegateCall, 6, 1, 100)
+    opcode[0xfa] = OpcodeData(0xfa, "STATICCALL", opcodeStaticCall, 6, 1, 100)
+    opcode[0x3d] = OpcodeData(0x3d, "RETURNDATASIZE", opcodeReturnDataSize, 0, 1, 2)
+    opcode[0x3e] = OpcodeData(0x3e, "RETURNDATACOPY", opcodeReturnDataCopy, 3, 0, 3)
+    return opcode
+
+def opcodeNotFound(ctx, inputParam):
+    return OPCODE_NOT_FOUND
+
+class Program:
+    # Code decoded once into an instruction table indexed by pc, so the run
+    # loop does not need to look up the opcode table or parse PUSH data.
+    # Every instruction start holds (handler, nextPc, opcodeDataObj), bytes
+    # which are PUSH data hold None. blocks is filled in by CodeAnalysis,
+    # see blockTable
+    def __init__(self, code, opcodes):
+        self.code = code
+        self.instructions = [None] * len(code)
+        # pc -> decoded PUSH immediate
+        self.immediates = {}
+        self.blocks = None
+        pc = 0
+        while pc < len(code):
+            op = code[pc]
+            nextPc = pc + 1
+            opcodeDataObj = opcodes.get(op)
+            if opcodeDataObj is None:
+                run = opcodeNotFound
+            elif op >= 0x60 and op <= 0x7f:
+                pushBytes = op - 0x60 + 1
+                data = code[nextPc:nextPc+pushBytes].ljust(pushBytes, b'\x00')
+                self.immediates[pc] = int.from_bytes(data, "big")
+                run = opcodeDataObj.run(self.immediates[pc])
+                nextPc += pushBytes
+            elif op == 0x58:
+                run = opcodeDataObj.run(pc)
+            else:
+                run = opcodeDataObj.run
+            self.instructions[pc] = (run, nextPc, opcodeDataObj)
+            pc = nextPc
+
+# Superinstructions: handlers running two adjacent instructions at once.
+# Each one leaves the stack, memory and pc exactly as the two original
+# handlers would, jump targets are validated when the program is fused
+def makePushJump(target, valid):
+    def opcodePushJump(ctx, inputParam):
+        if not valid:
+            return OPCODE_FAIL
+        ctx.pc = target
+        return OPCODE_CONTINUE
+    return opcodePushJump
+
+def makePushJumpI(target, valid):
+    def opcodePushJumpI(ctx, inputParam):
+        if ctx.stack.pop() > 0:
+            if not valid:
+                return OPCODE_FAIL
+            ctx.pc = target
+        return OPCODE_CONTINUE
+    return opcodePushJumpI
+
+def makePushAdd(data):
+    def opcodePushAdd(ctx, inputParam):
+        stack = ctx.stack.list
+        stack[-1] = (stack[-1] + data) & UINT256MAX
+        return OPCODE_CONTINUE
+    return opcodePushAdd
+
+def makePushMstore(offset):
+    def opcodePushMstore(ctx, inputParam):
+        ctx.memory.store(offset, ctx.stack.pop(), 32)
+        return OPCODE_CONTINUE
+    return opcodePushMstore
+
+def makePushMload(offset):
+    def opcodePushMload(ctx, inputParam):
+        ctx.stack.push(ctx.memory.load(offset))
+        return OPCODE_CONTINUE
+    return opcodePushMload
+
+def makeDupSwap(dupIndex, swapIndex):
+    def opcodeDupSwap(ctx, inputParam):
+        stack = ctx.stack.list
+        stack.append(stack[-dupIndex])
+        stack[-1], stack[-(swapIndex+1)] = stack[-(swapIndex+1)], stack[-1]
+        return OPCODE_CONTINUE
+    return opcodeDupSwap
+
+class FusedProgram:
+    # Program with common instruction pairs replaced by a superinstruction
+    # stored at the pc of the first one. The second instruction keeps its
+    # own entry, it is only skipped when running through the pair
+    def __init__(self, program, jumpDest, blocks):
+        self.code = program.code
+        self.instructions = list(program.instructions)
+        self.fused = 0
+        code = self.code
+        pc = 0
+        while pc < len(code):
+            run, nextPc, opcodeDataObj = self.instructions[pc]
+            if nextPc >= len(code) or opcodeDataObj is None:
+                pc = nextPc
+                continue
+            op = code[pc]
+            secondOp = code[nextPc]
+            _, afterPc, secondDataObj = self.instructions[nextPc]
+            fusedRun = None
+            if pc in program.immediates:
+                data = program.immediates[pc]
+                if secondOp == 0x56:
+                    fusedRun = makePushJump(data, data in jumpDest)
+                elif secondOp == 0x57:
+                    fusedRun = makePushJumpI(data, data in jumpDest)
+                elif secondOp == 0x01:
+                    fusedRun = makePushAdd(data)
+                elif secondOp == 0x52:
+                    fusedRun = makePushMstore(data)
+                elif secondOp == 0x51:
+                    fusedRun = makePushMload(data)
+            elif op >= 0x80 and op <= 0x8f and secondOp >= 0x90 and secondOp <= 0x9f:
+                fusedRun = makeDupSwap(op - 0x80 + 1, secondOp - 0x90 + 1)
+            if fusedRun is None:
+                pc = nextPc
+                continue
+            self.instructions[pc] = (fusedRun, afterPc, opcodeDataObj)
+            self.fused += 1
+            pc = afterPc
+        self.blocks = blockTable(self.instructions, blocks)
+
+class JitProgram:
+    # Program whose basic blocks are compiled to Python functions by jit.py.
+    # Each block start holds the compiled block with the end of the block
+    # as nextPc, so every block runs as one handler
+    def __init__(self, analysis):
+        program = analysis.program
+        self.code = program.code
+        self.instructions = list(program.instructions)
+        runtime = {
+            'M': UINT256MAX,
+            'OPCODE_CONTINUE': OPCODE_CONTINUE,
+            'OPCODE_STOP': OPCODE_STOP,
+            'OPCODE_FAIL': OPCODE_FAIL,
+        }
+        (self.source, compiled) = jit.compileProgram(program, analysis.blocks, analysis.jumpDest, runtime)
+        for block in analysis.blocks:
+            _, _, opcodeDataObj = program.instructions[block.start]
+            self.instructions[block.start] = (compiled[block.start], block.end, opcodeDataObj)
+        self.blocks = blockTable(self.instructions, analysis.blocks)
+
+# Opcodes after which execution does not fall through to the next instruction
+BLOCK_TERMINATORS = {0x00, 0x56, 0x57, 0xf3, 0xfd, 0xfe, 0xff}
+
+class BasicBlock:
+    # Straight-line run of instructions [start, end), only the first one can be
+    # a jump target and only the last one can leave the block
+    def __init__(self, start, end, instructions):
+        self.start = start
+        self.end = end
+        # Stack items the block needs on entry and the highest it grows above
+        # the entry height, from the pops/pushes of its opcodes
+        self.stackMin = 0
+        self.stackMax = 0
+        # Sum of the static gas of its opcodes, paid once on entry
+        self.gas = 0
+        height = 0
+        pc = start
+        while pc < end:
+            run, nextPc, opcodeDataObj = instructions[pc]
+            if opcodeDataObj is not None:
+                self.stackMin = max(self.stackMin, opcodeDataObj.pops - height)
+                height += opcodeDataObj.pushes - opcodeDataObj.pops
+                self.stackMax = max(self.stackMax, height)
+                self.gas += opcodeDataObj.gas
+            pc = nextPc
+        # Highest entry height which cannot overflow the stack in the block
+        self.stackLimit = MAXSTACKSIZE - self.stackMax
+
+def blockTable(instructions, blocks):
+    # pc -> (end, stackMin, stackLimit, gas, handlers) for every block start,
+    # this is what the run loops execute
+    table = [None] * len(instructions)
+    for block in blocks:
+        runs = []
+        pc = block.start
+        while pc < block.end:
+            run, nextPc, _ = instructions[pc]
+            runs.append(run)
+            pc = nextPc
+        table[block.start] = (block.end, block.stackMin, block.stackLimit, block.gas, runs)
+    return table
+
+class CodeAnalysis:
+    # Everything derived from the code alone, computed once per contract.
+    # Threads sharing an analysis may both build the fused or compiled
+    # program the first time, either result is the same
+    def __init__(self, code, opcodes):
+        self.code = code
+        self.jumpDest = frozenset(Utils.scanForJumpDest(code))
+        self.program = Program(code, opcodes)
+        self.blocks = self._scanBlocks()
+        self._bindGas()
+        self.program.blocks = blockTable(self.program.instructions, self.blocks)
+        self._fusedProgram = None
+        self._jitProgram = None
+        # Number of runs of this code, decides when it gets compiled
+        self.executions = 0
+
+    # Built on first use, only engines with fuse enabled need it
+    def fusedProgram(self):
+        if self._fusedProgram is None:
+            self._fusedProgram = FusedProgram(self.program, self.jumpDest, self.blocks)
+        return self._fusedProgram
+
+    def jitProgram(self):
+        if self._jitProgram is None:
+            self._jitProgram = JitProgram(self)
+        return self._jitProgram
+
+    # Give every GAS and SSTORE the static cost of the instructions after it
+    # in its block, see makeGas and makeSStore
+    def _bindGas(self):
+        instructions = self.program.instructions
+        for block in self.blocks:
+            pc = block.start
+            while pc < block.end:
+                run, nextPc, opcodeDataObj = instructions[pc]
+                if self.code[pc] in (0x5a, 0x55) and opcodeDataObj is not None:
+                    refund = 0
+                    after = nextPc
+                    while after < block.end:
+                        _, afterNext, afterDataObj = instructions[after]
+                        refund += afterDataObj.gas if afterDataObj is not None else 0
+                        after = afterNext
+                    if self.code[pc] == 0x5a:
+                        instructions[pc] = (makeGas(refund), nextPc, opcodeDataObj)
+                    else:
+                        instructions[pc] = (makeSStore(refund + opcodeDataObj.gas), nextPc, opcodeDataObj)
+                pc = nextPc
+
+    def _scanBlocks(self):
+        blocks = []
+        start = 0
+        pc = 0
+        instructions = self.program.instructions
+        while pc < len(instructions):
+            run, nextPc, opcodeDataObj = instructions[pc]
+            # JUMPDEST starts a new block
+            if pc in self.jumpDest and pc != start:
+                blocks.append(BasicBlock(start, pc, instructions))
+                start = pc
+            if opcodeDataObj is None or self.code[pc] in BLOCK_TERMINATORS:
+                blocks.append(BasicBlock(start, nextPc, instructions))
+                start = nextPc
+            pc = nextPc
+        if start < pc:
+            blocks.append(BasicBlock(start, pc, instructions))
+        return blocks
+
+class AnalysisCache:
+    # Bounded LRU of CodeAnalysis keyed by the code bytes, decoded with the
+    # opcode table of the engine owning the cache. Keying by the code needs
+    # no keccak, so code which never hashes never loads the keccak backend.
+    # Safe to use from several threads, the analysis itself is built outside
+    # of the lock
+    def __init__(self, opcodes, maxSize=256):
+        self.opcodes = opcodes
+        self.maxSize = maxSize
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get(self, code):
+        with self.lock:
+            analysis = self.entries.get(code)
+            if analysis is not None:
+                self.hits += 1
+                self.entries.move_to_end(code)
+                return analysis
+            self.misses += 1
+        analysis = CodeAnalysis(code, self.opcodes)
+        with self.lock:
+            # another thread may have added it meanwhile, keep the first one
+            analysis = self.entries.setdefault(code, analysis)
+            self.entries.move_to_end(code)
+            if len(self.entries) > self.maxSize:
+                self.entries.popitem(last=False)
+        return analysis
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+class KeccakCache:
+    # Bounded LRU of keccak digests keyed by the exact preimage bytes.
+    # Preimages longer than maxPreimage are hashed without being cached, so
+    # the cache holds at most maxSize * maxPreimage bytes of keys. Safe to
+    # use from several threads
+    def __init__(self, maxSize=4096, maxPreimage=1024):
+        self.maxSize = maxSize
+        self.maxPreimage = maxPreimage
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        # preimages too long to be cached
+        self.uncached = 0
+        self.lock = threading.Lock()
+
+    # data can be bytes or a memoryview of memory
+    def digest(self, data):
+        if len(data) > self.maxPreimage:
+            self.uncached += 1
+            return keccak(bytes(data))
+        key = bytes(data)
+        with self.lock:
+            digest = self.entries.get(key)
+            if digest is not None:
+                self.hits += 1
+                self.entries.move_to_end(key)
+                return digest
+            self.misses += 1
+        digest = keccak(key)
+        with self.lock:
+            self.entries[key] = digest
+            if len(self.entries) > self.maxSize:
+                self.entries.popitem(last=False)
+        return digest
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+# Run loop used when a tracer is attached, runs the instructions one by one
+# and calls tracer.step before each of them
+def runProgramTraced(ctx, inputParam, program, tracer):
+    instructions = program.instructions
+    blocks = program.blocks
+    code = program.code
+    codeLen = len(blocks)
+    stack = ctx.stack.list
+    meter = ctx.gas
+    step = tracer.step
+    response = OPCODE_STOP
+    pc = ctx.pc
+    try:
+        while pc < codeLen:
+            end, stackMin, stackLimit, gas, runs = blocks[pc]
+            height = len(stack)
+            if height < stackMin or height > stackLimit:
+                return (pc, OPCODE_FAIL)
+            # static gas of the block not used up by the steps so far, the
+            # tracer sees the gas left as if it was charged per instruction
+            pending = 0
+            if meter.metered:
+                meter.left -= gas
+                if meter.left < 0:
+                    return (pc, outOfGas(ctx))
+                pending = gas
+            ctx.pc = end
+            while pc < end:
+                run, nextPc, opcodeDataObj = instructions[pc]
+                step(ctx, pc, code[pc], opcodeDataObj, meter.left + pending)
+                if pending and opcodeDataObj is not None:
+                    pending -= opcodeDataObj.gas
+                response = run(ctx, inputParam)
+                if response.stopRun:
+                    return (pc, response)
+                pc = nextPc
+            pc = ctx.pc
+    except OutOfGas:
+        return (pc, outOfGas(ctx))
+    return (pc, response)
+
+# Run loop used when a profiler is attached, times every handler and tracks
+# the peak stack depth and memory size of the execution. Calls made by a
+# handler run in a frame of their own, their time is taken off the handler's
+def runProgramProfiled(ctx, inputParam, program, profiler):
+    instructions = program.instructions
+    blocks = program.blocks
+    code = program.code
+    codeLen = len(blocks)
+    stack = ctx.stack.list
+    memory = ctx.memory
+    meter = ctx.gas
+    record = profiler.record
+    frame = profiler.enter()
+    clock = time.perf_counter_ns
+    count = 0
+    peakStack = len(stack)
+    peakMemory = memory.size
+    response = OPCODE_STOP
+    pc = ctx.pc
+    started = clock()
+    try:
+        while pc < codeLen:
+            end, stackMin, stackLimit, gas, runs = blocks[pc]
+            height = len(stack)
+            if height < stackMin or height > stackLimit:
+                response = OPCODE_FAIL
+                return (pc, response)
+            if meter.metered:
+                meter.left -= gas
+                if meter.left < 0:
+                    response = outOfGas(ctx)
+                    return (pc, response)
+            ctx.pc = end
+            while pc < end:
+                run, nextPc, opcodeDataObj = instructions[pc]
+                start = clock()
+                response = run(ctx, inputParam)
+                elapsed = clock() - start
+                if frame.childTime:
+                    elapsed -= frame.childTime
+                    frame.childTime = 0
+                record(code[pc], elapsed)
+                count += 1
+                if len(stack) > peakStack:
+                    peakStack = len(stack)
+                if memory.size > peakMemory:
+                    peakMemory = memory.size
+                if response.stopRun:
+                    return (pc, response)
+                pc = nextPc
+            pc = ctx.pc
+    except OutOfGas:
+        response = outOfGas(ctx)
+        return (pc, response)
+    finally:
+        profiler.exit(frame, count, clock() - started, peakMemory, peakStack, response.success)
+    return (pc, response)
 
 class outputStackFormat(Enum):
     MultipleLine = 1
     SingleLine = 2
 
-def evm(code, outStackFormat, tx, block, state):
-    global testsRun, testsMax
-    if testsRun >= testsMax:
-        print(f'Implemented {len(opcode)} opcodes ')
-        sys.exit()
-    testsRun+=1
-
-    success = None
-    calldata = tx.get('data', "") if tx else ""
-    callStack = CallStack(code)
-    callStack.call(calldata)
-    # Create state
-    stateDict = {}
-    for address, values in state.items():
-        stateDict[int(address,16)] = Account(None, None, None)
-        if 'balance' in values:
-            stateDict[int(address,16)].balance = int(values['balance'], 16)
-        if 'code' in values:
-            stateDict[int(address,16)].codeAsm = values['code']['asm']
-            stateDict[int(address,16)].codeBin = values['code']['bin']
-
-    inputParam = InputParam(Opcode=None, Txn=tx, Block=block, State=stateDict)
-
-    ctx = callStack.currentCtx()
-    while ctx.pc < len(ctx.code):
-        op = ctx.code[ctx.pc]
-        # pc will always increment by 1 here
-        # pc can also be incremented in PUSH opcodes
-        ctx.pc += 1
-        opcodeDataObj = opcode.get(op)
-        if opcodeDataObj:
-            prehook(opcodeDataObj)
-            # Use the same object for all opcodes, so txn etc will be retained
-            inputParam.Opcode = opcodeDataObj.opcode
-            opcodeReturn = opcodeDataObj.run(ctx, inputParam)
-            success = opcodeReturn.success
-            if opcodeReturn.stopRun == True:
-                break
+class EVM:
+    # Execution engine, owns its configuration, opcode table, code analysis
+    # cache and hooks. Everything an execution changes lives in its own
+    # contexts and world state, so one engine can run code from several
+    # threads at once. Hooks are called from every thread running on it.
+    #   fuse           run common instruction pairs as one superinstruction
+    #                  (see FusedProgram)
+    #   jitThreshold   compile contracts to Python functions (see JitProgram)
+    #                  once they ran more than this many times, 0 compiles
+    #                  them before the first run and None never
+    #   tracer         gets every instruction, see tracer.py
+    #   profiler       times every opcode, see profiler.py
+    #   opcodes        opcode table, defaultOpcodes() when not given
+    # SHA3 and code hashes go through keccakCache, see KeccakCache
+    def __init__(self, fuse=False, jitThreshold=100, tracer=None, profiler=None, opcodes=None,
+                 analysisCacheSize=256, keccakCacheSize=4096):
+        self.fuse = fuse
+        self.jitThreshold = jitThreshold
+        self.tracer = tracer
+        self.profiler = profiler
+        self.opcodes = opcodes if opcodes is not None else defaultOpcodes()
+        self.analysisCache = AnalysisCache(self.opcodes, analysisCacheSize)
+        self.keccakCache = KeccakCache(keccakCacheSize)
+
+    # Picks the run loop once per execution, nested calls run with the same one
+    def selectRunner(self, metered, budget=None):
+        tracer = self.tracer
+        profiler = self.profiler
+        if tracer is not None:
+            # the tracer has to see every instruction, so never run fused pairs
+            # or compiled blocks
+            def runner(ctx, inputParam, analysis):
+                return runProgramTraced(ctx, inputParam, analysis.program, tracer)
+        elif profiler is not None:
+            # timed per opcode, so no fused pairs or compiled blocks either
+            def runner(ctx, inputParam, analysis):
+                return runProgramProfiled(ctx, inputParam, analysis.program, profiler)
         else:
-            print("Opcode implementation not found for ", hex(op))
+            jitThreshold = self.jitThreshold
+            fuse = self.fuse
+            def programOf(analysis):
+                analysis.executions += 1
+                if jitThreshold is not None and analysis.executions > jitThreshold:
+                    return analysis.jitProgram()
+                elif fuse:
+                    return analysis.fusedProgram()
+                return analysis.program
+            if budget is not None:
+                def runner(ctx, inputParam, analysis):
+                    return runProgramBudgeted(ctx, inputParam, programOf(analysis), analysis.program.blocks, budget)
+            else:
+                run = runProgramMetered if metered else runProgram
+                def runner(ctx, inputParam, analysis):
+                    return run(ctx, inputParam, programOf(analysis))
+        return runner
+
+    # One execution of `code` against `state`, the test's state mapping, a
+    # BaseState or a DiskState. Returns (success, stack, logsReturnOutput).
+    # commit=False keeps the changes of a successful run from the state, e.g.
+    # for eth_call. A Budget raises BudgetExceeded once the execution used
+    # it up, it is not checked while a tracer or profiler is attached
+    def execute(self, code, outStackFormat, tx, block, state, commit=True, budget=None):
+        # tx, block and account code are hex in the tests, parse them once here
+        txEnv = TxEnv(tx)
+        blockEnv = BlockEnv(block)
+        # Gas is only metered when the tx has a limit
+        gas = GasMeter(txEnv.gas)
+        gas.warmAddresses.update((txEnv.caller, txEnv.origin, txEnv.to))
+        # Create state, a BaseState built once or a DiskState can be passed
+        # instead of the mapping to share it between runs
+        if not isinstance(state, (BaseState, DiskState)):
+            state = BaseState.fromJson(state)
+        world = WorldState(state)
+
+        callStack = CallStack(code, world, self)
+        callStack.runner = self.selectRunner(gas.metered, budget)
+        ctx = callStack.call(txEnv.data, gas, txEnv.to, txEnv.caller, txEnv.value)
+
+        # Use the same object for all opcodes, so txn etc will be retained
+        inputParam = InputParam(Opcode=None, Txn=txEnv, Block=blockEnv, State=world, Calls=callStack)
+
+        tracer = self.tracer
+        if tracer is not None:
+            tracer.enter(ctx)
+        if budget is not None:
+            budget.start()
+        (pc, opcodeReturn) = callStack.runner(ctx, inputParam, callStack.analysis)
+        if opcodeReturn is OPCODE_NOT_FOUND:
+            if tracer is not None:
+                tracer.exit(ctx, False, None, gas.used())
             # return fake success but empty stack and logs so that test case
-            # panics with proper test name and error message
+            # panics with proper test name and error message, test() names
+            # the opcode
             return (True, [], None)
+        success = opcodeReturn.success
+        if not success:
+            # nothing a failed run did to the state is kept
+            world.revert(0)
+            # Failures other than REVERT consume all gas
+            if opcodeReturn.data is None:
+                gas.left = 0
+        elif commit:
+            world.commit()
+
+        stackOutput=[]
+        logsReturnOutput = {}
+        if gas.metered:
+            logsReturnOutput['gasUsed'] = gas.used()
+        if world.logs:
+            logsReturnOutput['logs'] = [{'address':f'0x{logs.address:040x}', 'data':logs.data.hex(), 'topics':logs.topics}
+                                        for logs in world.logs]
+        returnData = opcodeReturn.data.get('returnData', None) if opcodeReturn.data else None
+        logsReturnOutput['returnData'] = returnData.hex() if returnData is not None else None
+        if tracer is not None:
+            tracer.exit(ctx, success, logsReturnOutput['returnData'], gas.used())
+
+        if outStackFormat == outputStackFormat.MultipleLine:
+            while ctx.stack.len():
+                stackOutput.append(ctx.stack.pop())
+        else:
+            # Default output stack format is outputStackFormat.SingleLine
+            tempList = [f'{i:x}' for i in ctx.stack.elements()]
+            if len(tempList): stackOutput.append(int(''.join(tempList), 16))
 
-    stackOutput=[]
-    logsReturnOutput = {}
-    if opcodeReturn.data:
-        if 'logs' in opcodeReturn.data:
-            to = opcodeReturn.data['logs'].address
-            data = opcodeReturn.data['logs'].data
-            topics = opcodeReturn.data['logs'].topics
-            logs = []
-            logs.append({'address':to, 'data':data, 'topics':topics})
-            logsReturnOutput['logs'] = logs
-        logsReturnOutput['returnData'] = opcodeReturn.data.get('returnData', None)
-
-    if outStackFormat == outputStackFormat.MultipleLine:
-        while ctx.stack.len():
-            stackOutput.append(ctx.stack.pop())
-    else:
-        # Default output stack format is outputStackFormat.SingleLine
-        tempList = [f'{i:x}' for i in ctx.stack.elements()]
-        print('result in hex ', ''.join(tempList))
-        if len(tempList): stackOutput.append(int(''.join(tempList), 16))
-
-    return (success, stackOutput, logsReturnOutput)
-
-def test():
-    script_dirname = os.path.dirname(os.path.abspath(__file__))
-    json_file = os.path.join(script_dirname, "..", "evm.json")
-    with open(json_file) as f:
-        data = json.load(f)
-        total = len(data)
-
-        for i, test in enumerate(data):
-            # Note: as the test cases get more complex, you'll need to modify this
-            # to pass down more arguments to the evm function
-            tx = test.get('tx', None)
-            block = test.get('block', None)
-            state = test.get('state', {})
-
-            code = bytes.fromhex(test['code']['bin'])
-
-            testStackFormat = test['expect'].get('stack', [])
-            if len(testStackFormat) > 1:
-                testStackFormat = outputStackFormat.MultipleLine
-            else:
-                testStackFormat = outputStackFormat.SingleLine
-
-            (success, stack, logsReturnOutput) = evm(code, testStackFormat, tx, block, state)
-
-            logOutput = test['expect'].get('logs', None)
-            returnOutput = test['expect'].get('return', None)
-            if logOutput:
-                expectedInput = test['expect']['logs']
-                expectedOutput = logsReturnOutput['logs']
-                errorFormat = 'Log'
-            elif returnOutput:
-                expectedInput = test['expect']['return']
-                expectedOutput = logsReturnOutput['returnData']
-                errorFormat = 'Return Data'
-            else:
-                expectedInput = [int(x, 16) for x in test['expect']['stack']]
-                expectedOutput = stack
-                errorFormat = 'Stack'
-            
-            if expectedOutput != expectedInput or success != test['expect']['success']:
-                print(f"❌ Test #{i + 1}/{total} {test['name']}")
-                if expectedOutput != expectedInput:
-                    print(f"{errorFormat} doesn't match")
-                    print(" expected:", expectedInput)
-                    print("   actual:", expectedOutput)
-                else:
-                    print("Success doesn't match")
-                    print(" expected:", test['expect']['success'])
-                    print("   actual:", success)
-                print("")
-                print("Test code:")
-                print(test['code']['asm'])
-                print("")
-                print("Hint:", test['hint'])
-                print("")
-                print(f"Progress: {i}/{len(data)}")
-                print("")
-                break
-            else:
-                print(f"✓  Test #{i + 1}/{total} {test['name']}")
+        return (success, stackOutput, logsReturnOutput)
 
-if __name__ == '__main__':
-    if singleBin is None:
-        test()
-    else:
-        print('Run custom single test')
-        evm(bytes.fromhex(singleBin), 1, None, None, {})
+# Engine used by evm() and by callers which do not create their own
+defaultEngine = EVM()
+
+def evm(code, outStackFormat, tx, block, state):
+    return defaultEngine.execute(code, outStackFormat, tx, block, state)
+
+# Opcodes in `code` which are not in the engine's opcode table
+def missingOpcodes(engine, code):
+    program = engine.analysisCache.get(code).program
+    return {code[pc] for pc, instruction in enumerate(program.instructions)
+            if instruction is not None and instruction[2] is None}
+
+# Runs the tests of evm.json on `engine` until the first failure, at most
+# testsMax of them. Tests are read with fixtures.load, which streams the
+# file and keeps a parsed cache of it next to the file
+def test(engine=None, testsMax=None, path=None):
+    import fixtures
+    if engine is None:
+        engine = defaultEngine
+    if path is None:
+        script_dirname = os.path.dirname(os.path.abspath(__file__))
+        path = os.path.join(script_dirname, "..", "evm.json")
+
+    for i, test in enumerate(fixtures.load(path)):
+        if testsMax is not None and i >= testsMax:
+            print(f'Implemented {len(engine.opcodes)} opcodes ')
+            break
+
+        mismatch = fixtures.compare(test, engine.execute(test.code, test.stackFormat, test.tx, test.block, test.state))
+
+        if mismatch is not None:
+            (what, expected, actual) = mismatch
+            print(f"❌ Test #{i + 1} {test.name}")
+            print(f"{what} doesn't match")
+            print(" expected:", expected)
+            print("   actual:", actual)
+            print("")
+            print("Test code:")
+            print(test.asm)
+            print("")
+            print("Hint:", test.hint)
+            print("")
+            for op in sorted(missingOpcodes(engine, test.code)):
+                print("Opcode implementation not found for ", hex(op))
+            print(f"Progress: {i} passed")
+            print("")
+            break
+        else:
+            print(f"✓  Test #{i + 1} {test.name}")
+
+class Options:
+    def __init__(self):
+        # some random high number so that by default all test cases will run
+        self.testsMax = 1000
+        # singleBin which contains code binary to run
+        self.singleBin = None
+        self.fuse = False
+        self.jitThreshold = 100
+        # trace=<file> writes an EIP-3155 JSON lines trace of the test run
+        self.tracePath = None
+        # profile=<file> writes the profile when the run ends, as Prometheus
+        # text for .prom files and JSON otherwise
+        self.profilePath = None
+
+# Arguments can be combined, e.g. `evm.py fuse 11` or `evm.py jit=0`
+def parseArgs(args):
+    options = Options()
+    for arg in args:
+        if arg == 'fuse':
+            options.fuse = True
+        elif arg.startswith('jit='):
+            value = arg.split('=')[1]
+            options.jitThreshold = None if value == 'off' else int(value)
+        elif arg.startswith('trace='):
+            options.tracePath = arg.split('=', 1)[1]
+        elif arg.startswith('profile='):
+            options.profilePath = arg.split('=', 1)[1]
+        elif arg.startswith('test='):
+            options.singleBin = arg.split('=')[1]
+        else:
+            # control the test cases numbers here
+            options.testsMax = int(arg)
+    return options
+
+def main(args):
+    options = parseArgs(args)
+    engine = EVM(fuse=options.fuse, jitThreshold=options.jitThreshold)
+    # hooks are imported when they are used
+    if options.tracePath is not None or options.singleBin is not None:
+        from tracer import JsonTracer
+        # trace to stdout unless trace=<file> was given
+        engine.tracer = JsonTracer(options.tracePath if options.tracePath is not None else sys.stdout)
+    if options.profilePath is not None:
+        from profiler import Profiler
+        engine.profiler = Profiler(engine.opcodes, histograms=True)
+    # write the trace and profile even when a test crashes
+    try:
+        if options.singleBin is None:
+            test(engine, options.testsMax)
+        else:
+            print('Run custom single test')
+            code = bytes.fromhex(options.singleBin)
+            (success, stack, logsReturnOutput) = engine.execute(code, outputStackFormat.MultipleLine, None, None, {})
+            for op in sorted(missingOpcodes(engine, code)):
+                print("Opcode implementation not found for ", hex(op))
+            print('success', success)
+            # the stack from the bottom up, top of the stack last
+            print('result in hex ', ''.join(f'{i:x}' for i in reversed(stack)))
+            if logsReturnOutput and logsReturnOutput['returnData'] is not None:
+                print('return data ', logsReturnOutput['returnData'])
+    finally:
+        if engine.tracer is not None:
+            engine.tracer.close()
+        if engine.profiler is not None:
+            engine.profiler.save(options.profilePath)
@@ -0,0 +1,216 @@
+# Test fixture loading for EVM From Scratch
+#
+# load(path) yields one Fixture per test of an evm.json style file, with
+# the code decoded, the state parsed into a BaseState and the expectations
+# parsed, so the runner does no conversions of its own.
+#
+# The JSON is read incrementally: the first test is yielded as soon as it
+# has been read, not after the whole file was parsed. Files can hold a list
+# of tests (evm.json) or an object of tests by name (ethereum/tests style,
+# the name goes into the test).
+#
+# Parsed fixtures are also written to a binary cache next to the file,
+# <file>.cache, as pickles of up to CACHE_BATCH fixtures after a header
+# holding the SHA-256 of the JSON file (batches share the pickle memo, one
+# pickle per fixture loads at half the speed). The next load of an unchanged file reads the
+# cache instead of the JSON, any change of the file rebuilds it. The cache
+# is a pickle, only use it for files you trust as much as the code.
+#
+# compare(fixture, result) checks a result of EVM.execute against the
+# expectations of a fixture, for test() in evm.py and conformance.py.
+
+import hashlib
+import json
+import os
+import pickle
+
+import evm
+
+CACHE_VERSION = 4
+CACHE_BATCH = 64
+CHUNK_SIZE = 1 << 16
+
+class Fixture:
+    def __init__(self, test):
+        self.name = test['name']
+        # identifies the test's content, unchanged by reordering or renaming
+        # other tests of the file
+        self.digest = hashlib.sha256(json.dumps(test, sort_keys=True).encode()).hexdigest()
+        self.hint = test.get('hint', '')
+        self.asm = test['code'].get('asm', '')
+        self.code = bytes.fromhex(test['code']['bin'])
+        self.tx = test.get('tx', None)
+        self.block = test.get('block', None)
+        self.state = evm.BaseState.fromJson(test.get('state', {}))
+        expect = test['expect']
+        self.success = expect['success']
+        self.stack = [int(x, 16) for x in expect.get('stack', [])]
+        self.logs = expect.get('logs', None)
+        self.returnData = expect.get('return', None)
+        # the tests list a single stack item as one number
+        if len(self.stack) > 1:
+            self.stackFormat = evm.outputStackFormat.MultipleLine
+        else:
+            self.stackFormat = evm.outputStackFormat.SingleLine
+
+# None when `result` of EVM.execute is what the fixture expects, otherwise
+# (what did not match, expected, actual)
+def compare(fixture, result):
+    (success, stack, logsReturnOutput) = result
+    if fixture.logs:
+        expected, actual, what = fixture.logs, logsReturnOutput['logs'], 'Log'
+    elif fixture.returnData:
+        expected, actual, what = fixture.returnData, logsReturnOutput['returnData'], 'Return Data'
+    else:
+        expected, actual, what = fixture.stack, stack, 'Stack'
+    if actual != expected:
+        return what, expected, actual
+    if success != fixture.success:
+        return 'Success', fixture.success, success
+    return None
+
+def readJson(path):
+    # Yields the tests of a JSON file one by one while reading it
+    decoder = json.JSONDecoder()
+    with open(path, encoding='utf-8') as f:
+        buffer = ''
+        pos = 0
+        eof = False
+
+        def more():
+            # Reads the next chunk, keeping what was not consumed yet. A
+            # value longer than a chunk doubles the read size, so it is
+            # decoded a few times and not once per chunk
+            nonlocal buffer, pos, eof
+            chunk = f.read(max(CHUNK_SIZE, len(buffer) - pos))
+            if not chunk:
+                eof = True
+            buffer = buffer[pos:] + chunk
+            pos = 0
+
+        def skip(chars):
+            # Skips whitespace and any of `chars`, returns the next
+            # character or '' at the end of the file
+            nonlocal pos
+            while True:
+                while pos < len(buffer) and (buffer[pos].isspace() or buffer[pos] in chars):
+                    pos += 1
+                if pos < len(buffer) or eof:
+                    return buffer[pos] if pos < len(buffer) else ''
+                more()
+
+        def value():
+            # Decodes the next JSON value, reading more until it is complete
+            nonlocal pos
+            while True:
+                try:
+                    result, end = decoder.raw_decode(buffer, pos)
+                except json.JSONDecodeError:
+                    if eof:
+                        raise
+                    more()
+                    continue
+                # a number can continue in the next chunk
+                if end == len(buffer) and not eof:
+                    more()
+                    continue
+                pos = end
+                return result
+
+        first = skip('')
+        if first not in ('[', '{'):
+            raise ValueError(f'{path}: expected a list or an object of tests')
+        pos += 1
+        while True:
+            char = skip(',')
+            if char in (']', '}'):
+                return
+            if char == '':
+                raise ValueError(f'{path}: unexpected end of file')
+            if first == '[':
+                yield value()
+            else:
+                name = value()
+                skip(':')
+                test = value()
+                test.setdefault('name', name)
+                yield test
+
+def fileHash(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def readCache(cachePath, source):
+    # Yields the cached fixtures, nothing when the cache is missing or was
+    # built from another version of the file
+    try:
+        f = open(cachePath, 'rb')
+    except OSError:
+        return
+    with f:
+        try:
+            header = pickle.load(f)
+        except Exception:
+            return
+        if header != {'version': CACHE_VERSION, 'source': source}:
+            return
+        while True:
+            batch = pickle.load(f)
+            if batch is None:
+                return
+            yield from batch
+
+def load(path, cache=True):
+    if not cache:
+        for test in readJson(path):
+            yield Fixture(test)
+        return
+    source = fileHash(path)
+    cachePath = path + '.cache'
+    cached = readCache(cachePath, source)
+    first = next(cached, None)
+    if first is not None:
+        yield first
+        yield from cached
+        return
+    # build the cache while yielding, written to a temporary file and
+    # renamed so a half written cache is never read
+    tempPath = f'{cachePath}.{os.getpid()}.tmp'
+    try:
+        out = open(tempPath, 'wb')
+    except OSError:
+        out = None
+    tests = readJson(path)
+    batch = []
+    complete = False
+    try:
+        if out is not None:
+            pickle.dump({'version': CACHE_VERSION, 'source': source}, out, pickle.HIGHEST_PROTOCOL)
+        for test in tests:
+            fixture = Fixture(test)
+            if out is not None:
+                batch.append(fixture)
+                if len(batch) == CACHE_BATCH:
+                    pickle.dump(batch, out, pickle.HIGHEST_PROTOCOL)
+                    batch = []
+            yield fixture
+        complete = True
+    finally:
+        if out is not None:
+            try:
+                # the caller may stop early, e.g. at the first failing test,
+                # the cache still gets every fixture
+                if not complete:
+                    batch.extend(Fixture(test) for test in tests)
+                if batch:
+                    pickle.dump(batch, out, pickle.HIGHEST_PROTOCOL)
+                pickle.dump(None, out)
+                out.close()
+                os.replace(tempPath, cachePath)
+            except Exception:
+                out.close()
+                if os.path.exists(tempPath):
+                    os.remove(tempPath)
@@ -0,0 +1,225 @@
+# Basic-block compiler for EVM From Scratch
+#
+# Every basic block of a contract is turned into the source of one Python
+# function. Stack items produced and consumed inside the block live in local
+# variables, only what is left over at the end of the block (or before an
+# opcode which still goes through its handler) is written to the real stack.
+#
+# The run loop checks the stack height against the block's stackMin and
+# stackLimit and charges the block's static gas before calling the compiled
+# function, so the generated code can pop and push without any checks.
+# Dynamic gas is charged where it comes up: memory expansion inside Memory,
+# everything else (SLOAD, SSTORE, ...) by running the opcode's handler. Both
+# can run out of gas, so the virtual stack is written back before them and a
+# failed run leaves the stack as the interpreter does.
+#
+# This module does not import evm.py, the caller passes everything the
+# generated code needs in `runtime`:
+#   M                UINT256MAX
+#   OPCODE_CONTINUE, OPCODE_STOP, OPCODE_FAIL
+
+# a is the top of the stack, b the item below it, same as in the handlers
+BINARY = {
+    0x01: '({a} + {b}) & M',
+    0x02: '({a} * {b}) & M',
+    0x03: '({a} - {b}) & M',
+    0x06: '{a} % {b} if {b} else 0',
+    0x10: '1 if {a} < {b} else 0',
+    0x11: '1 if {a} > {b} else 0',
+    0x14: '1 if {a} == {b} else 0',
+    0x16: '{a} & {b}',
+    0x17: '{a} | {b}',
+    0x18: '{a} ^ {b}',
+    0x1b: '({b} << {a}) & M if {a} <= 255 else 0',
+    0x1c: '{b} >> {a} if {a} <= 255 else 0',
+}
+
+UNARY = {
+    0x15: '0 if {a} else 1',
+    0x19: '{a} ^ M',
+}
+
+class BlockCompiler:
+    def __init__(self, program, block, jumpDest, runtime):
+        self.program = program
+        self.block = block
+        self.jumpDest = jumpDest
+        self.runtime = runtime
+        self.lines = []
+        # Values pushed by the block which are not on the real stack yet,
+        # either an int constant or the name of a local
+        self.virtual = []
+        self.locals = 0
+
+    def emit(self, line):
+        self.lines.append('    ' + line)
+
+    def newLocal(self, expr):
+        name = f'v{self.locals}'
+        self.locals += 1
+        self.emit(f'{name} = {expr}')
+        return name
+
+    def render(self, item):
+        return hex(item) if isinstance(item, int) else item
+
+    # Move items from the real stack below the virtual ones until the
+    # virtual stack holds at least `count` items
+    def ensure(self, count):
+        while len(self.virtual) < count:
+            self.virtual.insert(0, self.newLocal('pop()'))
+
+    def pop(self):
+        self.ensure(1)
+        return self.virtual.pop()
+
+    def flush(self):
+        if len(self.virtual) == 1:
+            self.emit(f'push({self.render(self.virtual[0])})')
+        elif self.virtual:
+            items = ', '.join(self.render(i) for i in self.virtual)
+            self.emit(f'stack.extend(({items}))')
+        self.virtual = []
+
+    def operation(self, template, **operands):
+        if all(isinstance(v, int) for v in operands.values()):
+            # constant folding, every operand came from a PUSH
+            return eval(template.format(**{k: hex(v) for k, v in operands.items()}),
+                        {'M': self.runtime['M']})
+        return self.newLocal(template.format(**{k: self.render(v) for k, v in operands.items()}))
+
+    def callHandler(self, pc, run):
+        self.flush()
+        name = f'h{pc}'
+        self.runtime[name] = run
+        self.emit(f'r = {name}(ctx, inputParam)')
+        self.emit('if r is not OPCODE_CONTINUE and r.stopRun:')
+        self.emit('    return r')
+
+    def jump(self, target, condition=None):
+        # ctx.pc already points to the end of the block, only change it when
+        # the jump is taken. Targets known at compile time are checked here
+        indent = ''
+        if condition is not None:
+            self.emit(f'if {self.render(condition)}:')
+            indent = '    '
+        if isinstance(target, int):
+            if target in self.jumpDest:
+                self.emit(f'{indent}ctx.pc = {hex(target)}')
+            else:
+                self.emit(f'{indent}return OPCODE_FAIL')
+        else:
+            self.emit(f'{indent}if {target} not in jumpDest:')
+            self.emit(f'{indent}    return OPCODE_FAIL')
+            self.emit(f'{indent}ctx.pc = {target}')
+        self.emit('return OPCODE_CONTINUE')
+
+    def compile(self):
+        block = self.block
+        instructions = self.program.instructions
+        code = self.program.code
+        name = f'block_{block.start}'
+        # The last opcode run through its handler, its response is the block's
+        # response if nothing runs after it
+        lastResponse = 'OPCODE_CONTINUE'
+        pc = block.start
+        while pc < block.end:
+            run, nextPc, opcodeDataObj = instructions[pc]
+            op = code[pc]
+            lastResponse = 'OPCODE_CONTINUE'
+            if opcodeDataObj is None:
+                self.callHandler(pc, run)
+                lastResponse = 'r'
+            elif pc in self.program.immediates:
+                self.virtual.append(self.program.immediates[pc])
+            elif op in BINARY:
+                a = self.pop()
+                b = self.pop()
+                self.virtual.append(self.operation(BINARY[op], a=a, b=b))
+            elif op in UNARY:
+                a = self.pop()
+                self.virtual.append(self.operation(UNARY[op], a=a))
+            elif op >= 0x80 and op <= 0x8f:
+                index = op - 0x80 + 1
+                self.ensure(index)
+                self.virtual.append(self.virtual[-index])
+            elif op >= 0x90 and op <= 0x9f:
+                index = op - 0x90 + 1
+                self.ensure(index + 1)
+                v = self.virtual
+                v[-1], v[-(index+1)] = v[-(index+1)], v[-1]
+            elif op == 0x50:
+                self.pop()
+            elif op == 0x58:
+                self.virtual.append(pc)
+            elif op == 0x5b:
+                pass
+            elif op == 0x51:
+                a = self.pop()
+                # memory expansion can run out of gas, the items below the
+                # operands have to be on the real stack then as with the
+                # handler
+                self.flush()
+                self.virtual.append(self.newLocal(f'ctx.memory.load({self.render(a)})'))
+            elif op == 0x52 or op == 0x53:
+                a = self.render(self.pop())
+                b = self.render(self.pop())
+                self.flush()
+                # keep the order of side effects, values pushed before still
+                # have to be visible to handlers called later
+                if op == 0x52:
+                    self.emit(f'ctx.memory.store({a}, {b}, 32)')
+                else:
+                    self.emit(f'ctx.memory.store({a}, {b} & 0xff, 1)')
+            elif op == 0x56:
+                target = self.pop()
+                self.flush()
+                self.jump(target)
+                return name
+            elif op == 0x57:
+                target = self.pop()
+                condition = self.pop()
+                self.flush()
+                if isinstance(condition, int):
+                    if condition:
+                        self.jump(target)
+                    else:
+                        self.emit('return OPCODE_CONTINUE')
+                else:
+                    self.jump(target, condition)
+                return name
+            elif op == 0x00:
+                self.flush()
+                self.emit('return OPCODE_STOP')
+                return name
+            else:
+                self.callHandler(pc, run)
+                lastResponse = 'r'
+            pc = nextPc
+        self.flush()
+        self.emit(f'return {lastResponse}')
+        return name
+
+    def source(self, name):
+        header = [
+            f'def {name}(ctx, inputParam):',
+            '    stack = ctx.stack.list',
+            '    pop = stack.pop',
+            '    push = stack.append',
+        ]
+        return '\n'.join(header + self.lines)
+
+def compileProgram(program, blocks, jumpDest, runtime):
+    # Returns the generated source and block start pc -> compiled function
+    runtime = dict(runtime)
+    runtime['jumpDest'] = jumpDest
+    sources = []
+    names = {}
+    for block in blocks:
+        compiler = BlockCompiler(program, block, jumpDest, runtime)
+        name = compiler.compile()
+        sources.append(compiler.source(name))
+        names[block.start] = name
+    source = '\n\n'.join(sources) + '\n'
+    exec(compile(source, f'<jit {len(program.code)} bytes>', 'exec'), runtime)
+    return source, {start: runtime[name] for start, name in names.items()}
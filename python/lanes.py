@@ -0,0 +1,612 @@
+#!/usr/bin/env python3
+
+# Vectorized execution of one contract over many inputs for EVM From Scratch
+#
+# LaneEngine.execute runs the same code once per calldata ("lane") and
+# returns what EVM.execute returns for each of them, for fuzzing and batches
+# of eth_call. Lanes run together in groups which share their pc: every
+# stack item of a group is an int when it is the same in all of its lanes
+# (PUSH, CALLER, ...) or a (4, lanes) NumPy uint64 array of 64-bit limbs,
+# least significant limb first. Arithmetic, comparison and bitwise opcodes,
+# calldata and memory accesses then run once per group instead of once per
+# lane. Static block gas and memory expansion are charged per group, they
+# are the same in all of its lanes.
+#
+# When JUMP or JUMPI sends the lanes of a group to different pcs the group
+# is split into one group per destination. Lanes the groups do not model go
+# to the scalar path, they are run again from the start with engine.execute:
+# groups smaller than minLanes, opcodes outside of VECTOR_OPCODES (storage,
+# calls, logs, SHA3, DIV, ...), memory offsets which differ between lanes,
+# invalid jumps, failed stack checks and running out of gas.
+#
+# Lanes never commit to the state, as with commit=False. An engine with a
+# tracer or profiler runs every lane on the scalar path so its hooks see
+# every instruction, an opcode the engine's table replaced always runs
+# there. NumPy is only needed by this module, evm.py does not import it.
+#
+#   python3 lanes.py [lanes] [rounds]
+#
+# runs a contract decoding its calldata over random calldata on both paths,
+# checks that every result matches and prints the throughput.
+
+import random
+import sys
+import time
+
+import numpy as np
+
+import evm
+
+M = evm.UINT256MAX
+# groups smaller than this run on the scalar path
+MIN_LANES = 8
+# memory per lane a group may grow to, larger offsets run on the scalar path
+MAX_MEMORY = 1 << 20
+
+class Fallback(Exception):
+    # the group's lanes have to run on the scalar path
+    pass
+
+def toLimbs(value):
+    # (4, 1) limbs of an int, broadcasts against (4, lanes)
+    return np.array([[(value >> shift) & 0xffffffffffffffff] for shift in (0, 64, 128, 192)], dtype=np.uint64)
+
+def expand(item, count):
+    # a stack item as (4, count) limbs, ints as a read only view
+    if isinstance(item, int):
+        return np.broadcast_to(toLimbs(item), (4, count))
+    return item
+
+def toInts(item, count):
+    if isinstance(item, int):
+        return [item] * count
+    return [a | b << 64 | c << 128 | d << 192 for a, b, c, d in zip(*item.tolist())]
+
+def uniform(item):
+    # the int in all lanes of an item, None when lanes differ
+    if isinstance(item, int):
+        return item
+    if (item == item[:, :1]).all():
+        return toInts(item[:, :1], 1)[0]
+    return None
+
+def lowWord(values, count):
+    # words holding `values` (n,) in their lowest limb
+    out = np.zeros((4, count), np.uint64)
+    out[0] = values
+    return out
+
+def bytesToWords(data):
+    # (n, 32) big-endian bytes to (4, n) limbs
+    return np.ascontiguousarray(np.ascontiguousarray(data).view('>u8').astype(np.uint64)[:, ::-1].T)
+
+def wordsToBytes(words):
+    # (4, n) limbs to (n, 32) big-endian bytes
+    return np.ascontiguousarray(words[::-1].T).astype('>u8').view(np.uint8)
+
+# Vector forms of the handlers, a is the top of the stack and b the item
+# below it as in core.py. Operands are (4, lanes) or (4, 1) limbs, results
+# are new arrays, stack items are never changed in place
+def vectorAdd(a, b):
+    out = np.empty(np.broadcast_shapes(a.shape, b.shape), np.uint64)
+    carry = False
+    for k in range(4):
+        s = a[k] + b[k]
+        overflow = s < a[k]
+        out[k] = s + carry
+        carry = overflow | (out[k] < s)
+    return out
+
+def vectorSub(a, b):
+    out = np.empty(np.broadcast_shapes(a.shape, b.shape), np.uint64)
+    borrow = False
+    for k in range(4):
+        d = a[k] - b[k]
+        underflow = a[k] < b[k]
+        out[k] = d - borrow
+        borrow = underflow | (d < borrow)
+    return out
+
+def vectorMul(a, b):
+    # schoolbook on 32-bit halves, columns stay below 2**37 until the carries
+    # are propagated
+    shape = np.broadcast_shapes(a.shape, b.shape)
+    x = [half for k in range(4) for half in (a[k] & 0xffffffff, a[k] >> 32)]
+    y = [half for k in range(4) for half in (b[k] & 0xffffffff, b[k] >> 32)]
+    columns = [np.zeros(shape[1:], np.uint64) for _ in range(8)]
+    for i in range(8):
+        for j in range(8 - i):
+            product = x[i] * y[j]
+            columns[i + j] += product & 0xffffffff
+            if i + j < 7:
+                columns[i + j + 1] += product >> 32
+    carry = 0
+    for k in range(8):
+        column = columns[k] + carry
+        carry = column >> 32
+        columns[k] = column & 0xffffffff
+    out = np.empty(shape, np.uint64)
+    for k in range(4):
+        out[k] = columns[2 * k] | (columns[2 * k + 1] << 32)
+    return out
+
+def lessThan(a, b):
+    less = False
+    for k in range(4):
+        less = (a[k] < b[k]) | ((a[k] == b[k]) & less)
+    return less
+
+def flipSign(a):
+    # signed order of words is the unsigned order with the top bit flipped
+    out = a.copy()
+    out[3] ^= 1 << 63
+    return out
+
+def shiftAmounts(a, count):
+    # per lane shift of a SHL or SHR, `over` where it is 256 or more
+    a = expand(a, count)
+    over = ((a[1] | a[2] | a[3]) != 0) | (a[0] > 255)
+    shift = np.where(over, 0, a[0])
+    return over, (shift >> 6).astype(np.intp), shift & 63
+
+def vectorShr(a, b, count):
+    over, limbs, bits = shiftAmounts(a, count)
+    padded = np.zeros((8, count), np.uint64)
+    padded[:4] = expand(b, count)
+    lanes = np.arange(count)
+    out = np.empty((4, count), np.uint64)
+    for k in range(4):
+        high = padded[k + limbs + 1, lanes] << ((64 - bits) & 63)
+        out[k] = (padded[k + limbs, lanes] >> bits) | np.where(bits == 0, 0, high)
+    out[:, over] = 0
+    return out
+
+def vectorShl(a, b, count):
+    over, limbs, bits = shiftAmounts(a, count)
+    padded = np.zeros((8, count), np.uint64)
+    padded[4:] = expand(b, count)
+    lanes = np.arange(count)
+    out = np.empty((4, count), np.uint64)
+    for k in range(4):
+        low = padded[3 + k - limbs, lanes] >> ((64 - bits) & 63)
+        out[k] = (padded[4 + k - limbs, lanes] << bits) | np.where(bits == 0, 0, low)
+    out[:, over] = 0
+    return out
+
+def shiftRight(b, shift):
+    # b >> shift for the same shift in every lane
+    if shift > 255:
+        return 0
+    limbs, bits = divmod(shift, 64)
+    out = np.zeros((4, b.shape[1]), np.uint64)
+    for k in range(4 - limbs):
+        out[k] = b[k + limbs] >> bits
+        if bits and k + limbs < 3:
+            out[k] |= b[k + limbs + 1] << (64 - bits)
+    return out
+
+def shiftLeft(b, shift):
+    if shift > 255:
+        return 0
+    limbs, bits = divmod(shift, 64)
+    out = np.zeros((4, b.shape[1]), np.uint64)
+    for k in range(limbs, 4):
+        out[k] = b[k - limbs] << bits
+        if bits and k > limbs:
+            out[k] |= b[k - limbs - 1] >> (64 - bits)
+    return out
+
+def vectorByte(a, b, count):
+    a = expand(a, count)
+    b = expand(b, count)
+    valid = ((a[1] | a[2] | a[3]) == 0) & (a[0] < 32)
+    index = 31 - np.minimum(a[0], 31)
+    values = (b[(index >> 3).astype(np.intp), np.arange(count)] >> ((index & 7) * 8)) & 0xff
+    return lowWord(np.where(valid, values, 0), count)
+
+# Pure binary and unary operations: (int form, vector form). The int form
+# runs when the operands are the same in every lane
+BINARY = {
+    0x01: (lambda a, b: (a + b) & M, lambda a, b, n: vectorAdd(a, b)),
+    0x02: (lambda a, b: (a * b) & M, lambda a, b, n: vectorMul(a, b)),
+    0x03: (lambda a, b: (a - b) & M, lambda a, b, n: vectorSub(a, b)),
+    0x10: (lambda a, b: 1 if a < b else 0, lambda a, b, n: lowWord(lessThan(a, b), n)),
+    0x11: (lambda a, b: 1 if a > b else 0, lambda a, b, n: lowWord(lessThan(b, a), n)),
+    0x12: (lambda a, b: 1 if a ^ (1 << 255) < b ^ (1 << 255) else 0,
+           lambda a, b, n: lowWord(lessThan(flipSign(a), flipSign(b)), n)),
+    0x13: (lambda a, b: 1 if a ^ (1 << 255) > b ^ (1 << 255) else 0,
+           lambda a, b, n: lowWord(lessThan(flipSign(b), flipSign(a)), n)),
+    0x14: (lambda a, b: 1 if a == b else 0, lambda a, b, n: lowWord((a == b).all(axis=0), n)),
+    0x16: (lambda a, b: a & b, lambda a, b, n: a & b),
+    0x17: (lambda a, b: a | b, lambda a, b, n: a | b),
+    0x18: (lambda a, b: a ^ b, lambda a, b, n: a ^ b),
+    0x1a: (lambda a, b: (b >> (8 * (31 - a))) & 0xff if a < 32 else 0, vectorByte),
+    0x1b: (lambda a, b: (b << a) & M if a <= 255 else 0, vectorShl),
+    0x1c: (lambda a, b: b >> a if a <= 255 else 0, vectorShr),
+}
+
+UNARY = {
+    0x15: (lambda a: 0 if a else 1, lambda a, n: lowWord(~a.any(axis=0), n)),
+    0x19: (lambda a: a ^ M, lambda a, n: ~a),
+}
+
+# ops whose vector forms need full (4, lanes) operands
+FULL_WIDTH = frozenset((0x1a, 0x1b, 0x1c))
+
+# Opcodes pushing a value of the tx, block or code, the same in every lane
+CONSTANTS = {
+    0x30: lambda run: run.txEnv.to,
+    0x32: lambda run: run.txEnv.origin,
+    0x33: lambda run: run.txEnv.caller,
+    0x34: lambda run: run.txEnv.value,
+    0x38: lambda run: len(run.code),
+    0x3a: lambda run: run.txEnv.gasPrice,
+    0x41: lambda run: run.blockEnv.coinbase,
+    0x42: lambda run: run.blockEnv.timestamp,
+    0x43: lambda run: run.blockEnv.number,
+    0x44: lambda run: run.blockEnv.difficulty,
+    0x45: lambda run: run.blockEnv.gasLimit,
+    0x46: lambda run: run.blockEnv.chainId,
+    0x48: lambda run: run.blockEnv.baseFee,
+}
+
+STACK_OPCODES = frozenset([0x50, 0x5b] + list(range(0x60, 0xa0)))
+CONTROL_OPCODES = frozenset((0x00, 0x35, 0x36, 0x51, 0x52, 0x53, 0x56, 0x57, 0x58, 0x59, 0xf3, 0xfd))
+VECTOR_OPCODES = frozenset(BINARY) | frozenset(UNARY) | frozenset(CONSTANTS) | STACK_OPCODES | CONTROL_OPCODES
+
+def sameHandler(run, default):
+    # DUP and SWAP handlers are made per opcode table, by the same factory
+    if run is default:
+        return True
+    name = getattr(run, '__qualname__', None)
+    return name is not None and '<locals>' in name and name == getattr(default, '__qualname__', None)
+
+class Group:
+    # Lanes running in lockstep at pc. lanes indexes the calldatas, memory
+    # is (lanes, capacity) bytes of which the first memorySize are in use
+    __slots__ = ('lanes', 'pc', 'stack', 'memory', 'memorySize', 'gasLeft', 'calldata', 'calldataSize')
+
+    def __init__(self, lanes, calldata, calldataSize, gasLeft):
+        self.lanes = lanes
+        self.pc = 0
+        self.stack = []
+        self.memory = None
+        self.memorySize = 0
+        self.gasLeft = gasLeft
+        self.calldata = calldata
+        self.calldataSize = calldataSize
+
+    def subset(self, mask, pc):
+        group = Group(self.lanes[mask], self.calldata[mask], self.calldataSize[mask], self.gasLeft)
+        group.pc = pc
+        group.stack = [item if isinstance(item, int) else item[:, mask] for item in self.stack]
+        if self.memory is not None:
+            group.memory = self.memory[mask]
+        group.memorySize = self.memorySize
+        return group
+
+class LaneRun:
+    # One call of LaneEngine.execute
+    def __init__(self, engine, code, outStackFormat, tx, block, state, calldatas):
+        self.engine = engine
+        self.code = code
+        self.outStackFormat = outStackFormat
+        self.tx = tx or {}
+        self.block = block
+        # parsed once for the lanes on the scalar path
+        if not isinstance(state, (evm.BaseState, evm.DiskState)):
+            state = evm.BaseState.fromJson(state)
+        self.state = state
+        self.calldatas = calldatas
+        self.txEnv = evm.TxEnv(self.tx)
+        self.blockEnv = evm.BlockEnv(block)
+        self.metered = self.txEnv.gas is not None
+        self.results = [None] * len(calldatas)
+        self.scalarLanes = []
+        self.groups = []
+
+    def scalar(self, lanes):
+        self.scalarLanes.extend(lanes.tolist())
+
+    def push(self, group):
+        if len(group.lanes) < self.engine.minLanes:
+            self.scalar(group.lanes)
+        else:
+            self.groups.append(group)
+
+    def execute(self):
+        if self.engine.vectorize:
+            analysis = self.engine.engine.analysisCache.get(self.code)
+            self.program = analysis.program
+            self.jumpDest = analysis.jumpDest
+            self.isJumpDest = np.zeros(len(self.code) + 1, bool)
+            self.isJumpDest[list(analysis.jumpDest)] = True
+            count = len(self.calldatas)
+            width = max((len(data) for data in self.calldatas), default=0) + 32
+            calldata = np.zeros((count, width), np.uint8)
+            for lane, data in enumerate(self.calldatas):
+                calldata[lane, :len(data)] = np.frombuffer(data, np.uint8)
+            calldataSize = np.array([len(data) for data in self.calldatas], np.uint64)
+            self.push(Group(np.arange(count), calldata, calldataSize, self.txEnv.gas))
+            while self.groups:
+                group = self.groups.pop()
+                try:
+                    self.run(group)
+                except Fallback:
+                    self.scalar(group.lanes)
+        else:
+            self.scalarLanes = list(range(len(self.calldatas)))
+        engine = self.engine.engine
+        for lane in sorted(self.scalarLanes):
+            tx = dict(self.tx, data=self.calldatas[lane].hex())
+            self.results[lane] = engine.execute(self.code, self.outStackFormat, tx, self.block, self.state, commit=False)
+        self.engine.scalarLanes += len(self.scalarLanes)
+        self.engine.vectorLanes += len(self.calldatas) - len(self.scalarLanes)
+        return self.results
+
+    def run(self, group):
+        code = self.code
+        codeLen = len(code)
+        instructions = self.program.instructions
+        blocks = self.program.blocks
+        immediates = self.program.immediates
+        supported = self.engine.supported
+        stack = group.stack
+        count = len(group.lanes)
+        pc = group.pc
+        while pc < codeLen:
+            block = blocks[pc]
+            if block is not None:
+                end, stackMin, stackLimit, gas, runs = block
+                if len(stack) < stackMin or len(stack) > stackLimit:
+                    raise Fallback()
+                if self.metered:
+                    group.gasLeft -= gas
+                    if group.gasLeft < 0:
+                        raise Fallback()
+            op = code[pc]
+            if op not in supported:
+                raise Fallback()
+            nextPc = instructions[pc][1]
+            if op in BINARY:
+                a = stack.pop()
+                b = stack[-1]
+                intForm, vectorForm = BINARY[op]
+                if isinstance(a, int) and isinstance(b, int):
+                    stack[-1] = intForm(a, b)
+                elif op in FULL_WIDTH:
+                    if op != 0x1a and isinstance(a, int):
+                        stack[-1] = shiftLeft(b, a) if op == 0x1b else shiftRight(b, a)
+                    else:
+                        stack[-1] = vectorForm(a, b, count)
+                else:
+                    stack[-1] = vectorForm(expand(a, 1), expand(b, 1), count)
+            elif op >= 0x60 and op <= 0x7f:
+                stack.append(immediates[pc])
+            elif op >= 0x80 and op <= 0x8f:
+                stack.append(stack[-(op - 0x7f)])
+            elif op >= 0x90 and op <= 0x9f:
+                index = -(op - 0x8f) - 1
+                stack[-1], stack[index] = stack[index], stack[-1]
+            elif op == 0x50:
+                stack.pop()
+            elif op in UNARY:
+                a = stack[-1]
+                intForm, vectorForm = UNARY[op]
+                stack[-1] = intForm(a) if isinstance(a, int) else vectorForm(a, count)
+            elif op in CONSTANTS:
+                stack.append(CONSTANTS[op](self))
+            elif op == 0x5b:
+                pass
+            elif op == 0x56 or op == 0x57:
+                target = stack.pop()
+                condition = stack.pop() if op == 0x57 else None
+                pc = self.jump(group, target, condition, nextPc)
+                if pc is None:
+                    return
+                continue
+            elif op == 0x35:
+                stack[-1] = self.calldataLoad(group, stack[-1])
+            elif op == 0x36:
+                sizes = group.calldataSize
+                stack.append(int(sizes[0]) if (sizes == sizes[0]).all() else lowWord(sizes, count))
+            elif op == 0x51:
+                offset = self.offset(stack[-1])
+                self.expandMemory(group, offset, 32)
+                stack[-1] = bytesToWords(group.memory[:, offset:offset+32])
+            elif op == 0x52 or op == 0x53:
+                offset = self.offset(stack.pop())
+                value = stack.pop()
+                size = 32 if op == 0x52 else 1
+                self.expandMemory(group, offset, size)
+                if isinstance(value, int):
+                    data = (value & 0xff if size == 1 else value).to_bytes(size, 'big')
+                    group.memory[:, offset:offset+size] = np.frombuffer(data, np.uint8)
+                elif size == 1:
+                    group.memory[:, offset] = (value[0] & 0xff).astype(np.uint8)
+                else:
+                    group.memory[:, offset:offset+32] = wordsToBytes(value)
+            elif op == 0x58:
+                stack.append(pc)
+            elif op == 0x59:
+                stack.append(group.memorySize)
+            elif op == 0x00:
+                self.finish(group, True, None)
+                return
+            else:
+                # RETURN and REVERT
+                offset = self.offset(stack.pop())
+                size = self.offset(stack.pop())
+                self.expandMemory(group, offset, size)
+                if size:
+                    data = [row.tobytes().hex() for row in group.memory[:, offset:offset+size]]
+                else:
+                    data = [''] * count
+                self.finish(group, op == 0xf3, data)
+                return
+            pc = nextPc
+        self.finish(group, True, None)
+
+    def offset(self, item):
+        # a memory offset or size, the same in every lane and small enough
+        # for the memory of the group
+        value = uniform(item)
+        if value is None or value > MAX_MEMORY:
+            raise Fallback()
+        return value
+
+    def expandMemory(self, group, offset, size):
+        # as Memory._expand, charged once for the group
+        if not size or offset + size <= group.memorySize:
+            return
+        newSize = (((offset + size) - 1) // 32) * 32 + 32
+        if newSize > MAX_MEMORY:
+            raise Fallback()
+        if self.metered:
+            group.gasLeft -= evm.core.memoryGas(newSize) - evm.core.memoryGas(group.memorySize)
+            if group.gasLeft < 0:
+                raise Fallback()
+        capacity = 0 if group.memory is None else group.memory.shape[1]
+        if newSize > capacity:
+            memory = np.zeros((len(group.lanes), max(newSize, 2 * capacity)), np.uint8)
+            if group.memory is not None:
+                memory[:, :capacity] = group.memory
+            group.memory = memory
+        group.memorySize = newSize
+
+    def calldataLoad(self, group, offset):
+        # bytes past the end of calldata read as zero, the rows of the
+        # calldata matrix end in 32 zero bytes
+        calldata = group.calldata
+        width = calldata.shape[1] - 32
+        if isinstance(offset, int):
+            if offset >= width:
+                return 0
+            return bytesToWords(calldata[:, offset:offset+32])
+        valid = ((offset[1] | offset[2] | offset[3]) == 0) & (offset[0] < width)
+        start = np.where(valid, offset[0], width).astype(np.intp)
+        lanes = np.arange(len(group.lanes))
+        return bytesToWords(calldata[lanes[:, None], start[:, None] + np.arange(32)])
+
+    def jump(self, group, target, condition, nextPc):
+        # The pc the group continues at, None when it was split
+        if isinstance(target, int) and (condition is None or isinstance(condition, int)):
+            if condition is not None and not condition:
+                return nextPc
+            if target not in self.jumpDest:
+                raise Fallback()
+            return target
+        count = len(group.lanes)
+        codeLen = len(self.code)
+        target = expand(target, count)
+        small = ((target[1] | target[2] | target[3]) == 0) & (target[0] < codeLen)
+        destination = np.where(small, target[0], codeLen).astype(np.intp)
+        # -1 marks lanes jumping to something which is not a JUMPDEST
+        destination = np.where(self.isJumpDest[destination], destination, -1)
+        if condition is not None:
+            taken = condition != 0 if isinstance(condition, int) else condition.any(axis=0)
+            destination = np.where(taken, destination, nextPc)
+        pcs = np.unique(destination)
+        if len(pcs) == 1 and pcs[0] >= 0:
+            return int(pcs[0])
+        for pc in pcs.tolist():
+            mask = destination == pc
+            if pc < 0:
+                self.scalar(group.lanes[mask])
+            else:
+                self.push(group.subset(mask, pc))
+        return None
+
+    def finish(self, group, success, returnData):
+        count = len(group.lanes)
+        columns = [toInts(item, count) for item in group.stack]
+        for index, lane in enumerate(group.lanes.tolist()):
+            elements = [column[index] for column in columns]
+            if self.outStackFormat == evm.outputStackFormat.MultipleLine:
+                stackOutput = elements[::-1]
+            else:
+                tempList = [f'{i:x}' for i in elements]
+                stackOutput = [int(''.join(tempList), 16)] if tempList else []
+            logsReturnOutput = {}
+            if self.metered:
+                logsReturnOutput['gasUsed'] = self.txEnv.gas - group.gasLeft
+            logsReturnOutput['returnData'] = returnData[index] if returnData is not None else None
+            self.results[lane] = (success, stackOutput, logsReturnOutput)
+
+class LaneEngine:
+    # Runs contracts over many calldatas on `engine` (evm.defaultEngine by
+    # default). vectorLanes and scalarLanes count the lanes run on each path
+    def __init__(self, engine=None, minLanes=MIN_LANES):
+        self.engine = engine if engine is not None else evm.defaultEngine
+        self.minLanes = minLanes
+        self.vectorLanes = 0
+        self.scalarLanes = 0
+        self.vectorize = self.engine.tracer is None and self.engine.profiler is None
+        # opcodes the engine runs with the default handlers
+        defaults = evm.defaultOpcodes()
+        self.supported = frozenset(op for op in VECTOR_OPCODES
+                                   if op in defaults and op in self.engine.opcodes
+                                   and sameHandler(self.engine.opcodes[op].run, defaults[op].run))
+
+    # One result of EVM.execute per calldata (bytes), with tx['data'] replaced
+    # by the calldata
+    def execute(self, code, outStackFormat, tx, block, state, calldatas):
+        return LaneRun(self, code, outStackFormat, tx, block, state, list(calldatas)).execute()
+
+def executeLanes(code, outStackFormat, tx, block, state, calldatas, engine=None):
+    return LaneEngine(engine).execute(code, outStackFormat, tx, block, state, calldatas)
+
+def decoder():
+    # Dispatches on the selector: 0x11111111 returns a word computed from
+    # two arguments, 0x22222222 loops (first argument & 7) times and returns
+    # the counter and the shifted second argument, anything else reverts
+    from benchsuite import assemble
+    return assemble(
+        0, 'CALLDATALOAD', 224, 'SHR',
+        'DUP1', 0x11111111, 'EQ', ':first', 'JUMPI',
+        'DUP1', 0x22222222, 'EQ', ':second', 'JUMPI',
+        0, 0, 'REVERT',
+        '@first', 36, 'CALLDATALOAD', 4, 'CALLDATALOAD',
+        'DUP2', 'DUP2', 'MUL', 'DUP3', 'DUP3', 'SUB', 'XOR',
+        'DUP2', 'DUP2', 'LT', 'ADD', 'DUP3', 'DUP3', 'SGT', 'OR',
+        0, 'MSTORE', 'CALLDATASIZE', 32, 'MSTORE8', 33, 0, 'RETURN',
+        '@second', 36, 'CALLDATALOAD', 4, 'CALLDATALOAD', 7, 'AND', 0,
+        '@loop', 'DUP2', 'DUP2', 'LT', 'ISZERO', ':done', 'JUMPI',
+        'SWAP2', 3, 'SHL', 'SWAP2', 1, 'ADD', ':loop', 'JUMP',
+        '@done', 'STOP')
+
+def randomCalldata(rng):
+    selector = rng.choice((0x11111111, 0x22222222, 0x33333333))
+    words = [rng.choice((0, 1, 7, M, 1 << 255, rng.getrandbits(256), rng.getrandbits(64))) for _ in range(2)]
+    data = selector.to_bytes(4, 'big') + b''.join(word.to_bytes(32, 'big') for word in words)
+    return data[:rng.choice((len(data), len(data), 20, 50))]
+
+def main(args):
+    count = int(args[0]) if len(args) > 0 else 4096
+    rounds = int(args[1]) if len(args) > 1 else 3
+    rng = random.Random(1)
+    code = decoder()
+    tx = {'gas': hex(100000)}
+    calldatas = [randomCalldata(rng) for _ in range(count)]
+    lanes = LaneEngine()
+    best = None
+    for _ in range(rounds):
+        start = time.perf_counter()
+        results = lanes.execute(code, evm.outputStackFormat.MultipleLine, tx, None, {}, calldatas)
+        seconds = time.perf_counter() - start
+        best = seconds if best is None else min(best, seconds)
+    start = time.perf_counter()
+    expected = [evm.defaultEngine.execute(code, evm.outputStackFormat.MultipleLine, dict(tx, data=data.hex()), None, {},
+                                          commit=False) for data in calldatas]
+    scalarSeconds = time.perf_counter() - start
+    mismatches = [lane for lane in range(count) if results[lane] != expected[lane]]
+    for lane in mismatches[:5]:
+        print(f'lane {lane} calldata {calldatas[lane].hex()}')
+        print('   vector:', results[lane])
+        print('   scalar:', expected[lane])
+    print(f'{count} lanes: {count / best:,.0f} runs/s vectorized, {count / scalarSeconds:,.0f} runs/s scalar, '
+          f'{lanes.scalarLanes // rounds} lanes on the scalar path, {len(mismatches)} mismatches')
+    return 1 if mismatches else 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,207 @@
+# Per-opcode profiler for EVM From Scratch
+#
+# Attached with EVM(profiler=...), the engine then runs the code with
+# runProgramProfiled which times every handler and records the totals of
+# each execution. Without a profiler the normal run loops are used.
+#
+# Collected:
+#   per opcode      execution count, cumulative handler time and optionally
+#                   a latency histogram
+#   per execution   instructions, wall time, peak memory size and peak
+#                   stack depth
+#
+# Calls run their code with runProgramProfiled as well, in a frame of their
+# own. The time of a call's frame is not counted for the CALL (CALLCODE,
+# DELEGATECALL, STATICCALL) which made it, its opcodes are counted for
+# themselves. An execution is one call of EVM.execute: its instructions
+# include those of every frame it called and its peaks are the largest of
+# any of its frames.
+#
+# Results are exported with toJson() and toPrometheus(). This module does
+# not import evm.py, the opcode table is passed in so every opcode shows up
+# in the results even before it ran.
+
+import json
+import threading
+from collections import deque
+
+# Histogram bucket upper bounds in nanoseconds
+DEFAULT_BUCKETS = (100, 250, 500, 1000, 2500, 5000, 10000, 25000, 100000, 1000000)
+
+class OpcodeStats:
+    def __init__(self, opcode, name, buckets):
+        self.opcode = opcode
+        self.name = name
+        self.count = 0
+        # nanoseconds
+        self.time = 0
+        # per bucket counts, the last one is +Inf. None when histograms are off
+        self.histogram = [0] * (len(buckets) + 1) if buckets else None
+
+class Frame:
+    # Running call frame, collects what its nested frames did
+    __slots__ = ('childTime', 'instructions', 'peakMemory', 'peakStack')
+
+    def __init__(self):
+        # nanoseconds spent in nested frames since the last handler of this
+        # frame was recorded
+        self.childTime = 0
+        self.instructions = 0
+        self.peakMemory = 0
+        self.peakStack = 0
+
+class ExecutionStats:
+    def __init__(self, instructions, wallTime, peakMemory, peakStack, success):
+        self.instructions = instructions
+        # nanoseconds
+        self.wallTime = wallTime
+        self.peakMemory = peakMemory
+        self.peakStack = peakStack
+        self.success = success
+
+    def toDict(self):
+        return {
+            'instructions': self.instructions,
+            'wallTime': self.wallTime / 1e9,
+            'peakMemory': self.peakMemory,
+            'peakStack': self.peakStack,
+            'success': self.success,
+        }
+
+class Profiler:
+    # opcodeTable is the engine's opcodes. histograms=True records a latency histogram
+    # per opcode, recent executions are kept up to `keep`
+    def __init__(self, opcodeTable, histograms=False, buckets=DEFAULT_BUCKETS, keep=1000):
+        self.buckets = tuple(buckets) if histograms else ()
+        self.opcodes = {}
+        for op, opcodeDataObj in opcodeTable.items():
+            self.opcodes[op] = OpcodeStats(op, opcodeDataObj.name, self.buckets)
+        self.recent = deque(maxlen=keep)
+        # totals over every execution
+        self.executions = 0
+        self.instructions = 0
+        self.wallTime = 0
+        self.peakMemory = 0
+        self.peakStack = 0
+        # running frames, per thread as the engine can run on several
+        self.local = threading.local()
+
+    # Frame of a call starting to run, handed back to exit()
+    def enter(self):
+        frames = getattr(self.local, 'frames', None)
+        if frames is None:
+            frames = self.local.frames = []
+        frame = Frame()
+        frames.append(frame)
+        return frame
+
+    # Ends the frame, a top-level frame is recorded as an execution and a
+    # nested one is added to its caller
+    def exit(self, frame, instructions, wallTime, peakMemory, peakStack, success):
+        frames = self.local.frames
+        frames.pop()
+        instructions += frame.instructions
+        peakMemory = max(peakMemory, frame.peakMemory)
+        peakStack = max(peakStack, frame.peakStack)
+        if frames:
+            caller = frames[-1]
+            caller.childTime += wallTime
+            caller.instructions += instructions
+            caller.peakMemory = max(caller.peakMemory, peakMemory)
+            caller.peakStack = max(caller.peakStack, peakStack)
+        else:
+            self.execution(instructions, wallTime, peakMemory, peakStack, success)
+
+    def record(self, op, elapsed):
+        stats = self.opcodes.get(op)
+        if stats is None:
+            # bytes without an entry in the opcode table
+            stats = OpcodeStats(op, f'opcode {hex(op)}', self.buckets)
+            self.opcodes[op] = stats
+        stats.count += 1
+        stats.time += elapsed
+        if stats.histogram is not None:
+            index = 0
+            for bound in self.buckets:
+                if elapsed <= bound:
+                    break
+                index += 1
+            stats.histogram[index] += 1
+
+    def execution(self, instructions, wallTime, peakMemory, peakStack, success):
+        self.recent.append(ExecutionStats(instructions, wallTime, peakMemory, peakStack, success))
+        self.executions += 1
+        self.instructions += instructions
+        self.wallTime += wallTime
+        self.peakMemory = max(self.peakMemory, peakMemory)
+        self.peakStack = max(self.peakStack, peakStack)
+
+    # Opcodes sorted by cumulative time, the ones worth optimizing first
+    def hottest(self):
+        return sorted(self.opcodes.values(), key=lambda s: s.time, reverse=True)
+
+    def toJson(self):
+        opcodes = {}
+        for stats in sorted(self.opcodes.values(), key=lambda s: s.opcode):
+            entry = {'opcode': stats.opcode, 'count': stats.count, 'time': stats.time / 1e9}
+            if stats.histogram is not None:
+                entry['histogram'] = {
+                    'buckets': [b / 1e9 for b in self.buckets],
+                    'counts': stats.histogram,
+                }
+            opcodes[stats.name] = entry
+        return json.dumps({
+            'opcodes': opcodes,
+            'executions': {
+                'count': self.executions,
+                'instructions': self.instructions,
+                'wallTime': self.wallTime / 1e9,
+                'peakMemory': self.peakMemory,
+                'peakStack': self.peakStack,
+            },
+            'recent': [e.toDict() for e in self.recent],
+        }, indent=2)
+
+    def toPrometheus(self):
+        lines = []
+        def metric(name, kind, help):
+            lines.append(f'# HELP {name} {help}')
+            lines.append(f'# TYPE {name} {kind}')
+        opcodes = sorted(self.opcodes.values(), key=lambda s: s.opcode)
+        metric('evm_opcode_executions_total', 'counter', 'Instructions executed per opcode')
+        for stats in opcodes:
+            lines.append(f'evm_opcode_executions_total{{opcode="{stats.name}"}} {stats.count}')
+        metric('evm_opcode_seconds_total', 'counter', 'Time spent in the handler of each opcode')
+        for stats in opcodes:
+            lines.append(f'evm_opcode_seconds_total{{opcode="{stats.name}"}} {stats.time / 1e9}')
+        if self.buckets:
+            metric('evm_opcode_duration_seconds', 'histogram', 'Handler latency per opcode')
+            for stats in opcodes:
+                if not stats.count:
+                    continue
+                cumulative = 0
+                for bound, count in zip(self.buckets, stats.histogram):
+                    cumulative += count
+                    lines.append(f'evm_opcode_duration_seconds_bucket{{opcode="{stats.name}",le="{bound / 1e9}"}} {cumulative}')
+                lines.append(f'evm_opcode_duration_seconds_bucket{{opcode="{stats.name}",le="+Inf"}} {stats.count}')
+                lines.append(f'evm_opcode_duration_seconds_sum{{opcode="{stats.name}"}} {stats.time / 1e9}')
+                lines.append(f'evm_opcode_duration_seconds_count{{opcode="{stats.name}"}} {stats.count}')
+        metric('evm_executions_total', 'counter', 'Profiled executions')
+        lines.append(f'evm_executions_total {self.executions}')
+        metric('evm_instructions_total', 'counter', 'Instructions executed by all executions')
+        lines.append(f'evm_instructions_total {self.instructions}')
+        metric('evm_execution_seconds_total', 'counter', 'Wall time of all executions')
+        lines.append(f'evm_execution_seconds_total {self.wallTime / 1e9}')
+        metric('evm_peak_memory_bytes', 'gauge', 'Largest memory size of any execution')
+        lines.append(f'evm_peak_memory_bytes {self.peakMemory}')
+        metric('evm_peak_stack_depth', 'gauge', 'Deepest stack of any execution')
+        lines.append(f'evm_peak_stack_depth {self.peakStack}')
+        return '\n'.join(lines) + '\n'
+
+    # Writes Prometheus text for .prom files, JSON otherwise
+    def save(self, path):
+        with open(path, 'w') as f:
+            if path.endswith('.prom'):
+                f.write(self.toPrometheus())
+            else:
+                f.write(self.toJson())
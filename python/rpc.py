@@ -0,0 +1,315 @@
+#!/usr/bin/env python3
+
+# JSON-RPC server for EVM From Scratch
+#
+# Serves eth_call and eth_estimateGas over HTTP on localhost, as single
+# requests and batches, against one BaseState or DiskState:
+#
+#   python3 rpc.py [port=8545] [state=<state.json>] [db=<state.db>]
+#                  [workers=4] [pending=64] [instructions=N] [seconds=S]
+#                  [gascap=N]
+#
+# state= is a state mapping as in evm.json, db= a database written by
+# DiskState. Calls never change the state. The block tag parameter is
+# accepted and ignored, every call runs in the default BlockEnv.
+#
+# Requests are executed by a pool of worker threads sharing one EVM engine,
+# so the analysis and keccak caches stay warm for the life of the server.
+# The event loop only reads, dispatches and answers requests:
+#   coalescing     identical requests in flight share one execution
+#   budgets        every request gets an instruction and a time Budget next
+#                  to its gas limit, running out is answered with an error
+#   backpressure   at most `pending` executions are queued or running, more
+#                  are answered with a "limit exceeded" error right away
+
+import asyncio
+import json
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
+import evm
+
+# JSON-RPC error codes
+PARSE_ERROR = -32700
+INVALID_REQUEST = -32600
+METHOD_NOT_FOUND = -32601
+INVALID_PARAMS = -32602
+INTERNAL_ERROR = -32603
+EXECUTION_ERROR = -32000
+LIMIT_EXCEEDED = -32005
+# what nodes answer for REVERT, with the revert data as error data
+EXECUTION_REVERTED = 3
+
+# intrinsic gas of a transaction and of its calldata bytes
+TX_GAS = 21000
+TX_DATA_ZERO_GAS = 4
+TX_DATA_NONZERO_GAS = 16
+
+class RpcError(Exception):
+    def __init__(self, code, message, data=None):
+        super().__init__(message)
+        self.code = code
+        self.message = message
+        self.data = data
+
+    def toResponse(self, id):
+        error = {'code': self.code, 'message': self.message}
+        if self.data is not None:
+            error['data'] = self.data
+        return {'jsonrpc': '2.0', 'id': id, 'error': error}
+
+def quantity(value, name):
+    if not isinstance(value, str) or not value.startswith('0x'):
+        raise RpcError(INVALID_PARAMS, f'{name} must be a 0x prefixed hex string')
+    try:
+        return int(value, 16)
+    except ValueError:
+        raise RpcError(INVALID_PARAMS, f'{name} is not a hex number')
+
+def data(value, name):
+    if not isinstance(value, str) or not value.startswith('0x'):
+        raise RpcError(INVALID_PARAMS, f'{name} must be a 0x prefixed hex string')
+    try:
+        return bytes.fromhex(value[2:])
+    except ValueError:
+        raise RpcError(INVALID_PARAMS, f'{name} is not hex data')
+
+def intrinsicGas(calldata):
+    zeros = calldata.count(0)
+    return TX_GAS + TX_DATA_ZERO_GAS * zeros + TX_DATA_NONZERO_GAS * (len(calldata) - zeros)
+
+class Call:
+    # The call object of eth_call and eth_estimateGas, parsed once
+    def __init__(self, params, gasCap):
+        if not isinstance(params, list) or not params or not isinstance(params[0], dict):
+            raise RpcError(INVALID_PARAMS, 'expected [call object, block]')
+        call = params[0]
+        if call.get('to') is None:
+            raise RpcError(INVALID_PARAMS, 'contract creation is not supported')
+        self.to = quantity(call['to'], 'to')
+        self.caller = quantity(call.get('from', '0x0'), 'from')
+        self.gasPrice = quantity(call.get('gasPrice', '0x0'), 'gasPrice')
+        self.value = quantity(call.get('value', '0x0'), 'value')
+        self.data = data(call.get('input', call.get('data', '0x')), 'input')
+        self.gas = min(quantity(call['gas'], 'gas'), gasCap) if 'gas' in call else gasCap
+
+    # tx mapping for EVM.execute with `gas` for the execution
+    def tx(self, gas):
+        return {
+            'to': hex(self.to),
+            'from': hex(self.caller),
+            'origin': hex(self.caller),
+            'gasprice': hex(self.gasPrice),
+            'value': hex(self.value),
+            'data': self.data.hex(),
+            'gas': hex(gas),
+        }
+
+class RpcServer:
+    # state is a BaseState or DiskState. instructions and seconds are the
+    # budget of one request, gasCap the most gas any call runs with
+    def __init__(self, state, engine=None, workers=4, maxPending=64, instructions=50_000_000,
+                 seconds=5.0, gasCap=50_000_000, maxBatch=100, maxBody=1 << 20):
+        self.state = state
+        self.engine = engine if engine is not None else evm.EVM()
+        self.pool = ThreadPoolExecutor(workers)
+        self.maxPending = maxPending
+        self.instructions = instructions
+        self.seconds = seconds
+        self.gasCap = gasCap
+        self.maxBatch = maxBatch
+        self.maxBody = maxBody
+        self.methods = {
+            'eth_call': self.call,
+            'eth_estimateGas': self.estimateGas,
+        }
+        # executions queued or running, by request key
+        self.inflight = {}
+        self.requests = 0
+        self.coalesced = 0
+        self.rejected = 0
+
+    # Runs in a worker thread, raises RpcError for every failure
+    def execute(self, call, gas, budget):
+        account = self.state.accounts.get(call.to)
+        if account is None or not account.code:
+            # nothing runs, the call succeeds without output
+            return True, 0, b''
+        try:
+            (success, stack, output) = self.engine.execute(account.code, evm.outputStackFormat.MultipleLine,
+                                                           call.tx(gas), {}, self.state, commit=False, budget=budget)
+        except evm.core.BudgetExceeded as e:
+            raise RpcError(LIMIT_EXCEEDED, str(e))
+        if output is None:
+            raise RpcError(EXECUTION_ERROR, 'invalid opcode')
+        returnData = bytes.fromhex(output['returnData']) if output['returnData'] is not None else b''
+        if not success and output['returnData'] is not None:
+            raise RpcError(EXECUTION_REVERTED, 'execution reverted', '0x' + returnData.hex())
+        return success, output['gasUsed'], returnData
+
+    def call(self, params):
+        call = Call(params, self.gasCap)
+        success, gasUsed, returnData = self.execute(call, call.gas, evm.core.Budget(self.instructions, self.seconds))
+        if not success:
+            raise RpcError(EXECUTION_ERROR, 'out of gas' if gasUsed >= call.gas else 'execution failed')
+        return '0x' + returnData.hex()
+
+    def estimateGas(self, params):
+        call = Call(params, self.gasCap)
+        intrinsic = intrinsicGas(call.data)
+        if call.gas < intrinsic:
+            raise RpcError(EXECUTION_ERROR, 'intrinsic gas too low')
+        # one budget for every probe of the request
+        budget = evm.core.Budget(self.instructions, self.seconds)
+        limit = call.gas - intrinsic
+        success, gasUsed, _ = self.execute(call, limit, budget)
+        if not success:
+            raise RpcError(EXECUTION_ERROR, f'gas required exceeds allowance ({call.gas})')
+        # the gas used is usually enough, CALL forwarding 63/64 of what is
+        # left can need more, find the lowest limit which succeeds
+        low = gasUsed - 1
+        high = limit
+        if self.succeeds(call, gasUsed, budget):
+            high = gasUsed
+        while low + 1 < high:
+            middle = (low + high) // 2
+            if self.succeeds(call, middle, budget):
+                high = middle
+            else:
+                low = middle
+        return hex(high + intrinsic)
+
+    def succeeds(self, call, gas, budget):
+        try:
+            return self.execute(call, gas, budget)[0]
+        except RpcError as e:
+            if e.code == LIMIT_EXCEEDED:
+                raise
+            return False
+
+    async def dispatch(self, method, params):
+        key = json.dumps([method, params], sort_keys=True)
+        future = self.inflight.get(key)
+        if future is not None:
+            self.coalesced += 1
+        else:
+            if len(self.inflight) >= self.maxPending:
+                self.rejected += 1
+                raise RpcError(LIMIT_EXCEEDED, 'too many pending requests')
+            loop = asyncio.get_running_loop()
+            future = loop.run_in_executor(self.pool, self.methods[method], params)
+            self.inflight[key] = future
+            # removed when the execution finishes, even if every client
+            # waiting for it went away
+            future.add_done_callback(lambda _: self.inflight.pop(key, None))
+        # one client going away must not cancel the execution of the others
+        return await asyncio.shield(future)
+
+    async def handleRequest(self, request):
+        if not isinstance(request, dict):
+            return RpcError(INVALID_REQUEST, 'invalid request').toResponse(None)
+        id = request.get('id')
+        method = request.get('method')
+        if request.get('jsonrpc') != '2.0' or not isinstance(method, str):
+            return RpcError(INVALID_REQUEST, 'invalid request').toResponse(id)
+        self.requests += 1
+        try:
+            if method not in self.methods:
+                raise RpcError(METHOD_NOT_FOUND, f'method {method} not found')
+            response = {'jsonrpc': '2.0', 'id': id, 'result': await self.dispatch(method, request.get('params', []))}
+        except RpcError as e:
+            response = e.toResponse(id)
+        except Exception as e:
+            response = RpcError(INTERNAL_ERROR, f'{type(e).__name__}: {e}').toResponse(id)
+        # notifications are not answered
+        return response if 'id' in request else None
+
+    # JSON-RPC message -> response object, None when nothing is answered
+    async def handleMessage(self, body):
+        try:
+            message = json.loads(body)
+        except ValueError:
+            return RpcError(PARSE_ERROR, 'parse error').toResponse(None)
+        if isinstance(message, list):
+            if not message or len(message) > self.maxBatch:
+                return RpcError(INVALID_REQUEST, f'batches need 1 to {self.maxBatch} requests').toResponse(None)
+            responses = await asyncio.gather(*(self.handleRequest(request) for request in message))
+            return [response for response in responses if response is not None] or None
+        return await self.handleRequest(message)
+
+    async def handleConnection(self, reader, writer):
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                parts = line.decode('latin-1').split()
+                headers = {}
+                while True:
+                    header = await reader.readline()
+                    if header in (b'\r\n', b'\n', b''):
+                        break
+                    name, _, value = header.decode('latin-1').partition(':')
+                    headers[name.strip().lower()] = value.strip()
+                if len(parts) != 3:
+                    await self.respond(writer, 400, None, False)
+                    break
+                method, _, version = parts
+                length = int(headers.get('content-length', '0') or '0')
+                if length > self.maxBody:
+                    await self.respond(writer, 413, None, False)
+                    break
+                body = await reader.readexactly(length)
+                keepAlive = version == 'HTTP/1.1' and headers.get('connection', '').lower() != 'close'
+                if method != 'POST':
+                    await self.respond(writer, 405, None, keepAlive)
+                else:
+                    response = await self.handleMessage(body)
+                    await self.respond(writer, 200 if response is not None else 204, response, keepAlive)
+                if not keepAlive:
+                    break
+        except (asyncio.IncompleteReadError, ConnectionError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    async def respond(self, writer, status, response, keepAlive):
+        reasons = {200: 'OK', 204: 'No Content', 400: 'Bad Request', 405: 'Method Not Allowed',
+                   413: 'Payload Too Large'}
+        body = json.dumps(response).encode() if response is not None else b''
+        head = (f'HTTP/1.1 {status} {reasons[status]}\r\n'
+                f'Content-Type: application/json\r\n'
+                f'Content-Length: {len(body)}\r\n'
+                f'Connection: {"keep-alive" if keepAlive else "close"}\r\n\r\n')
+        writer.write(head.encode('latin-1') + body)
+        await writer.drain()
+
+    async def serve(self, host='127.0.0.1', port=8545):
+        server = await asyncio.start_server(self.handleConnection, host, port)
+        async with server:
+            await server.serve_forever()
+
+def main(args):
+    options = {'port': '8545', 'workers': '4', 'pending': '64', 'instructions': '50000000',
+               'seconds': '5', 'gascap': '50000000'}
+    for arg in args:
+        name, _, value = arg.partition('=')
+        options[name] = value
+    if 'db' in options:
+        state = evm.DiskState(options['db'], evm.Account, writeBack=False)
+    elif 'state' in options:
+        with open(options['state']) as f:
+            state = evm.BaseState.fromJson(json.load(f))
+    else:
+        state = evm.BaseState()
+    server = RpcServer(state, workers=int(options['workers']), maxPending=int(options['pending']),
+                       instructions=int(options['instructions']), seconds=float(options['seconds']),
+                       gasCap=int(options['gascap']))
+    print(f'listening on http://127.0.0.1:{options["port"]}')
+    try:
+        asyncio.run(server.serve(port=int(options['port'])))
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,190 @@
+# On-disk world state for EVM From Scratch
+#
+# DiskState keeps accounts and storage in a SQLite database and can be passed
+# to evm() wherever a BaseState is accepted: runs read through it and write to
+# their own WorldState overlay. Nothing is loaded up front, every account and
+# slot is read the first time it is needed and kept in an LRU cache, so the
+# state can be far larger than RAM and does not have to be rebuilt per run.
+#
+# When a run succeeds evm() calls commit(world), which writes every account
+# and slot the run changed back in one SQLite transaction and refreshes the
+# cache. With writeBack=False the database is never changed.
+#
+# Addresses, slots, values and balances are stored as big-endian 32 byte
+# blobs, SQLite integers are only 64 bits. One DiskState can be used from
+# several threads, the connection and cache are behind a lock. This module
+# does not import evm.py, the Account class is passed in.
+
+import threading
+from collections import OrderedDict
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS accounts (
+    address BLOB PRIMARY KEY,
+    balance BLOB NOT NULL,
+    code BLOB NOT NULL,
+    asm TEXT
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS storage (
+    address BLOB NOT NULL,
+    slot BLOB NOT NULL,
+    value BLOB NOT NULL,
+    PRIMARY KEY (address, slot)
+) WITHOUT ROWID;
+'''
+
+def word(value):
+    return value.to_bytes(32, 'big')
+
+# Cache entry of accounts and slots which are not in the database
+ABSENT = object()
+
+class LRUCache:
+    # Bounded mapping which drops the least recently used entry when full
+    def __init__(self, maxSize):
+        self.maxSize = maxSize
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    # The cached value or None, None is never stored
+    def get(self, key):
+        value = self.entries.get(key)
+        if value is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.entries.move_to_end(key)
+        return value
+
+    def put(self, key, value):
+        self.entries[key] = value
+        self.entries.move_to_end(key)
+        if len(self.entries) > self.maxSize:
+            self.entries.popitem(last=False)
+
+    def clear(self):
+        self.entries.clear()
+
+class DiskAccounts:
+    # Read side of the accounts table, looks like the accounts mapping of a
+    # BaseState. Accounts handed out are shared, overlays copy them before
+    # changing them
+    def __init__(self, disk):
+        self.disk = disk
+
+    def get(self, address, default=None):
+        account = self.disk.loadAccount(address)
+        return default if account is ABSENT else account
+
+    def __contains__(self, address):
+        return self.disk.loadAccount(address) is not ABSENT
+
+class DiskStorage:
+    # Read side of the storage of one account, looks like the storage
+    # mapping of a BaseState
+    def __init__(self, disk, address):
+        self.disk = disk
+        self.address = address
+
+    def get(self, key, default=None):
+        value = self.disk.loadSlot(self.address, key)
+        return default if value is ABSENT else value
+
+class DiskState:
+    # `path` of the SQLite database, ':memory:' for a throwaway one. account
+    # is evm.Account. cacheSize bounds the accounts and slots kept in memory
+    def __init__(self, path, account, cacheSize=1 << 16, writeBack=True):
+        # imported here, evm.py imports this module whether or not a
+        # DiskState is used
+        import sqlite3
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.lock = threading.Lock()
+        self.db.executescript(SCHEMA)
+        self.account = account
+        self.cache = LRUCache(cacheSize)
+        self.writeBack = writeBack
+        self.accounts = DiskAccounts(self)
+
+    def loadAccount(self, address):
+        with self.lock:
+            return self._loadAccount(address)
+
+    def _loadAccount(self, address):
+        key = ('account', address)
+        account = self.cache.get(key)
+        if account is None:
+            row = self.db.execute('SELECT balance, code, asm FROM accounts WHERE address = ?',
+                                  (word(address),)).fetchone()
+            if row is None:
+                account = ABSENT
+            else:
+                account = self.account(balance=int.from_bytes(row[0], 'big'), code=bytes(row[1]), codeAsm=row[2])
+            self.cache.put(key, account)
+        return account
+
+    def loadSlot(self, address, slot):
+        with self.lock:
+            return self._loadSlot(address, slot)
+
+    def _loadSlot(self, address, slot):
+        key = (address, slot)
+        value = self.cache.get(key)
+        if value is None:
+            row = self.db.execute('SELECT value FROM storage WHERE address = ? AND slot = ?',
+                                  (word(address), word(slot))).fetchone()
+            value = int.from_bytes(row[0], 'big') if row is not None else ABSENT
+            self.cache.put(key, value)
+        return value
+
+    def storageOf(self, address):
+        return DiskStorage(self, address)
+
+    # Writes the accounts and slots changed by a WorldState in one
+    # transaction. Slots set to zero are deleted
+    def commit(self, world):
+        if not self.writeBack:
+            return
+        with self.lock:
+            self._commit(world)
+
+    def _commit(self, world):
+        accountRows = []
+        for address, account in world.accounts.items():
+            accountRows.append((word(address), word(account.balance), account.code, account.codeAsm))
+        slotRows = []
+        clearedRows = []
+        for address, slots in world.storages.items():
+            for slot, value in slots.items():
+                if value:
+                    slotRows.append((word(address), word(slot), word(value)))
+                else:
+                    clearedRows.append((word(address), word(slot)))
+        with self.db:
+            self.db.executemany('INSERT OR REPLACE INTO accounts VALUES (?, ?, ?, ?)', accountRows)
+            self.db.executemany('INSERT OR REPLACE INTO storage VALUES (?, ?, ?)', slotRows)
+            self.db.executemany('DELETE FROM storage WHERE address = ? AND slot = ?', clearedRows)
+        # the overlay may still be used by the caller, cache copies
+        for address, account in world.accounts.items():
+            self.cache.put(('account', address),
+                           self.account(balance=account.balance, code=account.code, codeAsm=account.codeAsm))
+        for address, slots in world.storages.items():
+            for slot, value in slots.items():
+                self.cache.put((address, slot), value if value else ABSENT)
+
+    # Imports a BaseState, e.g. BaseState.fromJson of a test's state
+    def load(self, base):
+        with self.lock:
+            with self.db:
+                self.db.executemany('INSERT OR REPLACE INTO accounts VALUES (?, ?, ?, ?)',
+                                    [(word(address), word(account.balance), account.code, account.codeAsm)
+                                     for address, account in base.accounts.items()])
+                self.db.executemany('INSERT OR REPLACE INTO storage VALUES (?, ?, ?)',
+                                    [(word(address), word(slot), word(value))
+                                     for address, slots in base.storages.items()
+                                     for slot, value in slots.items() if value])
+            self.cache.clear()
+
+    def close(self):
+        with self.lock:
+            self.db.close()
@@ -0,0 +1,88 @@
+# Execution tracers for EVM From Scratch
+#
+# A tracer is attached with EVM(tracer=...), the engine then runs the code
+# with runProgramTraced which reports every instruction. Without a tracer the
+# untraced run loops are used and tracing costs nothing.
+#
+# Events:
+#   enter(ctx)                                  a call frame starts running
+#   step(ctx, pc, op, opcodeDataObj, gas)       before every instruction, gas
+#                                               is what is left before it runs
+#   exit(ctx, success, output, gasUsed)         the call frame finished,
+#                                               output is the return data hex
+#
+# ctx.depth is the call depth, 1 for the outermost frame. This module does
+# not import evm.py
+
+import json
+import time
+
+class Tracer:
+    # Base class, every event does nothing
+    def enter(self, ctx):
+        pass
+
+    def step(self, ctx, pc, op, opcodeDataObj, gas):
+        pass
+
+    def exit(self, ctx, success, output, gasUsed):
+        pass
+
+    def close(self):
+        pass
+
+class JsonTracer(Tracer):
+    # EIP-3155 style trace, one JSON object per instruction and a summary
+    # line when the outermost frame exits. `sink` is a path or an open text
+    # file, paths are opened with a large write buffer
+    def __init__(self, sink, memory=False, bufferSize=1 << 16):
+        if isinstance(sink, str):
+            self.file = open(sink, 'w', buffering=bufferSize)
+            self.ownsFile = True
+        else:
+            self.file = sink
+            self.ownsFile = False
+        # memory dumps are large, only include them when asked for
+        self.memory = memory
+        self.write = self.file.write
+        self.started = None
+
+    def enter(self, ctx):
+        if ctx.depth == 1:
+            self.started = time.perf_counter()
+
+    def step(self, ctx, pc, op, opcodeDataObj, gas):
+        line = {
+            'pc': pc,
+            'op': op,
+            'gas': hex(gas),
+            'gasCost': hex(opcodeDataObj.gas if opcodeDataObj is not None else 0),
+            'memSize': ctx.memory.size,
+            'stack': [hex(item) for item in ctx.stack.list],
+            'depth': ctx.depth,
+            'refund': 0,
+            'opName': opcodeDataObj.name if opcodeDataObj is not None else f'opcode {hex(op)}',
+        }
+        if self.memory:
+            line['memory'] = '0x' + ctx.memory.read(0, ctx.memory.size).hex()
+        self.write(json.dumps(line, separators=(',', ':')))
+        self.write('\n')
+
+    def exit(self, ctx, success, output, gasUsed):
+        if ctx.depth != 1:
+            return
+        summary = {
+            'output': output or '',
+            'gasUsed': hex(gasUsed),
+            'pass': success,
+        }
+        if self.started is not None:
+            summary['time'] = int((time.perf_counter() - self.started) * 1e9)
+        self.write(json.dumps(summary, separators=(',', ':')))
+        self.write('\n')
+
+    def close(self):
+        if self.ownsFile:
+            self.file.close()
+        else:
+            self.file.flush()
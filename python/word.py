@@ -0,0 +1,186 @@
+#!/usr/bin/env python3
+
+# 256-bit word arithmetic for EVM From Scratch
+#
+# Operands and results are ints in [0, 2**256). Every function keeps its
+# intermediate values within 512 bits whatever the operands are, so no
+# input can make an opcode allocate huge ints or loop per bit:
+#   exp         modular exponentiation, never builds base ** exponent
+#   sar         one arithmetic shift of the signed value, no per bit loop
+#   div, sdiv   exact integer division, no float rounding
+#   signExtend  byte indexes past 31 leave the value unchanged
+#
+# Signed operands are two's complement words, division and modulo by zero
+# give 0 as the EVM defines.
+#
+#   python3 word.py [rounds]
+#
+# checks the functions against straightforward reference definitions on
+# edge cases and random operands.
+
+from typing import TYPE_CHECKING, Final, Iterator
+
+if TYPE_CHECKING:
+    from random import Random
+
+WORD: Final = 1 << 256
+UINT256MAX: Final = WORD - 1
+SIGN: Final = 1 << 255
+
+def toSigned(value: int) -> int:
+    return value - WORD if value & SIGN else value
+
+def fromSigned(value: int) -> int:
+    return value & UINT256MAX
+
+def div(a: int, b: int) -> int:
+    return a // b if b else 0
+
+def mod(a: int, b: int) -> int:
+    return a % b if b else 0
+
+def sdiv(a: int, b: int) -> int:
+    if not b:
+        return 0
+    a = toSigned(a)
+    b = toSigned(b)
+    # truncates towards zero, Python's // rounds down
+    quotient = abs(a) // abs(b)
+    if (a < 0) != (b < 0):
+        quotient = -quotient
+    # -2**255 / -1 wraps around to -2**255
+    return quotient & UINT256MAX
+
+def smod(a: int, b: int) -> int:
+    if not b:
+        return 0
+    a = toSigned(a)
+    b = toSigned(b)
+    # the result has the sign of a, Python's % takes the sign of b
+    remainder = abs(a) % abs(b)
+    return (-remainder if a < 0 else remainder) & UINT256MAX
+
+def addMod(a: int, b: int, n: int) -> int:
+    return (a + b) % n if n else 0
+
+def mulMod(a: int, b: int, n: int) -> int:
+    return (a * b) % n if n else 0
+
+def exp(base: int, exponent: int) -> int:
+    return pow(base, exponent, WORD)
+
+def shl(shift: int, value: int) -> int:
+    return (value << shift) & UINT256MAX if shift < 256 else 0
+
+def shr(shift: int, value: int) -> int:
+    return value >> shift if shift < 256 else 0
+
+def sar(shift: int, value: int) -> int:
+    # shifting the signed value by 255 already leaves only sign bits, larger
+    # shifts are clamped so they cost the same
+    return (toSigned(value) >> min(shift, 255)) & UINT256MAX
+
+def signExtend(byteIndex: int, value: int) -> int:
+    if byteIndex >= 31:
+        return value
+    bit = byteIndex * 8 + 7
+    low = (1 << (bit + 1)) - 1
+    if value >> bit & 1:
+        return value | (UINT256MAX ^ low)
+    return value & low
+
+# Reference definitions, slow but written from the EVM's description
+def truncatedQuotient(a: int, b: int) -> int:
+    # a / b rounded towards zero, from floor division
+    quotient = a // b
+    if quotient < 0 and quotient * b != a:
+        quotient += 1
+    return quotient
+
+def referenceSdiv(a: int, b: int) -> int:
+    a = toSigned(a)
+    b = toSigned(b)
+    if b == 0:
+        return 0
+    return fromSigned(truncatedQuotient(a, b))
+
+def referenceSmod(a: int, b: int) -> int:
+    a = toSigned(a)
+    b = toSigned(b)
+    if b == 0:
+        return 0
+    return fromSigned(a - b * truncatedQuotient(a, b))
+
+def referenceExp(base: int, exponent: int) -> int:
+    result = 1
+    for bit in reversed(range(exponent.bit_length())):
+        result = result * result % WORD
+        if exponent >> bit & 1:
+            result = result * base % WORD
+    return result
+
+def referenceSar(shift: int, value: int) -> int:
+    result = value
+    for _ in range(min(shift, 256)):
+        result = (result >> 1) | (value & SIGN)
+    return result
+
+def referenceSignExtend(byteIndex: int, value: int) -> int:
+    if byteIndex >= 31:
+        return value
+    bits = value.to_bytes(32, 'big')
+    keep = byteIndex + 1
+    fill = b'\xff' if bits[32 - keep] & 0x80 else b'\x00'
+    return int.from_bytes(fill * (32 - keep) + bits[32 - keep:], 'big')
+
+EDGES: Final = (0, 1, 2, 3, 7, 31, 32, 255, 256, SIGN - 1, SIGN, SIGN + 1, UINT256MAX - 1, UINT256MAX)
+
+def operands(random: 'Random', rounds: int) -> Iterator[tuple[int, int]]:
+    for a in EDGES:
+        for b in EDGES:
+            yield a, b
+    for _ in range(rounds):
+        # mix full words with short ones so small shifts and indexes show up
+        a = random.getrandbits(random.choice((8, 64, 256)))
+        b = random.getrandbits(random.choice((8, 64, 256)))
+        if random.random() < 0.25:
+            a = fromSigned(-a)
+        yield a, b
+
+def check(rounds: int = 20000, seed: int = 1) -> int:
+    from random import Random
+    random = Random(seed)
+    failures = 0
+    def expect(name: str, a: int, b: int, actual: int, expected: int) -> None:
+        nonlocal failures
+        if actual != expected:
+            failures += 1
+            if failures <= 10:
+                print(f'{name}({hex(a)}, {hex(b)}) = {hex(actual)}, expected {hex(expected)}')
+    for a, b in operands(random, rounds):
+        expect('div', a, b, div(a, b), 0 if b == 0 else a // b)
+        expect('sdiv', a, b, sdiv(a, b), referenceSdiv(a, b))
+        expect('smod', a, b, smod(a, b), referenceSmod(a, b))
+        expect('exp', a, b, exp(a, b), referenceExp(a, b))
+        expect('sar', b, a, sar(b, a), referenceSar(b, a))
+        expect('signExtend', b, a, signExtend(b, a), referenceSignExtend(b, a))
+        expect('shl', b, a, shl(b, a), (a * 2 ** b) % WORD if b < 256 else 0)
+        expect('shr', b, a, shr(b, a), a // 2 ** b if b < 256 else 0)
+        n = random.getrandbits(256) | 1
+        expect('addMod', a, b, addMod(a, b, n), (a + b) % n)
+        expect('mulMod', a, b, mulMod(a, b, n), (a * b) % n)
+        # properties which hold for every word
+        if b:
+            expect('div*b+mod', a, b, div(a, b) * b + mod(a, b), a)
+            expect('sdiv*b+smod', a, b, fromSigned(toSigned(sdiv(a, b)) * toSigned(b) + toSigned(smod(a, b))), a)
+        expect('signExtend idempotent', b % 32, a, signExtend(b % 32, signExtend(b % 32, a)), signExtend(b % 32, a))
+        for result in (sdiv(a, b), smod(a, b), exp(a, b), sar(b, a), signExtend(b, a)):
+            expect('in range', a, b, result, result & UINT256MAX)
+    return failures
+
+if __name__ == '__main__':
+    import sys
+    rounds = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    failures = check(rounds)
+    print(f'{failures} failures')
+    sys.exit(1 if failures else 0)